@@ -0,0 +1,133 @@
+import argparse
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from yomitoku import TextDetector
+from yomitoku.configs import TextDetectorDBNetConfig
+from yomitoku.data.functions import estimate_text_height, load_image
+from yomitoku.utils.misc import calc_iou_matrix, quads_to_xyxy
+
+from benchmark_utils import list_images
+
+
+def recall(reference, predicted, thresh=0.5):
+    """Ratio of the reference boxes matched by a predicted box with IoU>=thresh."""
+    if len(reference) == 0:
+        return 1.0
+    if len(predicted) == 0:
+        return 0.0
+
+    iou = calc_iou_matrix(reference, predicted)
+    matched = 0
+    while True:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[i, j] < thresh:
+            break
+        matched += 1
+        iou[i, :] = 0
+        iou[:, j] = 0
+    return matched / len(reference)
+
+
+def build(path_cfg, device, shortest_size=None, adaptive=False):
+    cfg = OmegaConf.load(path_cfg) if path_cfg is not None else OmegaConf.create()
+    default = OmegaConf.structured(TextDetectorDBNetConfig)
+    cfg = OmegaConf.merge(default, cfg)
+
+    if shortest_size is not None:
+        # 最長辺の上限も同じ比率で変更する
+        ratio = shortest_size / cfg.data.shortest_size
+        cfg.data.limit_size = int(cfg.data.limit_size * ratio)
+        cfg.data.shortest_size = shortest_size
+    cfg.data.adaptive_resize = adaptive
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_tmp = str(Path(tmp_dir) / "text_detector.yaml")
+        OmegaConf.save(cfg, path_tmp)
+        return TextDetector(path_cfg=path_tmp, device=device)
+
+
+def measure(detector, img, repeat):
+    """Return the boxes, the median end-to-end latency and the input size."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tensor = detector.preprocess(img)
+        preds = detector.infer(tensor)
+        quads, _ = detector.postprocess(preds, img.shape[:2])
+        times.append(time.perf_counter() - start)
+
+    return quads_to_xyxy(quads), np.median(times), min(tensor.shape[2:])
+
+
+def main(args):
+    warnings.filterwarnings("ignore")
+
+    imgs = [load_image(path) for path in list_images(args.images)]
+
+    # 最も高い解像度の検出結果を正解とみなす
+    sizes = sorted(args.sizes, reverse=True)
+    detectors = {
+        f"fixed {size}": build(args.td_cfg, args.device, size) for size in sizes
+    }
+    detectors["adaptive"] = build(args.td_cfg, args.device, adaptive=True)
+
+    report = {name: {"latency": [], "recall": [], "size": []} for name in detectors}
+    estimate_times = []
+    for img in imgs:
+        start = time.perf_counter()
+        estimate_text_height(img)
+        estimate_times.append(time.perf_counter() - start)
+
+        reference = None
+        for name, detector in detectors.items():
+            boxes, latency, size = measure(detector, img, args.repeat)
+            if reference is None:
+                reference = boxes
+
+            report[name]["latency"].append(latency)
+            report[name]["recall"].append(recall(reference, boxes))
+            report[name]["size"].append(size)
+
+    print(f"{'mode':<14}{'latency [ms]':>14}{'recall':>9}{'min recall':>12}{'size':>8}")
+    for name, values in report.items():
+        latency = np.mean(values["latency"]) * 1000
+        print(
+            f"{name:<14}{latency:>14.1f}{np.mean(values['recall']):>9.3f}"
+            f"{np.min(values['recall']):>12.3f}{np.median(values['size']):>8.0f}"
+        )
+
+    print(
+        f"text height estimation: {np.mean(estimate_times) * 1000:.1f} ms/page, "
+        f"recall: IoU>=0.5 against fixed {sizes[0]}, size: median shortest edge"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", type=str, help="image file or directory to evaluate")
+    parser.add_argument(
+        "--td_cfg",
+        type=str,
+        default=None,
+        help="path of text detector config file",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1920, 1280, 960, 640],
+        help="shortest edge lengths of the fixed resolution modes",
+    )
+    parser.add_argument("--device", type=str, default="cpu", help="device to run on")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="number of runs per image for latency"
+    )
+    args = parser.parse_args()
+
+    main(args)
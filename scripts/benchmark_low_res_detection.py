@@ -0,0 +1,151 @@
+import argparse
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from yomitoku import TextDetector
+from yomitoku.data.functions import load_image
+from yomitoku.utils.misc import calc_iou_matrix, quads_to_xyxy
+
+from benchmark_utils import list_images
+
+
+def match_boxes(reference, predicted, thresh):
+    """Match the boxes greedily by IoU and return the pairs of indices."""
+    if len(reference) == 0 or len(predicted) == 0:
+        return []
+
+    iou = calc_iou_matrix(reference, predicted)
+    pairs = []
+    while True:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[i, j] < thresh:
+            break
+        pairs.append((i, j))
+        iou[i, :] = 0
+        iou[:, j] = 0
+    return pairs
+
+
+def box_f1(reference, predicted, thresh):
+    if len(reference) == 0 and len(predicted) == 0:
+        return 1.0
+
+    matched = len(match_boxes(reference, predicted, thresh))
+    if matched == 0:
+        return 0.0
+
+    precision = matched / len(predicted)
+    recall = matched / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+
+def edge_error(reference, predicted):
+    """Mean absolute error of the box edges [px] of the boxes matched with IoU>=0.5."""
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1, 4)
+    predicted = np.asarray(predicted, dtype=np.float64).reshape(-1, 4)
+    pairs = match_boxes(reference, predicted, 0.5)
+    if len(pairs) == 0:
+        return np.nan
+
+    i, j = np.array(pairs).T
+    return np.abs(reference[i] - predicted[j]).mean()
+
+
+def build(path_cfg, low_res, device, refine_samples=None):
+    cfg = OmegaConf.load(path_cfg) if path_cfg is not None else OmegaConf.create()
+    cfg.low_res = low_res
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_tmp = str(Path(tmp_dir) / "text_detector.yaml")
+        OmegaConf.save(cfg, path_tmp)
+        detector = TextDetector(path_cfg=path_tmp, device=device)
+
+    if refine_samples is not None:
+        detector.post_processor.refine_samples = refine_samples
+    return detector
+
+
+def measure(detector, img, repeat):
+    """Return the boxes and the median latency of the network and the postprocess."""
+    tensor = detector.preprocess(img)
+    times = {"network": [], "postprocess": []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        preds = detector.infer(tensor)
+        times["network"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        quads, _ = detector.postprocess(preds, img.shape[:2])
+        times["postprocess"].append(time.perf_counter() - start)
+
+    return quads_to_xyxy(quads), {k: np.median(v) for k, v in times.items()}
+
+
+def main(args):
+    warnings.filterwarnings("ignore")
+
+    imgs = [load_image(path) for path in list_images(args.images)]
+    detectors = {
+        "full": build(args.td_cfg, False, args.device),
+        "low_res": build(args.td_cfg, True, args.device),
+        "low_res (no refine)": build(args.td_cfg, True, args.device, 0),
+    }
+
+    report = {
+        name: {"network": [], "postprocess": [], "f1": [], "f1@0.8": [], "error": []}
+        for name in detectors
+    }
+
+    for img in imgs:
+        reference = None
+        for name, detector in detectors.items():
+            boxes, times = measure(detector, img, args.repeat)
+            if reference is None:
+                reference = boxes
+
+            report[name]["network"].append(times["network"])
+            report[name]["postprocess"].append(times["postprocess"])
+            report[name]["f1"].append(box_f1(reference, boxes, 0.5))
+            report[name]["f1@0.8"].append(box_f1(reference, boxes, 0.8))
+            report[name]["error"].append(edge_error(reference, boxes))
+
+    print(
+        f"{'mode':<22}{'network [ms]':>14}{'post [ms]':>12}"
+        f"{'F1@0.5':>9}{'F1@0.8':>9}{'edge [px]':>11}"
+    )
+    for name, values in report.items():
+        network = np.median(values["network"]) * 1000
+        post = np.median(values["postprocess"]) * 1000
+        print(
+            f"{name:<22}{network:>14.1f}{post:>12.1f}"
+            f"{np.mean(values['f1']):>9.3f}{np.mean(values['f1@0.8']):>9.3f}"
+            f"{np.nanmean(values['error']):>11.2f}"
+        )
+
+    print(
+        "F1: box F1 against the full resolution mode, "
+        "edge: mean absolute error of the matched box edges"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", type=str, help="image file or directory to evaluate")
+    parser.add_argument(
+        "--td_cfg",
+        type=str,
+        default=None,
+        help="path of text detector config file",
+    )
+    parser.add_argument("--device", type=str, default="cpu", help="device to run on")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="number of runs per image for latency"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,165 @@
+import argparse
+import time
+import warnings
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from yomitoku import (
+    LayoutParser,
+    TableStructureRecognizer,
+    TextDetector,
+    TextRecognizer,
+)
+from yomitoku.data.functions import load_image
+from yomitoku.utils.misc import calc_iou_matrix, quads_to_xyxy
+
+from benchmark_utils import list_images
+
+
+def box_f1(reference, predicted, thresh=0.5):
+    """F1 of the predicted boxes against the fp32 boxes matched greedily by IoU."""
+    if len(reference) == 0 and len(predicted) == 0:
+        return 1.0
+    if len(reference) == 0 or len(predicted) == 0:
+        return 0.0
+
+    iou = calc_iou_matrix(reference, predicted)
+    matched = 0
+    while True:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[i, j] < thresh:
+            break
+        matched += 1
+        iou[i, :] = 0
+        iou[:, j] = 0
+
+    precision = matched / len(predicted)
+    recall = matched / len(reference)
+    if matched == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def layout_boxes(results):
+    return [
+        element.box
+        for category in ["paragraphs", "tables", "figures"]
+        for element in getattr(results, category)
+    ]
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def build(cls, quantize, calibration_images=None, **kwargs):
+    if cls is TextDetector and quantize is not None:
+        kwargs["calibration_images"] = calibration_images
+    return cls(device="cpu", quantize=quantize, **kwargs)
+
+
+def run(imgs, calibration_images):
+    report = {}
+
+    detectors = [build(TextDetector, q, calibration_images) for q in [None, "int8"]]
+    recognizers = [build(TextRecognizer, q) for q in [None, "int8"]]
+    parsers = [build(LayoutParser, q) for q in [None, "int8"]]
+    tsrs = [build(TableStructureRecognizer, q) for q in [None, "int8"]]
+
+    for name in ["TextDetector", "TextRecognizer", "LayoutParser", "TSR"]:
+        report[name] = {"fp32": [], "int8": [], "score": []}
+
+    for img in imgs:
+        # 各モジュールの入力はfp32の前段の結果に揃え、モジュール単体の精度を比較する
+        (det, _), t = measure(detectors[0].predict, img)
+        report["TextDetector"]["fp32"].append(t)
+        (det_q, _), t = measure(detectors[1].predict, img)
+        report["TextDetector"]["int8"].append(t)
+        report["TextDetector"]["score"].append(
+            box_f1(quads_to_xyxy(det.points), quads_to_xyxy(det_q.points))
+        )
+
+        (rec, _), t = measure(recognizers[0].predict, img, det.points)
+        report["TextRecognizer"]["fp32"].append(t)
+        (rec_q, _), t = measure(recognizers[1].predict, img, det.points)
+        report["TextRecognizer"]["int8"].append(t)
+        if len(rec.contents) > 0:
+            report["TextRecognizer"]["score"].append(
+                np.mean(
+                    [
+                        SequenceMatcher(None, a, b).ratio()
+                        for a, b in zip(rec.contents, rec_q.contents)
+                    ]
+                )
+            )
+
+        (layout, _), t = measure(parsers[0].predict, img)
+        report["LayoutParser"]["fp32"].append(t)
+        (layout_q, _), t = measure(parsers[1].predict, img)
+        report["LayoutParser"]["int8"].append(t)
+        report["LayoutParser"]["score"].append(
+            box_f1(layout_boxes(layout), layout_boxes(layout_q))
+        )
+
+        table_boxes = [table.box for table in layout.tables]
+        if len(table_boxes) == 0:
+            continue
+
+        (tables, _), t = measure(tsrs[0].predict, img, table_boxes)
+        report["TSR"]["fp32"].append(t)
+        (tables_q, _), t = measure(tsrs[1].predict, img, table_boxes)
+        report["TSR"]["int8"].append(t)
+        for table, table_q in zip(tables, tables_q):
+            report["TSR"]["score"].append(
+                box_f1(
+                    [cell.box for cell in table.cells],
+                    [cell.box for cell in table_q.cells],
+                )
+            )
+
+    return report
+
+
+def main(args):
+    warnings.filterwarnings("ignore")
+
+    imgs = [load_image(path) for path in list_images(args.images)]
+    calibration_images = [load_image(path) for path in list_images(args.calibration)]
+
+    report = run(imgs, calibration_images)
+
+    print(
+        f"{'module':<16}{'fp32 [ms]':>12}{'int8 [ms]':>12}{'speedup':>10}"
+        f"{'agreement':>12}"
+    )
+    for name, values in report.items():
+        if len(values["fp32"]) == 0:
+            print(f"{name:<16}{'-':>12}{'-':>12}{'-':>10}{'-':>12}")
+            continue
+
+        fp32 = np.median(values["fp32"]) * 1000
+        int8 = np.median(values["int8"]) * 1000
+        score = np.mean(values["score"]) if len(values["score"]) > 0 else np.nan
+        print(f"{name:<16}{fp32:>12.1f}{int8:>12.1f}{fp32 / int8:>9.2f}x{score:>12.3f}")
+
+    print(
+        "agreement: box F1 (IoU>=0.5) for detection/layout/table cells, "
+        "mean character similarity for recognition, against fp32 outputs"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", type=str, help="image file or directory to evaluate")
+    parser.add_argument(
+        "--calibration",
+        type=str,
+        required=True,
+        help="image file or directory used to calibrate the text detector",
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,167 @@
+import argparse
+import time
+
+import numpy as np
+
+from yomitoku.table_structure_recognizer import (
+    extract_cells,
+    filter_contained_cells_within_spancell,
+)
+from yomitoku.utils.misc import calc_intersection, filter_by_flag, is_contained
+
+
+def extract_cells_loop(row_boxes, col_boxes):
+    cells = []
+    for i, row_box in enumerate(row_boxes):
+        for j, col_box in enumerate(col_boxes):
+            intersection = calc_intersection(row_box, col_box)
+            if intersection is None:
+                continue
+
+            cells.append(
+                {
+                    "col": j + 1,
+                    "row": i + 1,
+                    "col_span": 1,
+                    "row_span": 1,
+                    "box": intersection,
+                    "contents": None,
+                }
+            )
+
+    return cells
+
+
+def filter_contained_cells_within_spancell_loop(cells, span_boxes):
+    check_list = [True] * len(cells)
+    child_boxes = [[] for _ in range(len(span_boxes))]
+    for i, span_box in enumerate(span_boxes):
+        for j, sub_cell in enumerate(cells):
+            if is_contained(span_box, sub_cell["box"]):
+                check_list[j] = False
+                child_boxes[i].append(sub_cell)
+
+    cells = filter_by_flag(cells, check_list)
+
+    for i, span_box in enumerate(span_boxes):
+        child_box = child_boxes[i]
+
+        if len(child_box) == 0:
+            continue
+
+        row = min([box["row"] for box in child_box])
+        col = min([box["col"] for box in child_box])
+        row_span = max([box["row"] for box in child_box]) - row + 1
+        col_span = max([box["col"] for box in child_box]) - col + 1
+
+        cells.append(
+            {
+                "col": col,
+                "row": row,
+                "col_span": col_span,
+                "row_span": row_span,
+                "box": list(map(int, span_box)),
+                "contents": None,
+            }
+        )
+
+    cells = sorted(cells, key=lambda x: (x["row"], x["col"]))
+    return cells
+
+
+def make_grid(n_row, n_col, n_span, cell_w=60, cell_h=20, jitter=3, seed=0):
+    rng = np.random.default_rng(seed)
+    width = n_col * cell_w
+    height = n_row * cell_h
+
+    row_boxes = []
+    for i in range(n_row):
+        y1, y2 = i * cell_h, (i + 1) * cell_h
+        dx1, dy1, dx2, dy2 = rng.integers(-jitter, jitter + 1, size=4)
+        row_boxes.append([0 + dx1, y1 + dy1, width + dx2, y2 + dy2])
+
+    col_boxes = []
+    for j in range(n_col):
+        x1, x2 = j * cell_w, (j + 1) * cell_w
+        dx1, dy1, dx2, dy2 = rng.integers(-jitter, jitter + 1, size=4)
+        col_boxes.append([x1 + dx1, 0 + dy1, x2 + dx2, height + dy2])
+
+    span_boxes = []
+    for _ in range(n_span):
+        row = int(rng.integers(0, n_row - 1))
+        col = int(rng.integers(0, n_col - 1))
+        row_span = int(rng.integers(1, 3))
+        col_span = int(rng.integers(1, 3))
+        span_boxes.append(
+            [
+                col * cell_w,
+                row * cell_h,
+                (col + col_span) * cell_w,
+                (row + row_span) * cell_h,
+            ]
+        )
+
+    row_boxes = sorted(row_boxes, key=lambda x: x[1])
+    col_boxes = sorted(col_boxes, key=lambda x: x[0])
+    return row_boxes, col_boxes, span_boxes
+
+
+def measure(func, *args, repeat=5):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed.append(time.perf_counter() - start)
+    return result, min(elapsed)
+
+
+def run(row_boxes, col_boxes, span_boxes, repeat):
+    def vectorized():
+        cells = extract_cells(row_boxes, col_boxes)
+        return filter_contained_cells_within_spancell(cells, span_boxes)
+
+    def loop():
+        cells = extract_cells_loop(row_boxes, col_boxes)
+        return filter_contained_cells_within_spancell_loop(cells, span_boxes)
+
+    cells_vec, time_vec = measure(vectorized, repeat=repeat)
+    cells_loop, time_loop = measure(loop, repeat=repeat)
+    return cells_vec == cells_loop, time_vec, time_loop
+
+
+def main(args):
+    for n_row, n_col in args.grids:
+        row_boxes, col_boxes, span_boxes = make_grid(
+            n_row, n_col, args.n_span, seed=args.seed
+        )
+        identical, time_vec, time_loop = run(
+            row_boxes, col_boxes, span_boxes, args.repeat
+        )
+        print(
+            f"grid {n_row}x{n_col} span {args.n_span}: "
+            f"vectorized {time_vec * 1000:.2f} ms, "
+            f"loop {time_loop * 1000:.2f} ms, "
+            f"speedup x{time_loop / time_vec:.1f}, identical={identical}"
+        )
+
+
+def parse_grid(value):
+    n_row, n_col = value.lower().split("x")
+    return int(n_row), int(n_col)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--grids",
+        type=parse_grid,
+        nargs="+",
+        default=[(10, 5), (30, 10), (50, 30)],
+        help="grid sizes to benchmark (e.g. 50x30)",
+    )
+    parser.add_argument("--n_span", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
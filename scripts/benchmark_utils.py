@@ -0,0 +1,16 @@
+from pathlib import Path
+
+from yomitoku.constants import SUPPORT_INPUT_FORMAT
+
+
+def list_images(path):
+    """List the image files (excluding PDFs) under the path, or the path itself."""
+    path = Path(path)
+    if path.is_file():
+        return [path]
+
+    return sorted(
+        f
+        for f in path.rglob("*")
+        if f.suffix[1:].lower() in SUPPORT_INPUT_FORMAT and f.suffix != ".pdf"
+    )
@@ -1,16 +1,50 @@
+import io
+import os
 import time
 from pathlib import Path
 from typing import Union
 
+import numpy as np
 import torch
+from huggingface_hub import constants, hf_hub_download
 from omegaconf import OmegaConf
 from pydantic import BaseModel, Extra
 
+from .constants import CACHE_DIR, ONNX_CACHE_DIR, SUPPORT_PRECISION
 from .export import export_json
+from .utils.cache import (
+    DEFAULT_CACHE_SIZE,
+    FileCache,
+    atomic_write,
+    hash_file,
+    hash_image,
+    hash_state_dict,
+    hash_texts,
+)
+from .utils.compile import ShapeTracedModule, is_compile_supported
 from .utils.logger import set_logger
+from .utils.onnx_session import create_session
+from .utils.quantization import quantize_dynamic_linears, validate_quantize
 
 logger = set_logger(__name__, "INFO")
 
+# ステージキャッシュに保存するモデルの出力形式のバージョン。
+# 出力の名前や形式を変更した場合は更新し、古い形式のキャッシュを利用しないようにする
+STAGE_CACHE_VERSION = 2
+
+
+def weights_revision(repo_id):
+    """
+    学習済みの重みを特定する識別子。Hugging Face Hubのリポジトリの場合は
+    ダウンロードしたスナップショットのコミットハッシュ、ローカルのディレクトリの場合は
+    重みのファイルのハッシュ値を返す。
+    """
+    if os.path.isdir(repo_id):
+        return hash_file(os.path.join(repo_id, constants.SAFETENSORS_SINGLE_FILE))
+
+    path = hf_hub_download(repo_id, constants.SAFETENSORS_SINGLE_FILE)
+    return os.path.basename(os.path.dirname(path))
+
 
 def load_yaml_config(path_config: str):
     path_config = Path(path_config)
@@ -57,8 +91,78 @@ class BaseSchema(BaseModel):
         export_json(self, out_path, **kwargs)
 
 
+def _record_to_schema(value):
+    if isinstance(value, BaseRecord):
+        return value.to_schema()
+    if isinstance(value, list):
+        return [_record_to_schema(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def _record_to_dict(value):
+    if isinstance(value, BaseRecord):
+        return value.dict()
+    if isinstance(value, list):
+        return [_record_to_dict(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class BaseRecord:
+    """
+    Lightweight result passed between pipeline stages.
+    Records hold only `__slots__` and are never validated. They are converted to
+    the corresponding `BaseSchema` with `to_schema()` at the public boundary.
+    """
+
+    __slots__ = ()
+    schema = None
+
+    def __init__(self, **kwargs):
+        missing = [name for name in self.__slots__ if name not in kwargs]
+        if missing:
+            raise TypeError(f"{self.__class__.__name__} missing fields: {missing}")
+
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
+
+    def dict(self):
+        return {name: _record_to_dict(getattr(self, name)) for name in self.__slots__}
+
+    def to_schema(self):
+        if self.schema is None:
+            raise NotImplementedError
+
+        values = {
+            name: _record_to_schema(getattr(self, name)) for name in self.__slots__
+        }
+        return self.schema.model_construct(**values)
+
+    def model_dump(self, **kwargs):
+        return self.to_schema().model_dump(**kwargs)
+
+
 class BaseModule:
     model_catalog = None
+    # モデルの出力に影響しない(後処理、可視化の)設定項目
+    postprocess_config_keys = ("visualize",)
+    # 動的量子化の対象とする線形層を含むサブモジュール
+    quantize_modules = ()
+    quantize = None
+    precision = "fp32"
+    # 入力の形状によって制御フローが変わらず、TorchScriptでトレースできるか
+    traceable = True
+    compile_mode = None
+    stage_cache = None
+    # ONNXに変換する際のopsetのバージョン
+    onnx_opset = 14
 
     def __init__(self):
         if self.model_catalog is None:
@@ -74,17 +178,238 @@ class BaseModule:
 
     def __new__(cls, *args, **kwds):
         logger.info(f"Initialize {cls.__name__}")
-        cls.__call__ = observer(cls, cls.__call__)
+        # 内部のステージ間呼び出しも計測するため、predictを持つ場合はそちらを計測する
+        if hasattr(cls, "predict"):
+            cls.predict = observer(cls, cls.predict)
+        else:
+            cls.__call__ = observer(cls, cls.__call__)
         return super().__new__(cls)
 
-    def load_model(self, name, path_cfg, from_pretrained=True):
+    def load_model(
+        self,
+        name,
+        path_cfg,
+        from_pretrained=True,
+        quantize=None,
+        calibration_data=None,
+    ):
         default_cfg, Net = self.model_catalog.get(name)
         self._cfg = load_config(default_cfg, path_cfg)
+        self.quantize = validate_quantize(quantize)
+
+        # 量子化済みの重みがキャッシュされている場合は、学習済みの重みを読み込まない
+        # 学習済みの重みの版やキャリブレーション画像が異なると量子化の結果も変わるため、
+        # キーに含める
+        cache, key = None, None
+        if self.quantize is not None and from_pretrained:
+            path_cache = os.path.join(CACHE_DIR, "quantized")
+            cache = FileCache(path_cache, max_size=DEFAULT_CACHE_SIZE, suffix=".pt")
+            key = hash_texts(
+                self.__class__.__name__,
+                self.quantize,
+                torch.__version__,
+                OmegaConf.to_yaml(self._cfg),
+                weights_revision(self._cfg.hf_hub_repo),
+                *[hash_image(img) for img in calibration_data or []],
+            )
+
+            data = cache.load(key)
+            if data is not None:
+                self.model = Net(cfg=self._cfg)
+                self.model.eval()
+                self.quantize_model([], calibrate=False)
+                self.model.load_state_dict(torch.load(io.BytesIO(data)))
+                logger.info(f"Load quantized weights: {cache.path(key)}")
+                return
+
         if from_pretrained:
             self.model = Net.from_pretrained(self._cfg.hf_hub_repo, cfg=self._cfg)
         else:
             self.model = Net(cfg=self._cfg)
 
+        if self.quantize is not None:
+            self.model.eval()
+            self.quantize_model(calibration_data or [])
+
+            if cache is not None:
+                buffer = io.BytesIO()
+                torch.save(self.model.state_dict(), buffer)
+                cache.save(key, buffer.getvalue())
+
+    def quantize_model(self, calibration_data, calibrate=True):
+        """
+        Quantize the model to INT8 for CPU inference.
+        By default the linear layers of `quantize_modules` are dynamically quantized.
+        When `calibrate` is False, only the quantized structure is built so that
+        cached quantized weights can be loaded.
+        """
+        quantize_dynamic_linears(self.model, self.quantize_modules)
+
+    def forward(self, tensor):
+        """Apply the network to the preprocessed tensor and return a dict of tensors."""
+        raise NotImplementedError
+
+    def set_precision(self, precision):
+        """
+        推論時の精度を設定する。fp32以外の場合はautocastで演算を低精度で実行し、
+        モデルの出力は後処理のためにfp32に戻す。
+        """
+        if precision not in SUPPORT_PRECISION:
+            raise ValueError(
+                f"Invalid precision: {precision}. "
+                f"Supported values are {SUPPORT_PRECISION}"
+            )
+
+        if precision != "fp32":
+            if self.quantize is not None:
+                raise ValueError("precision must be fp32 for quantized models.")
+
+            if getattr(self, "infer_onnx", False):
+                logger.warning("precision is ignored in ONNX inference.")
+                precision = "fp32"
+            elif precision == "fp16" and self.device.type == "cpu":
+                logger.warning("fp16 is not supported on CPU. Use fp32 instead.")
+                precision = "fp32"
+
+        self.precision = precision
+
+    def run_forward(self, tensor):
+        if self.precision == "fp32":
+            return self.forward(tensor)
+
+        dtype = torch.float16 if self.precision == "fp16" else torch.bfloat16
+        with torch.autocast(device_type=self.device.type, dtype=dtype):
+            preds = self.forward(tensor)
+
+        return {name: pred.float() for name, pred in preds.items()}
+
+    def compile_model(self):
+        """
+        Compile the model with torch.compile. If it is not available, the model is
+        traced with TorchScript per input shape instead.
+        """
+        if getattr(self, "infer_onnx", False):
+            logger.warning("compile is ignored in ONNX inference.")
+            return
+
+        if is_compile_supported():
+            self.model.compile()
+            self.compile_mode = "torch.compile"
+        elif self.traceable:
+            self.model = ShapeTracedModule(self.model)
+            self.compile_mode = "torchscript"
+        else:
+            logger.warning(f"{self.__class__.__name__} runs in eager mode.")
+            return
+
+        logger.info(f"{self.__class__.__name__} compile mode: {self.compile_mode}")
+
+    def onnx_input_shape(self):
+        """Shape of the dummy input used to export the model to ONNX."""
+        return (1, 3, *self._cfg.data.img_size)
+
+    def onnx_path(self):
+        """
+        Path of the exported ONNX model in the ONNX cache directory.
+        The file name contains a hash of the weights, the config, the opset and the
+        input shape, so that stale exports are never reused.
+        """
+        cfg = OmegaConf.to_container(self._cfg)
+        for key in (*self.postprocess_config_keys, "onnx_runtime"):
+            cfg.pop(key, None)
+
+        key = hash_texts(
+            self.__class__.__name__,
+            hash_state_dict(self.model.state_dict()),
+            OmegaConf.to_yaml(cfg),
+            self.onnx_opset,
+            self.onnx_input_shape(),
+            torch.__version__,
+        )
+
+        cache_dir = self._cfg.onnx_runtime.cache_dir or ONNX_CACHE_DIR
+        name = self._cfg.hf_hub_repo.split("/")[-1]
+        return os.path.join(cache_dir, f"{name}-{key[:16]}.onnx")
+
+    def load_onnx(self):
+        """Export the model to ONNX on the first run and create the session."""
+        path_onnx = self.onnx_path()
+        if not os.path.exists(path_onnx):
+            logger.info(f"Export ONNX model: {path_onnx}")
+            # 複数のプロセスが同時に変換しても、変換途中のファイルを読み込まない
+            with atomic_write(path_onnx, suffix=".onnx") as tmp_path:
+                self.convert_onnx(tmp_path)
+
+        self.sess = self.create_onnx_session(path_onnx)
+
+    def create_onnx_session(self, path_onnx):
+        """Create an ONNX Runtime session with the `onnx_runtime` config."""
+        return create_session(
+            path_onnx,
+            self.device,
+            self._cfg.onnx_runtime,
+            name=self.__class__.__name__,
+        )
+
+    def warmup_shapes(self):
+        """Return the input shapes to compile the model for at startup."""
+        return []
+
+    def warmup(self, shapes=None):
+        """
+        Run the model on dummy inputs of each shape bucket so that compilation is
+        done at startup rather than on the first request.
+        """
+        if shapes is None:
+            shapes = self.warmup_shapes()
+
+        for shape in shapes:
+            start = time.time()
+            self.run_forward(torch.zeros(shape))
+            elapsed = time.time() - start
+            logger.info(f"{self.__class__.__name__} warmup {shape}: {elapsed:.2f} sec")
+
+    def infer(self, tensor):
+        """
+        ネットワークを適用する。ステージキャッシュが有効な場合は、入力テンソルとモデルが
+        同一であればキャッシュしたモデルの出力を返却し、後処理のみを再実行できるようにする。
+        """
+        if self.stage_cache is None:
+            return self.run_forward(tensor)
+
+        key = hash_texts(self.model_hash, hash_image(tensor.numpy()))
+        data = self.stage_cache.load(key)
+        if data is not None:
+            with np.load(io.BytesIO(data)) as arrays:
+                return {
+                    name: torch.from_numpy(arrays[name]).to(self.device)
+                    for name in arrays.files
+                }
+
+        preds = self.run_forward(tensor)
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **{name: pred.cpu().numpy() for name, pred in preds.items()})
+        self.stage_cache.save(key, buffer.getvalue())
+        return preds
+
+    def enable_stage_cache(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        """Cache raw model outputs so that only postprocessing is re-run."""
+        self.stage_cache = FileCache(cache_dir, max_size=max_size, suffix=".npz")
+
+        cfg = OmegaConf.to_container(self._cfg)
+        for key in self.postprocess_config_keys:
+            cfg.pop(key, None)
+
+        self.model_hash = hash_texts(
+            STAGE_CACHE_VERSION,
+            self.__class__.__name__,
+            getattr(self, "infer_onnx", False),
+            self.quantize,
+            OmegaConf.to_yaml(cfg),
+            hash_state_dict(self.model.state_dict()),
+        )
+
     def save_config(self, path_cfg):
         OmegaConf.save(self._cfg, path_cfg)
 
@@ -105,6 +430,10 @@ class BaseModule:
 
     @device.setter
     def device(self, device):
+        if self.quantize is not None and "cuda" in device:
+            logger.warning("Quantized model only supports CPU. Use CPU instead.")
+            device = "cpu"
+
         if "cuda" in device:
             if torch.cuda.is_available():
                 self._device = torch.device(device)
@@ -0,0 +1,100 @@
+import argparse
+
+from ..layout_parser import LayoutParser
+from ..table_structure_recognizer import TableStructureRecognizer
+from ..text_detector import TextDetector
+from ..text_recognizer import TextRecognizer
+from ..utils.logger import set_logger
+
+logger = set_logger(__name__, "INFO")
+
+MODULES = {
+    "text_detector": TextDetector,
+    "text_recognizer": TextRecognizer,
+    "layout_parser": LayoutParser,
+    "table_structure_recognizer": TableStructureRecognizer,
+}
+
+
+def export(name, path_cfg=None, cache_dir=None, lite=False):
+    """
+    Export the model of the module to the ONNX cache directory and check that a
+    session can be created from it.
+    """
+    kwargs = {"path_cfg": path_cfg, "device": "cpu"}
+    if name == "text_recognizer" and lite:
+        kwargs["model_name"] = "parseq-small"
+
+    module = MODULES[name](**kwargs)
+    if cache_dir is not None:
+        module._cfg.onnx_runtime.cache_dir = cache_dir
+
+    module.load_onnx()
+    module.infer_onnx = True
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="export the models to ONNX ahead of time (e.g. at image build)"
+    )
+    parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=list(MODULES),
+        choices=list(MODULES),
+        help="modules to export",
+    )
+    parser.add_argument(
+        "-l",
+        "--lite",
+        action="store_true",
+        help="if set, export the lite text recognizer",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="ONNX cache directory (default: $YOMITOKU_ONNX_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--td_cfg",
+        type=str,
+        default=None,
+        help="path of text detector config file",
+    )
+    parser.add_argument(
+        "--tr_cfg",
+        type=str,
+        default=None,
+        help="path of text recognizer config file",
+    )
+    parser.add_argument(
+        "--lp_cfg",
+        type=str,
+        default=None,
+        help="path of layout parser config file",
+    )
+    parser.add_argument(
+        "--tsr_cfg",
+        type=str,
+        default=None,
+        help="path of table structure recognizer config file",
+    )
+    args = parser.parse_args()
+
+    path_cfgs = {
+        "text_detector": args.td_cfg,
+        "text_recognizer": args.tr_cfg,
+        "layout_parser": args.lp_cfg,
+        "table_structure_recognizer": args.tsr_cfg,
+    }
+
+    for name in args.modules:
+        logger.info(f"Export {name}")
+        export(name, path_cfgs[name], cache_dir=args.cache_dir, lite=args.lite)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,11 @@ from pathlib import Path
 import cv2
 import time
 
-from ..constants import SUPPORT_OUTPUT_FORMAT
+from ..constants import SUPPORT_OCR_REGIONS, SUPPORT_OUTPUT_FORMAT
 from ..data.functions import load_image, load_pdf
 from ..document_analyzer import DocumentAnalyzer
 from ..utils.logger import set_logger
+from ..utils.onnx_session import set_thread_budget
 
 logger = set_logger(__name__, "INFO")
 
@@ -77,6 +78,20 @@ def process_single_file(args, analyzer, path, format):
         logger.info(f"Output file: {out_path}")
 
 
+def get_tasks(args, format):
+    """出力形式とオプションから、解析に必要な最小限のタスクを決定する"""
+    if format == "json":
+        return None
+
+    tasks = {"paragraphs", "tables"}
+    if format in ["html", "md"] and args.figure:
+        tasks.add("figures")
+        if args.figure_letter:
+            tasks.add("figure_letters")
+
+    return tasks
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -168,6 +183,38 @@ def main():
         default="figures",
         help="directory to save figure images",
     )
+    parser.add_argument(
+        "--ocr_regions",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=SUPPORT_OCR_REGIONS,
+        help="if set, recognize only text within the specified layout regions",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="if set, cache the analysis results in the directory",
+    )
+    parser.add_argument(
+        "--stage_cache_dir",
+        type=str,
+        default=None,
+        help="if set, cache the raw model outputs in the directory",
+    )
+    parser.add_argument(
+        "--template",
+        type=str,
+        default=None,
+        help="path of reference image of a fixed-layout form used as layout template",
+    )
+    parser.add_argument(
+        "--onnx_threads",
+        type=int,
+        default=None,
+        help="total number of threads divided between the ONNX Runtime sessions",
+    )
 
     args = parser.parse_args()
 
@@ -203,12 +250,17 @@ def main():
         },
     }
 
+    if args.onnx_threads is not None:
+        # --liteではOCRのみONNX推論を行うため、レイアウト解析には割り当てない
+        shares = {"ocr": 1} if args.lite else None
+        set_thread_budget(args.onnx_threads, shares=shares)
+
     if args.lite:
         configs["ocr"]["text_recognizer"]["model_name"] = "parseq-small"
         configs["ocr"]["text_detector"]["infer_onnx"] = True
+        configs["ocr"]["text_recognizer"]["infer_onnx"] = True
 
-        # Note: Text Detector以外はONNX推論よりもPyTorch推論の方が速いため、ONNX推論は行わない
-        # configs["ocr"]["text_recognizer"]["infer_onnx"] = True
+        # Note: レイアウト解析はPyTorch推論の方が速いため、ONNX推論は行わない
         # configs["layout_analyzer"]["table_structure_recognizer"]["infer_onnx"] = True
         # configs["layout_analyzer"]["layout_parser"]["infer_onnx"] = True
 
@@ -216,8 +268,16 @@ def main():
         configs=configs,
         visualize=args.vis,
         device=args.device,
+        tasks=get_tasks(args, format),
+        ocr_regions=args.ocr_regions,
+        cache_dir=args.cache_dir,
+        stage_cache_dir=args.stage_cache_dir,
     )
 
+    if args.template is not None:
+        logger.info(f"Register layout template: {args.template}")
+        analyzer.register_template(load_image(args.template))
+
     os.makedirs(args.outdir, exist_ok=True)
     logger.info(f"Output directory: {args.outdir}")
 
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 
 
 @dataclass
@@ -7,6 +7,16 @@ class Data:
     img_size: List[int] = field(default_factory=lambda: [640, 640])
 
 
+@dataclass
+class Tiling:
+    mode: str = "resize"
+    tiles_per_short_side: int = 1
+    overlap: float = 0.2
+    batch_size: int = 4
+    merge: str = "wbf"
+    merge_iou: float = 0.55
+
+
 @dataclass
 class BackBone:
     depth: int = 50
@@ -60,11 +70,26 @@ class Decoder:
     query_select_method: str = "default"
 
 
+@dataclass
+class OnnxRuntime:
+    intra_op_num_threads: int = 0
+    inter_op_num_threads: int = 0
+    graph_optimization_level: str = "all"
+    enable_cpu_mem_arena: bool = True
+    enable_mem_pattern: bool = True
+    use_optimized_model: bool = False
+    cache_dir: Optional[str] = None
+    providers: List[str] = field(default_factory=list)
+
+
 @dataclass
 class LayoutParserRTDETRv2Config:
     hf_hub_repo: str = "KotaroKinoshita/yomitoku-layout-parser-rtdtrv2-open-beta"
+    precision: str = "fp32"
+    compile: bool = False
     thresh_score: float = 0.5
     data: Data = field(default_factory=Data)
+    tiling: Tiling = field(default_factory=Tiling)
     PResNet: BackBone = field(default_factory=BackBone)
     HybridEncoder: Encoder = field(default_factory=Encoder)
     RTDETRTransformerv2: Decoder = field(default_factory=Decoder)
@@ -87,3 +112,5 @@ class LayoutParserRTDETRv2Config:
             "page_footer",
         ]
     )
+
+    onnx_runtime: OnnxRuntime = field(default_factory=OnnxRuntime)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 
 
 @dataclass
@@ -60,11 +60,25 @@ class Decoder:
     query_select_method: str = "default"
 
 
+@dataclass
+class OnnxRuntime:
+    intra_op_num_threads: int = 0
+    inter_op_num_threads: int = 0
+    graph_optimization_level: str = "all"
+    enable_cpu_mem_arena: bool = True
+    enable_mem_pattern: bool = True
+    use_optimized_model: bool = False
+    cache_dir: Optional[str] = None
+    providers: List[str] = field(default_factory=list)
+
+
 @dataclass
 class TableStructureRecognizerRTDETRv2Config:
     hf_hub_repo: str = (
         "KotaroKinoshita/yomitoku-table-structure-recognizer-rtdtrv2-open-beta"
     )
+    precision: str = "fp32"
+    compile: bool = False
     thresh_score: float = 0.4
     data: Data = field(default_factory=Data)
     PResNet: BackBone = field(default_factory=BackBone)
@@ -78,3 +92,5 @@ class TableStructureRecognizerRTDETRv2Config:
             "span",
         ]
     )
+
+    onnx_runtime: OnnxRuntime = field(default_factory=OnnxRuntime)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 
 
 @dataclass
@@ -22,6 +22,19 @@ class Decoder:
 class Data:
     shortest_size: int = 1280
     limit_size: int = 1600
+    adaptive_resize: bool = False
+    target_text_height: int = 16
+    min_shortest_size: int = 640
+    max_shortest_size: int = 1920
+
+
+@dataclass
+class Tiling:
+    enabled: bool = False
+    tile_size: int = 1280
+    overlap: int = 160
+    batch_size: int = 4
+    max_length: int = 8000
 
 
 @dataclass
@@ -39,11 +52,29 @@ class Visualize:
     heatmap: bool = False
 
 
+@dataclass
+class OnnxRuntime:
+    intra_op_num_threads: int = 0
+    inter_op_num_threads: int = 0
+    graph_optimization_level: str = "all"
+    enable_cpu_mem_arena: bool = True
+    enable_mem_pattern: bool = True
+    use_optimized_model: bool = False
+    cache_dir: Optional[str] = None
+    providers: List[str] = field(default_factory=list)
+
+
 @dataclass
 class TextDetectorDBNetConfig:
     hf_hub_repo: str = "KotaroKinoshita/yomitoku-text-detector-dbnet-open-beta"
+    precision: str = "fp32"
+    compile: bool = False
+    deploy: bool = True
+    low_res: bool = False
     backbone: BackBone = field(default_factory=BackBone)
     decoder: Decoder = field(default_factory=Decoder)
     data: Data = field(default_factory=Data)
+    tiling: Tiling = field(default_factory=Tiling)
     post_process: PostProcess = field(default_factory=PostProcess)
     visualize: Visualize = field(default_factory=Visualize)
+    onnx_runtime: OnnxRuntime = field(default_factory=OnnxRuntime)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 
 from ..constants import ROOT_DIR
 
@@ -28,6 +28,18 @@ class Decoder:
     depth: int = 1
 
 
+@dataclass
+class OnnxRuntime:
+    intra_op_num_threads: int = 0
+    inter_op_num_threads: int = 0
+    graph_optimization_level: str = "all"
+    enable_cpu_mem_arena: bool = True
+    enable_mem_pattern: bool = True
+    use_optimized_model: bool = False
+    cache_dir: Optional[str] = None
+    providers: List[str] = field(default_factory=list)
+
+
 @dataclass
 class Visualize:
     font: str = str(ROOT_DIR + "/resource/MPLUS1p-Medium.ttf")
@@ -38,6 +50,8 @@ class Visualize:
 @dataclass
 class TextRecognizerPARSeqSmallConfig:
     hf_hub_repo: str = "KotaroKinoshita/yomitoku-text-recognizer-parseq-small-open-beta"
+    precision: str = "fp32"
+    compile: bool = False
     charset: str = str(ROOT_DIR + "/resource/charset.txt")
     num_tokens: int = 7312
     max_label_length: int = 100
@@ -47,5 +61,6 @@ class TextRecognizerPARSeqSmallConfig:
     data: Data = field(default_factory=Data)
     encoder: Encoder = field(default_factory=Encoder)
     decoder: Decoder = field(default_factory=Decoder)
+    onnx_runtime: OnnxRuntime = field(default_factory=OnnxRuntime)
 
     visualize: Visualize = field(default_factory=Visualize)
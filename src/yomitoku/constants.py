@@ -1,10 +1,28 @@
 import os
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get(
+    "YOMITOKU_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "yomitoku")
+)
+ONNX_CACHE_DIR = os.environ.get(
+    "YOMITOKU_ONNX_CACHE_DIR", os.path.join(CACHE_DIR, "onnx")
+)
 SUPPORT_OUTPUT_FORMAT = ["json", "csv", "html", "markdown", "md"]
 SUPPORT_INPUT_FORMAT = ["jpg", "jpeg", "png", "bmp", "tiff", "tif", "pdf"]
 MIN_IMAGE_SIZE = 32
 WARNING_IMAGE_SIZE = 720
+DIRECTIONS = ["horizontal", "vertical"]
+SUPPORT_TASKS = ["words", "paragraphs", "tables", "figures", "figure_letters"]
+SUPPORT_QUANTIZE = ["int8"]
+SUPPORT_PRECISION = ["fp32", "fp16", "bf16"]
+SUPPORT_OCR_REGIONS = [
+    "paragraphs",
+    "section_headings",
+    "page_header",
+    "page_footer",
+    "tables",
+    "figures",
+]
 
 PALETTE = [
     [255, 0, 0],
@@ -1,3 +1,4 @@
 from .functions import load_image, load_pdf
+from .page import Page
 
-__all__ = ["load_image", "load_pdf"]
+__all__ = ["load_image", "load_pdf", "Page"]
@@ -11,7 +11,6 @@ from .functions import (
 
 class ParseqDataset(Dataset):
     def __init__(self, cfg, img, quads):
-        self.img = img[:, :, ::-1]
         self.quads = quads
         self.cfg = cfg
         self.img = img
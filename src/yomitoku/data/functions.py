@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Union
 
 import cv2
 import numpy as np
@@ -119,6 +120,22 @@ def resize_shortest_edge(
     """
 
     h, w = img.shape[:2]
+    newh, neww = calc_resized_shortest_edge_size(h, w, shortest_edge_length, max_length)
+
+    img = cv2.resize(img, (neww, newh))
+    return img
+
+
+def calc_resized_shortest_edge_size(
+    h: int, w: int, shortest_edge_length: int, max_length: int
+):
+    """
+    Calculate the image size after `resize_shortest_edge()`.
+    Both edges are rounded down to multiples of 32.
+
+    Returns:
+        Tuple[int, int]: (height, width) after resizing
+    """
     scale = shortest_edge_length / min(h, w)
     if h < w:
         new_h, new_w = shortest_edge_length, int(w * scale)
@@ -131,9 +148,111 @@ def resize_shortest_edge(
 
     neww = max(int(new_w / 32) * 32, 32)
     newh = max(int(new_h / 32) * 32, 32)
+    return newh, neww
 
-    img = cv2.resize(img, (neww, newh))
-    return img
+
+def estimate_text_height(
+    img: np.ndarray, max_length: int = 1024, min_components: int = 10
+) -> Union[float, None]:
+    """
+    Estimate the height of the text in the image from its connected components.
+    Dark strokes are binarized with Otsu's method and closed so that the parts of a
+    character (and neighboring characters) are merged. For a near-square component
+    (a single character) the longer side approximates the text size, and for an
+    elongated component (a word or line, horizontal or vertical) the shorter side.
+
+    Args:
+        img (np.ndarray): target image(BGR)
+        max_length (int): maximum edge length of the image to analyze
+        min_components (int): minimum number of text-like components to make an estimate
+
+    Returns:
+        float: median text height in pixels of the input image, or None if too few
+            text-like components are found
+    """
+    h, w = img.shape[:2]
+    scale = min(1.0, max_length / max(h, w))
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+
+    stats = stats[1:]
+    widths = stats[:, cv2.CC_STAT_WIDTH]
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    fill = stats[:, cv2.CC_STAT_AREA] / np.maximum(widths * heights, 1)
+    # 連結した行や単語は短辺、個々の文字は長辺を文字の大きさとみなす
+    short = np.minimum(widths, heights)
+    long = np.maximum(widths, heights)
+    sizes = np.where(long < 2 * short, long, short)
+
+    # 罫線、図、ノイズを除外する
+    keep = (
+        (sizes >= 4) & (sizes < min(gray.shape[:2]) / 8) & (fill > 0.1) & (fill < 0.9)
+    )
+    if keep.sum() < min_components:
+        return None
+
+    return float(np.median(sizes[keep])) / scale
+
+
+def calc_adaptive_shortest_edge_size(
+    h: int,
+    w: int,
+    text_height: float,
+    shortest_edge_length: int,
+    max_length: int,
+    target_text_height: float,
+    min_shortest_edge_length: int,
+    max_shortest_edge_length: int,
+    step: int = 128,
+):
+    """
+    Choose the shortest edge length and the maximum edge length of
+    `resize_shortest_edge()` so that the text is resized to `target_text_height`
+    pixels. The limit of the longest edge is scaled by the same ratio. The shortest
+    edge length is rounded to multiples of `step` to keep the number of input
+    shapes small.
+
+    Returns:
+        Tuple[int, int]: (shortest edge length, maximum edge length)
+    """
+    new_h, _ = calc_resized_shortest_edge_size(h, w, shortest_edge_length, max_length)
+    ratio = target_text_height / (text_height * new_h / h)
+
+    length = shortest_edge_length * ratio
+    length = int(round(length / step) * step)
+    length = int(np.clip(length, min_shortest_edge_length, max_shortest_edge_length))
+    return length, int(max_length * length / shortest_edge_length)
+
+
+def calc_tiles(h: int, w: int, tile_size: int, overlap: int):
+    """
+    Split the image into overlapping tiles of `tile_size` pixels. The tiles of each
+    row and column are evenly spaced from edge to edge so that adjacent tiles
+    overlap by at least `overlap` pixels. Tiles are cropped to the image if it is
+    smaller than `tile_size`.
+
+    Returns:
+        List[Tuple[int, int, int, int]]: (x0, y0, x1, y1) of the tiles
+    """
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+
+        n = int(np.ceil((length - overlap) / (tile_size - overlap)))
+        return np.linspace(0, length - tile_size, n).round().astype(int).tolist()
+
+    return [
+        (x, y, min(x + tile_size, w), min(y + tile_size, h))
+        for y in starts(h)
+        for x in starts(w)
+    ]
 
 
 def standardization_image(
@@ -156,6 +275,60 @@ def standardization_image(
     return img
 
 
+def resize_to_tensor(
+    img: np.ndarray,
+    size,
+    out: torch.Tensor = None,
+    mean=None,
+    std=None,
+    rgb: bool = True,
+    interpolation: int = None,
+) -> torch.Tensor:
+    """
+    Resize the image once with OpenCV and write it into `out` as a tensor scaled
+    to [0, 1] (and standardized by `mean` and `std` if given), in place of
+    `T.Resize(size)` and `T.ToTensor()` on a PIL image. By default the image is
+    shrunk with area interpolation, which approximates the antialiasing of PIL.
+
+    Args:
+        img (np.ndarray): target image(BGR, uint8)
+        size (list): (height, width) after resizing
+        out (torch.Tensor, optional): (3, height, width) float tensor on CPU to write
+            into. It may be a view of a larger tensor.
+        mean (tuple, optional): mean of each channel of the output
+        std (tuple, optional): standard deviation of each channel of the output
+        rgb (bool): if False, keep the BGR order of the channels
+        interpolation (int, optional): interpolation flag of `cv2.resize()`
+
+    Returns:
+        torch.Tensor: (3, height, width) tensor
+    """
+    h, w = size
+    if interpolation is None:
+        interpolation = cv2.INTER_LINEAR
+        if h * w < img.shape[0] * img.shape[1]:
+            interpolation = cv2.INTER_AREA
+
+    resized = cv2.resize(img, (w, h), interpolation=interpolation)
+    if out is None:
+        out = torch.empty((3, h, w), dtype=torch.float32)
+
+    resized = resized.transpose(2, 0, 1)
+    if rgb:
+        resized = resized[::-1]
+
+    mean = np.zeros(3) if mean is None else np.asarray(mean, dtype=np.float64)
+    std = np.ones(3) if std is None else np.asarray(std, dtype=np.float64)
+    scale = (1 / (255 * std)).astype(np.float32)[:, None, None]
+
+    # チャンネルの並べ替えと正規化の結果を出力先に直接書き込む
+    array = out.numpy()
+    np.multiply(resized, scale, out=array)
+    if np.any(mean != 0):
+        np.subtract(array, (mean / std).astype(np.float32)[:, None, None], out=array)
+    return out
+
+
 def array_to_tensor(img: np.ndarray) -> torch.Tensor:
     """
     Convert the image data to tensor.
@@ -0,0 +1,53 @@
+import threading
+
+import numpy as np
+
+from ..utils.cache import hash_image
+
+
+class Page:
+    """
+    1ページの画像(BGR)と、その変換結果を保持して各モジュールで共有する。
+    DocumentAnalyzerは入力画像をPageに変換して各モジュールに渡し、
+    同じページに対する同じ前処理が二度計算されないようにする。
+
+    変換結果は前処理の内容を表すキーごとに保持する。OCRとレイアウト解析は
+    別スレッドで同じPageを参照するため、保持する辞書の操作はロックで保護する。
+    """
+
+    def __init__(self, img: np.ndarray):
+        self.img = img
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.img.shape
+
+    def memoize(self, key, func):
+        """
+        `key`に対応する変換結果を返す。未計算の場合は`func()`で計算して保持する。
+        計算中はロックを解放するため、他のスレッドの前処理を妨げない。
+        """
+        with self._lock:
+            if key in self._memo:
+                return self._memo[key]
+
+        value = func()
+        with self._lock:
+            return self._memo.setdefault(key, value)
+
+    def crop(self, box) -> np.ndarray:
+        """xyxyの矩形のビュー"""
+        x1, y1, x2, y2 = map(int, box)
+        return self.img[y1:y2, x1:x2]
+
+    def hash(self) -> str:
+        return self.memoize("hash", lambda: hash_image(self.img))
+
+
+def as_page(img) -> Page:
+    """画像(BGR)をPageに変換する。Pageの場合はそのまま返す。"""
+    if isinstance(img, Page):
+        return img
+    return Page(img)
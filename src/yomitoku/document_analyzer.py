@@ -2,18 +2,29 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 
+import numpy as np
+from omegaconf import OmegaConf
 from pydantic import conlist
 
-from .base import BaseSchema
+from .base import BaseRecord, BaseSchema
+from .constants import DIRECTIONS, SUPPORT_OCR_REGIONS, SUPPORT_TASKS
+from .data.page import as_page
 from .export import export_csv, export_html, export_markdown
 from .layout_analyzer import LayoutAnalyzer
-from .ocr import OCR, WordPrediction
+from .layout_parser import ElementRecord
+from .layout_template import LayoutTemplate, template_visualizer
+from .ocr import OCR, OCRResultArrays, WordPrediction
 from .table_structure_recognizer import TableStructureRecognizerSchema
-from .utils.misc import is_contained, quad_to_xyxy
+from .text_detector import TextDetectorRecord
+from .utils.cache import DEFAULT_CACHE_SIZE, FileCache, hash_state_dict, hash_texts
+from .utils.misc import is_contained, is_contained_matrix, quads_to_xyxy
 from .reading_order import prediction_reading_order
 
 from .utils.visualizer import reading_order_visualizer
 
+# テンプレートの文字領域の外接矩形に加える余白(ページの長辺に対する比率)
+TEMPLATE_REGION_MARGIN = 0.01
+
 
 class ParagraphSchema(BaseSchema):
     box: conlist(int, min_length=4, max_length=4)
@@ -47,8 +58,27 @@ class DocumentAnalyzerSchema(BaseSchema):
         export_csv(self, out_path, **kwargs)
 
 
-def combine_flags(flag1, flag2):
-    return [f1 or f2 for f1, f2 in zip(flag1, flag2)]
+class ParagraphRecord(BaseRecord):
+    __slots__ = ("box", "contents", "direction", "order", "role")
+    schema = ParagraphSchema
+
+
+class FigureRecord(BaseRecord):
+    __slots__ = ("box", "order", "paragraphs", "direction")
+    schema = FigureSchema
+
+
+class DocumentAnalyzerRecord(BaseRecord):
+    __slots__ = ("paragraphs", "tables", "words", "figures")
+    schema = DocumentAnalyzerSchema
+
+    def to_schema(self):
+        return self.schema.model_construct(
+            paragraphs=[paragraph.to_schema() for paragraph in self.paragraphs],
+            tables=[table.to_schema() for table in self.tables],
+            words=self.words.to_words(),
+            figures=[figure.to_schema() for figure in self.figures],
+        )
 
 
 def judge_page_direction(paragraphs):
@@ -87,49 +117,34 @@ def extract_paragraph_within_figure(paragraphs, figures):
             contained_paragraphs, figure["direction"]
         )
         figure["paragraphs"] = sorted(figure_paragraphs, key=lambda x: x.order)
-        figure = FigureSchema(**figure)
+        figure = FigureRecord(**figure)
         new_figures.append(figure)
 
     return new_figures, check_list
 
 
-def extract_words_within_element(pred_words, element):
-    contained_words = []
-    word_sum_width = 0
-    word_sum_height = 0
-    check_list = [False] * len(pred_words)
-    for i, word in enumerate(pred_words):
-        word_box = quad_to_xyxy(word.points)
-        if is_contained(element.box, word_box, threshold=0.5):
-            contained_words.append(word)
-            word_sum_width += word_box[2] - word_box[0]
-            word_sum_height += word_box[3] - word_box[1]
-            check_list[i] = True
-
-    if len(contained_words) == 0:
-        return None, None, check_list
+def extract_words_within_element(pred_words, element, word_boxes=None):
+    if word_boxes is None:
+        word_boxes = pred_words.boxes()
 
-    # mean_width = word_sum_width / len(contained_words)
-    # mean_height = word_sum_height / len(contained_words)
+    check_list = is_contained_matrix([element.box], word_boxes, threshold=0.5)[0]
+    indices = np.flatnonzero(check_list)
+
+    if len(indices) == 0:
+        return None, None, check_list
 
-    word_direction = [word.direction for word in contained_words]
+    word_direction = [DIRECTIONS[d] for d in pred_words.directions[indices]]
     cnt_horizontal = word_direction.count("horizontal")
     cnt_vertical = word_direction.count("vertical")
 
     element_direction = "horizontal" if cnt_horizontal > cnt_vertical else "vertical"
+    points = pred_words.points[indices]
     if element_direction == "horizontal":
-        contained_words = sorted(
-            contained_words,
-            key=lambda x: (sum([p[1] for p in x.points]) / 4),
-        )
+        order = np.argsort(points[:, :, 1].sum(axis=1) / 4, kind="stable")
     else:
-        contained_words = sorted(
-            contained_words,
-            key=lambda x: (sum([p[0] for p in x.points]) / 4),
-            reverse=True,
-        )
+        order = np.argsort(-(points[:, :, 0].sum(axis=1) / 4), kind="stable")
 
-    contained_words = "\n".join([content.content for content in contained_words])
+    contained_words = "\n".join([pred_words.contents[i] for i in indices[order]])
     return (contained_words, element_direction, check_list)
 
 
@@ -148,8 +163,96 @@ def recursive_update(original, new_data):
     return original
 
 
+def validate_tasks(tasks):
+    """
+    Validate the tasks requested from DocumentAnalyzer.
+
+    Args:
+        tasks (Iterable[str] | None): subset of `SUPPORT_TASKS`. None means all tasks.
+
+    Returns:
+        set[str]: validated tasks
+    """
+
+    if tasks is None:
+        return set(SUPPORT_TASKS)
+
+    tasks = set(tasks)
+    invalid = tasks - set(SUPPORT_TASKS)
+    if len(invalid) > 0:
+        raise ValueError(
+            f"Invalid tasks: {sorted(invalid)}. Supported tasks are {SUPPORT_TASKS}"
+        )
+
+    if len(tasks) == 0:
+        raise ValueError("At least one task must be specified.")
+
+    # 図内の文字は図の要素として出力されるため、図の検出も必要になる
+    if "figure_letters" in tasks:
+        tasks.add("figures")
+
+    return tasks
+
+
+def validate_ocr_regions(ocr_regions):
+    """
+    Validate the layout regions in which text is recognized.
+
+    Args:
+        ocr_regions (Iterable[str] | None): subset of `SUPPORT_OCR_REGIONS`.
+            None means the whole page.
+
+    Returns:
+        set[str] | None: validated regions
+    """
+
+    if ocr_regions is None:
+        return None
+
+    ocr_regions = set(ocr_regions)
+    invalid = ocr_regions - set(SUPPORT_OCR_REGIONS)
+    if len(invalid) > 0:
+        raise ValueError(
+            f"Invalid OCR regions: {sorted(invalid)}. "
+            f"Supported regions are {SUPPORT_OCR_REGIONS}"
+        )
+
+    if len(ocr_regions) == 0:
+        raise ValueError("At least one OCR region must be specified.")
+
+    return ocr_regions
+
+
+def extract_region_boxes(layout_res, regions):
+    """レイアウト解析結果から、指定されたカテゴリ・役割の領域の矩形を抽出する"""
+    boxes = []
+    for paragraph in layout_res.paragraphs:
+        region = paragraph.role if paragraph.role is not None else "paragraphs"
+        if region in regions:
+            boxes.append(paragraph.box)
+
+    if "tables" in regions:
+        boxes.extend([table.box for table in layout_res.tables])
+
+    if "figures" in regions:
+        boxes.extend([figure.box for figure in layout_res.figures])
+
+    return boxes
+
+
 class DocumentAnalyzer:
-    def __init__(self, configs=None, device="cuda", visualize=False):
+    def __init__(
+        self,
+        configs=None,
+        device="cuda",
+        visualize=False,
+        tasks=None,
+        ocr_regions=None,
+        cache_dir=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        stage_cache_dir=None,
+        template=None,
+    ):
         default_configs = {
             "ocr": {
                 "text_detector": {
@@ -180,28 +283,202 @@ class DocumentAnalyzer:
                 "configs must be a dict. See the https://kotaro-kinoshita.github.io/yomitoku-dev/usage/"
             )
 
-        self.ocr = OCR(configs=default_configs["ocr"])
-        self.layout = LayoutAnalyzer(configs=default_configs["layout_analyzer"])
+        self.tasks = validate_tasks(tasks)
+        self.ocr_regions = validate_ocr_regions(ocr_regions)
+
+        # 出力に必要なステージのモデルのみを読み込む
+        self.ocr = None
+        if self.tasks & {"words", "paragraphs", "tables", "figure_letters"}:
+            self.ocr = OCR(configs=default_configs["ocr"])
+
+        self.layout = None
+        if self.tasks & {"paragraphs", "tables", "figures"} or self.ocr_regions:
+            self.layout = LayoutAnalyzer(
+                configs=default_configs["layout_analyzer"],
+                recognize_tables="tables" in self.tasks,
+            )
+
         self.visualize = visualize
 
+        if isinstance(template, str):
+            template = LayoutTemplate.load(template)
+        self.template = template
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = FileCache(cache_dir, max_size=cache_size)
+            self._config_hash = self.config_hash()
+
+        if stage_cache_dir is not None:
+            for module in self.modules():
+                module.enable_stage_cache(stage_cache_dir, max_size=cache_size)
+
+    def modules(self):
+        modules = []
+        if self.ocr is not None:
+            modules += [self.ocr.detector, self.ocr.recognizer]
+
+        if self.layout is not None:
+            modules.append(self.layout.layout_parser)
+            if self.layout.table_structure_recognizer is not None:
+                modules.append(self.layout.table_structure_recognizer)
+
+        return modules
+
+    def config_hash(self):
+        """
+        読み込んだモデルの重みとその設定、推論方法、タスクの指定から
+        解析結果を特定するハッシュ値を計算する
+        """
+        texts = [
+            sorted(self.tasks),
+            None if self.ocr_regions is None else sorted(self.ocr_regions),
+            None if self.template is None else self.template.hash,
+        ]
+
+        for module in self.modules():
+            texts.append(module.__class__.__name__)
+            texts.append(module.quantize)
+            texts.append(getattr(module, "infer_onnx", False))
+            texts.append(OmegaConf.to_yaml(module._cfg))
+            texts.append(hash_state_dict(module.model.state_dict()))
+
+        return hash_texts(*texts)
+
+    def register_template(self, img):
+        """
+        参照ページのレイアウト解析結果をテンプレートとして登録する。
+        以降のページはテンプレートに位置合わせできた場合、レイアウト解析を省略する。
+        """
+        if self.layout is None:
+            raise ValueError("Layout analysis is not required for the tasks.")
+
+        page = as_page(img)
+        layout_res, _ = self.layout.predict(page)
+        self.template = LayoutTemplate.from_image(page.img, layout_res)
+
+        if self.cache is not None:
+            self._config_hash = self.config_hash()
+
+        return self.template
+
+    def match_template(self, img):
+        if self.template is None or self.layout is None:
+            return None
+
+        layout_res = self.template.match(as_page(img).img)
+        if layout_res is None:
+            return None
+
+        # テーブル構造認識を行わない場合、テーブル領域は段落として扱う
+        if self.layout.table_structure_recognizer is None:
+            tables = [
+                ElementRecord(box=table.box, score=1.0, role=None)
+                for table in layout_res.tables
+            ]
+            layout_res.paragraphs = layout_res.paragraphs + tables
+            layout_res.tables = []
+
+        return layout_res
+
+    def cache_key(self, img):
+        return hash_texts(as_page(img).hash(), self._config_hash)
+
+    @property
+    def recognize_after_layout(self):
+        """レイアウト解析の結果を用いて、文字認識を行う文字領域を絞り込むかどうか"""
+        return (
+            self.ocr is not None
+            and self.layout is not None
+            and ("figure_letters" not in self.tasks or self.ocr_regions is not None)
+        )
+
+    def select_quads(self, det_outputs, layout_res):
+        """
+        文字認識を行う文字領域を選択する。
+        `ocr_regions`が指定された場合はその領域内の文字領域のみを残し、
+        図内の文字が不要な場合は図の内部の文字領域を除外する。
+        """
+        word_boxes = quads_to_xyxy(det_outputs.points)
+        keep = np.ones(len(word_boxes), dtype=bool)
+
+        if self.ocr_regions is not None:
+            region_boxes = extract_region_boxes(layout_res, self.ocr_regions)
+            in_region = is_contained_matrix(region_boxes, word_boxes, threshold=0.5)
+            keep &= in_region.any(axis=0)
+
+        if "figure_letters" not in self.tasks:
+            figure_boxes = [figure.box for figure in layout_res.figures]
+            in_figure = is_contained_matrix(figure_boxes, word_boxes, threshold=0.5)
+            keep &= ~in_figure.any(axis=0)
+
+        det_outputs.points = det_outputs.points[keep]
+        det_outputs.scores = det_outputs.scores[keep]
+        return det_outputs
+
+    def template_text_boxes(self, layout_res):
+        """
+        テンプレートに位置合わせしたレイアウトのうち、文字認識を行う領域の矩形。
+        `ocr_regions`が指定された場合はその領域、指定されない場合は段落とテーブル
+        (図内の文字が必要な場合は図も含む)とする。
+        """
+        if self.ocr_regions is not None:
+            return extract_region_boxes(layout_res, self.ocr_regions)
+
+        boxes = [paragraph.box for paragraph in layout_res.paragraphs]
+        boxes.extend([table.box for table in layout_res.tables])
+        if "figure_letters" in self.tasks:
+            boxes.extend([figure.box for figure in layout_res.figures])
+        return boxes
+
+    def ocr_template(self, page, layout_res):
+        """
+        テンプレートに位置合わせできたページの文字を読み取る。テンプレートの文字領域を
+        含む範囲のみで文字を検出し、文字領域内の文字列のみを認識する。
+        """
+        region_boxes = np.asarray(self.template_text_boxes(layout_res)).reshape(-1, 4)
+        det_outputs = TextDetectorRecord(
+            points=np.zeros((0, 4, 2), dtype=np.int32), scores=np.zeros(0)
+        )
+        vis = None
+        if len(region_boxes) > 0:
+            h, w = page.shape[:2]
+            margin = TEMPLATE_REGION_MARGIN * max(h, w)
+            x0, y0 = np.maximum(region_boxes[:, :2].min(axis=0) - margin, 0)
+            x1, y1 = np.minimum(region_boxes[:, 2:].max(axis=0) + margin, (w, h))
+            det_outputs, vis = self.ocr.detector.predict(page, region=[x0, y0, x1, y1])
+
+            word_boxes = quads_to_xyxy(det_outputs.points)
+            in_region = is_contained_matrix(region_boxes, word_boxes, threshold=0.5)
+            keep = in_region.any(axis=0)
+            det_outputs.points = det_outputs.points[keep]
+            det_outputs.scores = det_outputs.scores[keep]
+
+        det_outputs = self.select_quads(det_outputs, layout_res)
+        rec_outputs, vis = self.ocr.recognizer.predict(
+            page, det_outputs.points, vis=vis
+        )
+        return self.ocr.aggregate(det_outputs, rec_outputs), vis
+
     def aggregate(self, ocr_res, layout_res):
         paragraphs = []
-        check_list = [False] * len(ocr_res.words)
+        word_boxes = ocr_res.boxes()
+        check_list = np.zeros(len(ocr_res), dtype=bool)
         for table in layout_res.tables:
             for cell in table.cells:
                 words, direction, flags = extract_words_within_element(
-                    ocr_res.words, cell
+                    ocr_res, cell, word_boxes
                 )
 
                 if words is None:
                     words = ""
 
                 cell.contents = words
-                check_list = combine_flags(check_list, flags)
+                check_list |= flags
 
         for paragraph in layout_res.paragraphs:
             words, direction, flags = extract_words_within_element(
-                ocr_res.words, paragraph
+                ocr_res, paragraph, word_boxes
             )
 
             if words is None:
@@ -215,23 +492,21 @@ class DocumentAnalyzer:
                 "role": paragraph.role,
             }
 
-            check_list = combine_flags(check_list, flags)
-            paragraph = ParagraphSchema(**paragraph)
+            check_list |= flags
+            paragraph = ParagraphRecord(**paragraph)
             paragraphs.append(paragraph)
 
-        for i, word in enumerate(ocr_res.words):
-            direction = word.direction
-            if not check_list[i]:
-                paragraph = {
-                    "contents": word.content,
-                    "box": quad_to_xyxy(word.points),
-                    "direction": direction,
-                    "order": 0,
-                    "role": None,
-                }
+        for i in np.flatnonzero(~check_list):
+            paragraph = {
+                "contents": ocr_res.contents[i],
+                "box": word_boxes[i].tolist(),
+                "direction": DIRECTIONS[ocr_res.directions[i]],
+                "order": 0,
+                "role": None,
+            }
 
-                paragraph = ParagraphSchema(**paragraph)
-                paragraphs.append(paragraph)
+            paragraph = ParagraphRecord(**paragraph)
+            paragraphs.append(paragraph)
 
         figures, check_list = extract_paragraph_within_figure(
             paragraphs, layout_res.figures
@@ -277,33 +552,108 @@ class DocumentAnalyzer:
             "paragraphs": paragraphs,
             "tables": tables,
             "figures": figures,
-            "words": ocr_res.words,
+            "words": ocr_res,
         }
 
         return outputs
 
-    async def run(self, img):
+    async def run_models(self, page):
+        """OCRとレイアウト解析のモデルを並列に実行する"""
+        results_ocr, ocr = OCRResultArrays.empty(), None
+        results_layout, layout = None, None
+        run_layout = self.layout is not None
         with ThreadPoolExecutor(max_workers=2) as executor:
             loop = asyncio.get_running_loop()
-            tasks = [
-                loop.run_in_executor(executor, self.ocr, img),
-                loop.run_in_executor(executor, self.layout, img),
-            ]
+            tasks = []
+            if self.ocr is not None:
+                # 文字領域を絞り込む場合は、レイアウト解析と並行して検出のみを行う
+                ocr_func = self.ocr.predict
+                if self.recognize_after_layout:
+                    ocr_func = self.ocr.detector.predict
+                tasks.append(loop.run_in_executor(executor, ocr_func, page))
+
+            if run_layout:
+                tasks.append(loop.run_in_executor(executor, self.layout.predict, page))
 
             results = await asyncio.gather(*tasks)
 
+        if self.ocr is not None:
             results_ocr, ocr = results[0]
-            results_layout, layout = results[1]
 
-        outputs = self.aggregate(results_ocr, results_layout)
-        results = DocumentAnalyzerSchema(**outputs)
+        if run_layout:
+            results_layout, layout = results[-1]
+
+        if self.recognize_after_layout:
+            results_det = self.select_quads(results_ocr, results_layout)
+            results_rec, ocr = self.ocr.recognizer.predict(
+                page, results_det.points, vis=ocr
+            )
+            results_ocr = self.ocr.aggregate(results_det, results_rec)
+
+        return results_ocr, ocr, results_layout, layout
+
+    async def run(self, img):
+        # 各モジュールにPageを渡し、前処理の結果を共有する
+        page = as_page(img)
+        img = page.img
+        results_ocr, ocr = OCRResultArrays.empty(), None
+        layout = None
+
+        # テンプレートに位置合わせできた場合はレイアウト解析のモデルを実行せず、
+        # テンプレートの文字領域のみで文字の検出と認識を行う
+        results_layout = self.match_template(page)
+        if results_layout is not None:
+            if self.visualize:
+                layout = template_visualizer(results_layout, img)
+            if self.ocr is not None:
+                results_ocr, ocr = self.ocr_template(page, results_layout)
+        else:
+            results_ocr, ocr, results_layout, layout = await self.run_models(page)
+
+        if results_layout is None:
+            outputs = {
+                "paragraphs": [],
+                "tables": [],
+                "figures": [],
+                "words": results_ocr,
+            }
+        else:
+            outputs = self.aggregate(results_ocr, results_layout)
+
+        for task in ["paragraphs", "tables", "figures"]:
+            if task not in self.tasks:
+                outputs[task] = []
+
+        if "words" not in self.tasks:
+            outputs["words"] = OCRResultArrays.empty()
+
+        results = DocumentAnalyzerRecord(**outputs)
         return results, ocr, layout
 
-    def __call__(self, img):
-        self.img = img
-        resutls, ocr, layout = asyncio.run(self.run(img))
+    def predict(self, img):
+        page = as_page(img)
+        self.img = page.img
+        resutls, ocr, layout = asyncio.run(self.run(page))
 
-        if self.visualize:
+        if self.visualize and layout is not None:
             layout = reading_order_visualizer(layout, resutls)
 
         return resutls, ocr, layout
+
+    def __call__(self, img):
+        # 可視化画像はキャッシュしないため、可視化時はキャッシュを利用しない
+        page = as_page(img)
+        key = None
+        if self.cache is not None and not self.visualize:
+            key = self.cache_key(page)
+            data = self.cache.load(key)
+            if data is not None:
+                return DocumentAnalyzerSchema.model_validate_json(data), None, None
+
+        results, ocr, layout = self.predict(page)
+        results = results.to_schema()
+
+        if key is not None:
+            self.cache.save(key, results.model_dump_json().encode())
+
+        return results, ocr, layout
@@ -1,6 +1,7 @@
 from typing import List
 
-from .base import BaseSchema
+from .base import BaseRecord, BaseSchema
+from .data.page import as_page
 from .layout_parser import Element, LayoutParser
 from .table_structure_recognizer import (
     TableStructureRecognizer,
@@ -14,8 +15,15 @@ class LayoutAnalyzerSchema(BaseSchema):
     figures: List[Element]
 
 
+class LayoutAnalyzerRecord(BaseRecord):
+    __slots__ = ("paragraphs", "tables", "figures")
+    schema = LayoutAnalyzerSchema
+
+
 class LayoutAnalyzer:
-    def __init__(self, configs=None, device="cuda", visualize=False):
+    def __init__(
+        self, configs=None, device="cuda", visualize=False, recognize_tables=True
+    ):
         layout_parser_kwargs = {
             "device": device,
             "visualize": visualize,
@@ -45,19 +53,35 @@ class LayoutAnalyzer:
         self.layout_parser = LayoutParser(
             **layout_parser_kwargs,
         )
-        self.table_structure_recognizer = TableStructureRecognizer(
-            **table_structure_recognizer_kwargs,
-        )
+        self.table_structure_recognizer = None
+        if recognize_tables:
+            self.table_structure_recognizer = TableStructureRecognizer(
+                **table_structure_recognizer_kwargs,
+            )
 
-    def __call__(self, img):
-        layout_results, vis = self.layout_parser(img)
-        table_boxes = [table.box for table in layout_results.tables]
-        table_results, vis = self.table_structure_recognizer(img, table_boxes, vis=vis)
+    def predict(self, img):
+        page = as_page(img)
+        layout_results, vis = self.layout_parser.predict(page)
+        paragraphs = layout_results.paragraphs
 
-        results = LayoutAnalyzerSchema(
-            paragraphs=layout_results.paragraphs,
+        if self.table_structure_recognizer is None:
+            # テーブル構造認識を行わない場合、テーブル領域は段落として扱う
+            paragraphs = paragraphs + layout_results.tables
+            table_results = []
+        else:
+            table_boxes = [table.box for table in layout_results.tables]
+            table_results, vis = self.table_structure_recognizer.predict(
+                page, table_boxes, vis=vis
+            )
+
+        results = LayoutAnalyzerRecord(
+            paragraphs=paragraphs,
             tables=table_results,
             figures=layout_results.figures,
         )
 
         return results, vis
+
+    def __call__(self, img):
+        results, vis = self.predict(img)
+        return results.to_schema(), vis
@@ -1,21 +1,16 @@
 from typing import List, Union
 
-import cv2
-import os
-import onnx
-import onnxruntime
+import numpy as np
 import torch
-import torchvision.transforms as T
-from PIL import Image
 from pydantic import conlist
 
-from .constants import ROOT_DIR
-
-from .base import BaseModelCatalog, BaseModule, BaseSchema
+from .base import BaseModelCatalog, BaseModule, BaseRecord, BaseSchema
 from .configs import LayoutParserRTDETRv2Config
-from .models import RTDETRv2
-from .postprocessor import RTDETRPostProcessor
-from .utils.misc import filter_by_flag, is_contained
+from .data.functions import calc_tiles, resize_to_tensor
+from .data.page import as_page
+from .models import RTDETRv2, RTDETRv2Deploy
+from .postprocessor import RTDETRPostProcessor, filter_detections, merge_detections
+from .utils.misc import filter_by_flag, is_contained_matrix
 from .utils.visualizer import layout_visualizer
 
 
@@ -31,6 +26,16 @@ class LayoutParserSchema(BaseSchema):
     figures: List[Element]
 
 
+class ElementRecord(BaseRecord):
+    __slots__ = ("box", "score", "role")
+    schema = Element
+
+
+class LayoutParserRecord(BaseRecord):
+    __slots__ = ("paragraphs", "tables", "figures")
+    schema = LayoutParserSchema
+
+
 class LayoutParserModelCatalog(BaseModelCatalog):
     def __init__(self):
         super().__init__()
@@ -41,31 +46,26 @@ def filter_contained_rectangles_within_category(category_elements):
     """同一カテゴリに属する矩形のうち、他の矩形の内側に含まれるものを除外"""
 
     for category, elements in category_elements.items():
-        group_box = [element["box"] for element in elements]
-        check_list = [True] * len(group_box)
-        for i, box_i in enumerate(group_box):
-            for j, box_j in enumerate(group_box):
-                if i >= j:
-                    continue
-
-                ij = is_contained(box_i, box_j)
-                ji = is_contained(box_j, box_i)
-
-                box_i_area = (box_i[2] - box_i[0]) * (box_i[3] - box_i[1])
-                box_j_area = (box_j[2] - box_j[0]) * (box_j[3] - box_j[1])
-
-                # 双方から見て内包関係にある場合、面積の大きい方を残す
-                if ij and ji:
-                    if box_i_area > box_j_area:
-                        check_list[j] = False
-                    else:
-                        check_list[i] = False
-                elif ij:
-                    check_list[j] = False
-                elif ji:
-                    check_list[i] = False
-
-        category_elements[category] = filter_by_flag(elements, check_list)
+        group_box = np.array(
+            [element["box"] for element in elements], dtype=np.float64
+        ).reshape(-1, 4)
+
+        # contained[i, j]: 矩形jが矩形iに含まれる
+        contained = is_contained_matrix(group_box, group_box)
+        contained_t = contained.T
+        area = (group_box[:, 2] - group_box[:, 0]) * (group_box[:, 3] - group_box[:, 1])
+        larger = area[:, None] > area[None, :]
+
+        # i < jの組み合わせのみを判定する
+        pair = np.triu(np.ones(contained.shape, dtype=bool), k=1)
+        both = contained & contained_t
+
+        # 双方から見て内包関係にある場合、面積の大きい方を残す
+        remove_j = pair & ((both & larger) | (contained & ~contained_t))
+        remove_i = pair & ((both & ~larger) | (contained_t & ~contained))
+
+        check_list = ~(remove_j.any(axis=0) | remove_i.any(axis=1))
+        category_elements[category] = filter_by_flag(elements, check_list.tolist())
 
     return category_elements
 
@@ -76,18 +76,22 @@ def filter_contained_rectangles_across_categories(category_elements, source, tar
     src_boxes = [element["box"] for element in category_elements[source]]
     tgt_boxes = [element["box"] for element in category_elements[target]]
 
-    check_list = [True] * len(tgt_boxes)
-    for i, src_box in enumerate(src_boxes):
-        for j, tgt_box in enumerate(tgt_boxes):
-            if is_contained(src_box, tgt_box):
-                check_list[j] = False
+    check_list = ~is_contained_matrix(src_boxes, tgt_boxes).any(axis=0)
 
-    category_elements[target] = filter_by_flag(category_elements[target], check_list)
+    category_elements[target] = filter_by_flag(
+        category_elements[target], check_list.tolist()
+    )
     return category_elements
 
 
+TILING_MODES = ("resize", "letterbox", "tile")
+
+
 class LayoutParser(BaseModule):
     model_catalog = LayoutParserModelCatalog()
+    onnx_opset = 16
+    postprocess_config_keys = ("thresh_score", "category", "role", "visualize")
+    quantize_modules = ("encoder.encoder", "decoder.decoder")
 
     def __init__(
         self,
@@ -97,26 +101,25 @@ class LayoutParser(BaseModule):
         visualize=False,
         from_pretrained=True,
         infer_onnx=False,
+        quantize=None,
+        compile=False,
     ):
         super().__init__()
-        self.load_model(model_name, path_cfg, from_pretrained)
+        if infer_onnx and quantize is not None:
+            raise ValueError("quantize is not supported with infer_onnx.")
+
+        self.load_model(model_name, path_cfg, from_pretrained, quantize=quantize)
         self.device = device
         self.visualize = visualize
 
-        self.model.eval()
-        self.model.to(self.device)
-
-        self.postprocessor = RTDETRPostProcessor(
+        # RepVGGの分岐とBatchNormを畳み込みに統合し、後処理をモデルに含める
+        postprocessor = RTDETRPostProcessor(
             num_classes=self._cfg.RTDETRTransformerv2.num_classes,
             num_top_queries=self._cfg.RTDETRTransformerv2.num_queries,
         )
-
-        self.transforms = T.Compose(
-            [
-                T.Resize(self._cfg.data.img_size),
-                T.ToTensor(),
-            ]
-        )
+        self.model = RTDETRv2Deploy(self.model, postprocessor)
+        self.model.eval()
+        self.model.to(self.device)
 
         self.thresh_score = self._cfg.thresh_score
 
@@ -125,52 +128,151 @@ class LayoutParser(BaseModule):
         }
 
         self.role = self._cfg.role
+
+        if self._cfg.tiling.mode not in TILING_MODES:
+            raise ValueError(
+                f"Invalid tiling mode: {self._cfg.tiling.mode}. "
+                f"Supported modes are {list(TILING_MODES)}"
+            )
+
         self.infer_onnx = infer_onnx
+        self.set_precision(self._cfg.precision)
         if infer_onnx:
-            name = self._cfg.hf_hub_repo.split("/")[-1]
-            path_onnx = f"{ROOT_DIR}/onnx/{name}.onnx"
-            if not os.path.exists(path_onnx):
-                self.convert_onnx(path_onnx)
-
-            model = onnx.load(path_onnx)
-            if torch.cuda.is_available() and device == "cuda":
-                self.sess = onnxruntime.InferenceSession(
-                    model.SerializeToString(), providers=["CUDAExecutionProvider"]
-                )
-            else:
-                self.sess = onnxruntime.InferenceSession(model.SerializeToString())
+            self.load_onnx()
 
-    def convert_onnx(self, path_onnx):
-        dynamic_axes = {
-            "input": {0: "batch_size"},
-            "output": {0: "batch_size"},
-        }
+        if compile or self._cfg.compile:
+            self.compile_model()
+            self.warmup()
 
-        img_size = self._cfg.data.img_size
-        dummy_input = torch.randn(1, 3, *img_size, requires_grad=True)
+    def convert_onnx(self, path_onnx):
+        # 入力は常に1枚の画像を固定サイズにリサイズしたものであるため、静的な形状で
+        # 変換し、形状に依存する演算を定数畳み込みで除去する
+        dummy_input = torch.randn(*self.onnx_input_shape())
 
         torch.onnx.export(
             self.model,
             dummy_input,
             path_onnx,
-            opset_version=16,
+            opset_version=self.onnx_opset,
             input_names=["input"],
-            output_names=["pred_logits", "pred_boxes"],
-            dynamic_axes=dynamic_axes,
+            output_names=["labels", "boxes", "scores"],
+            do_constant_folding=True,
+            dynamo=False,
         )
 
+    def warmup_shapes(self):
+        return [(1, 3, *self._cfg.data.img_size)]
+
     def preprocess(self, img):
-        cv_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(cv_img)
-        img_tensor = self.transforms(img)[None]
-        return img_tensor
+        tensor = torch.empty((1, 3, *self._cfg.data.img_size))
+        resize_to_tensor(img, self._cfg.data.img_size, out=tensor[0])
+        return tensor
+
+    def views(self, img):
+        """
+        推論する画像の領域 (x0, y0, x1, y1) のリスト。タイル分割では短辺を
+        `tiles_per_short_side`分割した正方形のタイルに分割し、ページ全体を加える。
+        """
+        h, w = img.shape[:2]
+        cfg = self._cfg.tiling
+        if cfg.mode != "tile":
+            return [(0, 0, w, h)]
+
+        tile_size = min(h, w) // cfg.tiles_per_short_side
+        views = calc_tiles(h, w, tile_size, int(tile_size * cfg.overlap))
+        # タイルの境界で見切れた要素はページ全体の検出結果で補う
+        if len(views) > 1:
+            views = [(0, 0, w, h)] + views
+        return views
+
+    def letterbox_size(self, view):
+        """領域の右下に余白を加えて入力の縦横比に合わせた大きさ (w, h)"""
+        x0, y0, x1, y1 = view
+        h, w = self._cfg.data.img_size
+        width = max(x1 - x0, (y1 - y0) * w / h)
+        height = max(y1 - y0, (x1 - x0) * h / w)
+        return width, height
+
+    def preprocess_view(self, img, view, out):
+        """
+        領域を切り出して`out` (3, H, W) の左上にリサイズし、残りの余白を白で埋める。
+        """
+        x0, y0, x1, y1 = view
+        width, height = self.letterbox_size(view)
+        h, w = self._cfg.data.img_size
+        resized_h = max(1, int(round((y1 - y0) * h / height)))
+        resized_w = max(1, int(round((x1 - x0) * w / width)))
+
+        out.fill_(1.0)
+        resize_to_tensor(
+            img[y0:y1, x0:x1],
+            (resized_h, resized_w),
+            out=out[:, :resized_h, :resized_w],
+        )
+        return out
+
+    def preprocess_views(self, img, views):
+        tensor = torch.empty((len(views), 3, *self._cfg.data.img_size))
+        for view, out in zip(views, tensor):
+            self.preprocess_view(img, view, out)
+        return tensor
+
+    def detect_views(self, page):
+        """
+        画像の各領域を入力の縦横比に合わせて余白を加えてから推論し、検出結果を統合する。
+        タイル分割では、内側のタイルの境界に接する検出結果は
+        見切れているとみなし除外する。
+        """
+        cfg = self._cfg.tiling
+        img = page.img
+        h, w = img.shape[:2]
+        views = self.views(img)
+        drop_cut = len(views) > 1
+
+        # 各バッチのテンソルは推論後に不要となるため、ページには保持しない
+        outputs = []
+        for i in range(0, len(views), cfg.batch_size):
+            batch = views[i : i + cfg.batch_size]
+            tensor = self.preprocess_views(img, batch)
+            preds = self.infer(tensor)
+            sizes = [self.letterbox_size(view) for view in batch]
+
+            results = filter_detections(preds, sizes, self.thresh_score)
+            for (x0, y0, x1, y1), result in zip(batch, results):
+                boxes = result["boxes"] + np.array([x0, y0, x0, y0], dtype=np.float32)
+                boxes = np.clip(boxes, [x0, y0, x0, y0], [x1, y1, x1, y1])
+                result["boxes"] = boxes
+
+                if drop_cut and (x1 - x0, y1 - y0) != (w, h):
+                    margin = 0.01 * min(x1 - x0, y1 - y0)
+                    cut = (
+                        ((boxes[:, 0] <= x0 + margin) & (x0 > 0))
+                        | ((boxes[:, 1] <= y0 + margin) & (y0 > 0))
+                        | ((boxes[:, 2] >= x1 - margin) & (x1 < w))
+                        | ((boxes[:, 3] >= y1 - margin) & (y1 < h))
+                    )
+                    result = {key: value[~cut] for key, value in result.items()}
+
+                outputs.append(result)
+
+        if len(outputs) == 1:
+            return outputs[0]
+
+        return merge_detections(outputs, cfg.merge_iou, cfg.merge)
 
     def postprocess(self, preds, image_size):
         h, w = image_size
-        orig_size = torch.tensor([w, h])[None].to(self.device)
-        outputs = self.postprocessor(preds, orig_size, self.thresh_score)
-        outputs = self.filtering_elements(outputs[0])
-        results = LayoutParserSchema(**outputs)
+        outputs = filter_detections(preds, [(w, h)], self.thresh_score)
+        return self.to_record(outputs[0])
+
+    def to_record(self, outputs):
+        outputs = self.filtering_elements(outputs)
+        results = LayoutParserRecord(
+            **{
+                category: [ElementRecord(**element) for element in elements]
+                for category, elements in outputs.items()
+            }
+        )
         return results
 
     def filtering_elements(self, preds):
@@ -210,24 +312,33 @@ class LayoutParser(BaseModule):
 
         return category_elements
 
-    def __call__(self, img):
-        ori_h, ori_w = img.shape[:2]
-        img_tensor = self.preprocess(img)
-
+    def forward(self, tensor):
         if self.infer_onnx:
-            input = img_tensor.numpy()
-            results = self.sess.run(None, {"input": input})
-            preds = {
-                "pred_logits": torch.tensor(results[0]).to(self.device),
-                "pred_boxes": torch.tensor(results[1]).to(self.device),
+            # ONNXモデルはバッチサイズ1の静的な形状で変換する
+            results = [
+                self.sess.run(None, {"input": input[None]}) for input in tensor.numpy()
+            ]
+            results = [np.concatenate(outputs) for outputs in zip(*results)]
+            return {
+                name: torch.tensor(result).to(self.device)
+                for name, result in zip(["labels", "boxes", "scores"], results)
             }
 
-        else:
-            with torch.inference_mode():
-                img_tensor = img_tensor.to(self.device)
-                preds = self.model(img_tensor)
+        with torch.inference_mode():
+            tensor = tensor.to(self.device)
+            return self.model(tensor)
 
-        results = self.postprocess(preds, (ori_h, ori_w))
+    def predict(self, img):
+        page = as_page(img)
+        img = page.img
+        ori_h, ori_w = img.shape[:2]
+        if self._cfg.tiling.mode == "resize":
+            key = ("layout_parser", tuple(self._cfg.data.img_size))
+            img_tensor = page.memoize(key, lambda: self.preprocess(img))
+            preds = self.infer(img_tensor)
+            results = self.postprocess(preds, (ori_h, ori_w))
+        else:
+            results = self.to_record(self.detect_views(page))
 
         vis = None
         if self.visualize:
@@ -237,3 +348,7 @@ class LayoutParser(BaseModule):
             )
 
         return results, vis
+
+    def __call__(self, img):
+        results, vis = self.predict(img)
+        return results.to_schema(), vis
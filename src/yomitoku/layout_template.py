@@ -0,0 +1,285 @@
+import json
+
+import cv2
+import numpy as np
+
+from .layout_analyzer import LayoutAnalyzerRecord
+from .layout_parser import ElementRecord, LayoutParserRecord
+from .table_structure_recognizer import TableCellRecord, TableStructureRecognizerRecord
+from .utils.cache import hash_image, hash_texts
+from .utils.logger import set_logger
+from .utils.visualizer import layout_visualizer, table_visualizer
+
+logger = set_logger(__name__, "INFO")
+
+
+def transform_boxes(boxes, H, image_size):
+    """
+    Transform xyxy boxes with a homography and return the bounding boxes of the
+    transformed corners clipped to the image.
+
+    Args:
+        boxes (np.ndarray): boxes (N, 4)
+        H (np.ndarray): homography (3, 3)
+        image_size (Tuple[int, int]): (height, width) of the target image
+
+    Returns:
+        np.ndarray: transformed boxes (N, 4) int
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=int)
+
+    x1, y1, x2, y2 = boxes.T
+    corners = np.stack(
+        [
+            np.stack([x1, y1], axis=-1),
+            np.stack([x2, y1], axis=-1),
+            np.stack([x2, y2], axis=-1),
+            np.stack([x1, y2], axis=-1),
+        ],
+        axis=1,
+    )
+
+    warped = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), H).reshape(-1, 4, 2)
+
+    h, w = image_size
+    xs = np.clip(warped[..., 0], 0, w)
+    ys = np.clip(warped[..., 1], 0, h)
+    transformed = np.stack(
+        [xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)], axis=-1
+    )
+    return np.round(transformed).astype(int)
+
+
+def layout_from_dict(data):
+    def to_elements(elements):
+        return [ElementRecord(**element) for element in elements]
+
+    tables = []
+    for table in data["tables"]:
+        cells = [TableCellRecord(**cell) for cell in table["cells"]]
+        tables.append(TableStructureRecognizerRecord(**{**table, "cells": cells}))
+
+    return LayoutAnalyzerRecord(
+        paragraphs=to_elements(data["paragraphs"]),
+        tables=tables,
+        figures=to_elements(data["figures"]),
+    )
+
+
+def template_visualizer(layout, img):
+    tables = [
+        ElementRecord(box=table.box, score=1.0, role=None) for table in layout.tables
+    ]
+    elements = LayoutParserRecord(
+        paragraphs=layout.paragraphs, tables=tables, figures=layout.figures
+    )
+    vis = layout_visualizer(elements, img)
+    for table in layout.tables:
+        vis = table_visualizer(vis, table)
+    return vis
+
+
+class LayoutTemplate:
+    """
+    固定レイアウトの帳票向けのテンプレート。
+    参照ページのレイアウト解析結果と特徴点を保持し、入力ページを特徴点のマッチングに
+    よる射影変換で位置合わせすることで、レイアウト解析のモデルを実行せずに入力ページの
+    レイアウトを求める。
+    """
+
+    def __init__(
+        self,
+        layout,
+        image_size,
+        keypoints,
+        descriptors,
+        n_features=2000,
+        max_size=1024,
+        ratio=0.75,
+        ransac_thresh=5.0,
+        min_inliers=30,
+    ):
+        self.layout = layout
+        self.image_size = tuple(image_size)
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+
+        self.n_features = n_features
+        self.max_size = max_size
+        self.ratio = ratio
+        self.ransac_thresh = ransac_thresh
+        self.min_inliers = min_inliers
+
+        self.detector = cv2.ORB_create(nfeatures=n_features)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+
+        self.hash = hash_texts(
+            hash_image(descriptors), json.dumps(layout.dict(), sort_keys=True)
+        )
+
+    @classmethod
+    def from_image(cls, img, layout, **kwargs):
+        """
+        Create a template from a reference page.
+
+        Args:
+            img (np.ndarray): reference image(BGR)
+            layout (LayoutAnalyzerRecord): layout analysis result of the reference image
+        """
+        detector = cv2.ORB_create(nfeatures=kwargs.get("n_features", 2000))
+        keypoints, descriptors = extract_features(
+            detector, img, kwargs.get("max_size", 1024)
+        )
+        if len(keypoints) < kwargs.get("min_inliers", 30):
+            raise ValueError("Not enough features found in the template image.")
+
+        return cls(layout, img.shape[:2], keypoints, descriptors, **kwargs)
+
+    def save(self, path):
+        np.savez(
+            path,
+            keypoints=self.keypoints,
+            descriptors=self.descriptors,
+            image_size=np.array(self.image_size),
+            layout=json.dumps(self.layout.dict()),
+        )
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as data:
+            return cls(
+                layout_from_dict(json.loads(str(data["layout"]))),
+                data["image_size"].tolist(),
+                data["keypoints"],
+                data["descriptors"],
+                **kwargs,
+            )
+
+    def align(self, img):
+        """
+        Estimate the homography from the template to the input page.
+
+        Returns:
+            np.ndarray: homography (3, 3), or None if the page does not match the template
+        """
+        keypoints, descriptors = extract_features(self.detector, img, self.max_size)
+        if len(keypoints) < self.min_inliers:
+            return None
+
+        matches = self.matcher.knnMatch(self.descriptors, descriptors, k=2)
+        good = [
+            m[0]
+            for m in matches
+            if len(m) == 2 and m[0].distance < self.ratio * m[1].distance
+        ]
+
+        if len(good) < self.min_inliers:
+            return None
+
+        src = self.keypoints[[m.queryIdx for m in good]]
+        dst = keypoints[[m.trainIdx for m in good]]
+
+        scale = max(img.shape[:2]) / self.max_size
+        H, mask = cv2.findHomography(
+            src, dst, cv2.RANSAC, self.ransac_thresh * max(scale, 1.0)
+        )
+
+        if H is None or int(mask.sum()) < self.min_inliers:
+            return None
+
+        # 位置合わせの結果、ページの面積が大きく変化する場合は別の帳票とみなす
+        h, w = self.image_size
+        corners = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float64)
+        warped = cv2.perspectiveTransform(corners[:, None], H)[:, 0].astype(np.float32)
+        ratio = cv2.contourArea(warped) / (img.shape[0] * img.shape[1])
+        if not 0.5 < ratio < 2.0:
+            return None
+
+        return H
+
+    def warp(self, H, image_size):
+        """Map the template layout to the input page with the homography."""
+        paragraphs = self.layout.paragraphs
+        figures = self.layout.figures
+        tables = self.layout.tables
+        cells = [cell for table in tables for cell in table.cells]
+
+        elements = paragraphs + figures + tables + cells
+        boxes = transform_boxes([e.box for e in elements], H, image_size).tolist()
+        boxes = iter(boxes)
+
+        def warp_elements(elements):
+            return [
+                ElementRecord(box=next(boxes), score=element.score, role=element.role)
+                for element in elements
+            ]
+
+        paragraphs = warp_elements(paragraphs)
+        figures = warp_elements(figures)
+
+        table_boxes = [next(boxes) for _ in tables]
+        warped_tables = []
+        for table, box in zip(tables, table_boxes):
+            warped_tables.append(
+                TableStructureRecognizerRecord(
+                    box=box,
+                    n_row=table.n_row,
+                    n_col=table.n_col,
+                    cells=[
+                        TableCellRecord(
+                            col=cell.col,
+                            row=cell.row,
+                            col_span=cell.col_span,
+                            row_span=cell.row_span,
+                            box=next(boxes),
+                            contents=None,
+                        )
+                        for cell in table.cells
+                    ],
+                    order=0,
+                )
+            )
+
+        return LayoutAnalyzerRecord(
+            paragraphs=paragraphs,
+            tables=warped_tables,
+            figures=figures,
+        )
+
+    def match(self, img):
+        """
+        Align the input page to the template and return its layout.
+
+        Returns:
+            LayoutAnalyzerRecord: layout of the input page, or None if the page
+            does not match the template
+        """
+        H = self.align(img)
+        if H is None:
+            logger.info("The page does not match the template.")
+            return None
+
+        return self.warp(H, img.shape[:2])
+
+
+def extract_features(detector, img, max_size):
+    """
+    Detect ORB features on a downscaled grayscale image and return the keypoint
+    coordinates in the original image and their descriptors.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    scale = min(1.0, max_size / max(h, w))
+    if scale < 1.0:
+        gray = cv2.resize(
+            gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA
+        )
+
+    keypoints, descriptors = detector.detectAndCompute(gray, None)
+    if descriptors is None:
+        return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 32), dtype=np.uint8)
+
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32) / scale
+    return points, descriptors
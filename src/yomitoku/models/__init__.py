@@ -1,9 +1,10 @@
 from .dbnet_plus import DBNet
 from .parseq import PARSeq
-from .rtdetr import RTDETRv2
+from .rtdetr import RTDETRv2, RTDETRv2Deploy
 
 __all__ = [
     "DBNet",
     "PARSeq",
     "RTDETRv2",
+    "RTDETRv2Deploy",
 ]
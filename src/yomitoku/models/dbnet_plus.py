@@ -5,11 +5,98 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 from huggingface_hub import PyTorchModelHubMixin
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision.models._utils import IntermediateLayerGetter
 
 from .layers.dbnet_feature_attention import ScaleFeatureSelection
 
 
+def fuse_conv_bn(module):
+    """
+    BatchNormを直前の畳み込みの重みとバイアスに畳み込む。
+    nn.Sequential内で連続する畳み込みとBatchNorm、およびResNetのconv{n}とbn{n}の組を対象とする。
+    """
+    for m in list(module.modules()):
+        if isinstance(m, nn.Sequential):
+            pairs = [
+                (str(i - 1), str(i))
+                for i in range(1, len(m))
+                if isinstance(m[i], nn.BatchNorm2d)
+                and isinstance(m[i - 1], (nn.Conv2d, nn.ConvTranspose2d))
+            ]
+        else:
+            pairs = [
+                (name.replace("bn", "conv", 1), name)
+                for name, child in m.named_children()
+                if name.startswith("bn") and isinstance(child, nn.BatchNorm2d)
+            ]
+
+        for conv_name, bn_name in pairs:
+            conv = getattr(m, conv_name, None)
+            if not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)):
+                continue
+
+            transpose = isinstance(conv, nn.ConvTranspose2d)
+            bn = getattr(m, bn_name)
+            setattr(m, conv_name, fuse_conv_bn_eval(conv, bn, transpose=transpose))
+            setattr(m, bn_name, nn.Identity())
+
+    return module
+
+
+def transposed_to_pointwise(layer):
+    """
+    kernel=stride=2の転置畳み込みを、出力の2x2のサブピクセルをチャネル方向に並べた
+    1x1畳み込みの重みとバイアスに変換する。
+    チャネルの並びは(サブピクセル, 出力チャネル)。
+    """
+    in_channels, out_channels = layer.weight.shape[:2]
+    weight = layer.weight.permute(2, 3, 1, 0).reshape(4 * out_channels, in_channels)
+    bias = layer.bias
+    if bias is None:
+        bias = torch.zeros(out_channels, device=weight.device)
+    return weight, bias.repeat(4)
+
+
+class LowResBinarize(nn.Module):
+    """
+    DBNetDecoder.binarizeを1/4解像度のまま計算する。2段の転置畳み込みを4x4のサブピクセルごとの
+    1x1畳み込みとして計算し、サブピクセルの確率の平均を出力する。
+    出力はbinarizeの出力を4x4で平均プーリングしたものと一致する。
+    """
+
+    @torch.no_grad()
+    def __init__(self, binarize):
+        super().__init__()
+        conv, norm, _, up1, norm1, _, up2, _ = binarize
+        if isinstance(norm, nn.BatchNorm2d):
+            conv = fuse_conv_bn_eval(conv, norm)
+        self.conv = conv
+
+        weight, bias = transposed_to_pointwise(up1)
+        if isinstance(norm1, nn.BatchNorm2d):
+            scale = norm1.weight / torch.sqrt(norm1.running_var + norm1.eps)
+            shift = norm1.bias - norm1.running_mean * scale
+            weight = weight * scale.repeat(4)[:, None]
+            bias = bias * scale.repeat(4) + shift.repeat(4)
+
+        self.up1 = nn.Conv2d(weight.shape[1], weight.shape[0], 1)
+        self.up1.weight.copy_(weight[:, :, None, None])
+        self.up1.bias.copy_(bias)
+
+        # 1段目のサブピクセルごとに、2段目の転置畳み込みを適用する
+        weight, bias = transposed_to_pointwise(up2)
+        self.up2 = nn.Conv2d(weight.shape[0] * weight.shape[1], 16, 1, groups=4)
+        self.up2.weight.copy_(weight.repeat(4, 1)[:, :, None, None])
+        self.up2.bias.copy_(bias.repeat(4))
+
+    def forward(self, x):
+        x = F.relu(self.conv(x))
+        x = F.relu(self.up1(x))
+        x = torch.sigmoid(self.up2(x))
+        return x.mean(dim=1, keepdim=True)
+
+
 class BackboneBase(nn.Module):
     def __init__(self, backbone: nn.Module):
         super().__init__()
@@ -195,6 +282,8 @@ class DBNetDecoder(nn.Module):
             return nn.ConvTranspose2d(in_channels, out_channels, 2, 2)
 
     def step_function(self, x, y):
+        # 低精度ではexpがオーバーフローするため、fp32で計算する
+        x, y = x.float(), y.float()
         return torch.reciprocal(1 + torch.exp(-self.k * (x - y)))
 
     def forward(self, features):
@@ -244,3 +333,34 @@ class DBNet(nn.Module, PyTorchModelHubMixin):
         features = self.backbone(tensor)
         xs = self.decoder(features)
         return xs
+
+    @torch.no_grad()
+    def deploy(self, channels_last=False):
+        """
+        推論用の構造に変換する。BatchNormを畳み込みに畳み込み、推論では出力しない
+        しきい値マップの分岐を削除する。学習済みの重みを読み込んだ後に呼び出すこと。
+
+        Args:
+            channels_last (bool): 重みをchannels_lastのメモリ形式に変換する
+        """
+        self.eval()
+        fuse_conv_bn(self)
+        if hasattr(self.decoder, "thresh"):
+            del self.decoder.thresh
+
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        return self
+
+    def to_low_resolution(self):
+        """
+        確率マップを入力の1/4の解像度で出力するモードに変換する。
+        推論では利用しないしきい値マップの分岐も削除する。
+        """
+        self.eval()
+        if not isinstance(self.decoder.binarize, LowResBinarize):
+            self.decoder.binarize = LowResBinarize(self.decoder.binarize)
+
+        if hasattr(self.decoder, "thresh"):
+            del self.decoder.thresh
+        return self
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 from functools import partial
 from typing import Optional, Sequence
 
@@ -21,6 +22,7 @@ import torch.nn as nn
 from huggingface_hub import PyTorchModelHubMixin
 from timm.models.helpers import named_apply
 from torch import Tensor
+from torch.nn import functional as F
 
 from .layers.parseq_transformer import Decoder, Encoder, TokenEmbedding
 
@@ -228,3 +230,174 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
                 logits = self.head(tgt_out)
 
         return logits
+
+
+def _in_projection(attn: nn.MultiheadAttention, x: Tensor, index: int):
+    """Project x with the query(0), key(1) or value(2) weights of the attention."""
+    embed_dim = attn.embed_dim
+    weight = attn.in_proj_weight[index * embed_dim : (index + 1) * embed_dim]
+    bias = attn.in_proj_bias[index * embed_dim : (index + 1) * embed_dim]
+    return F.linear(x, weight, bias)
+
+
+def _attention(attn: nn.MultiheadAttention, q: Tensor, k: Tensor, v: Tensor):
+    """Multi-head attention on already projected queries, keys and values."""
+    N = q.shape[0]
+    num_heads = attn.num_heads
+    head_dim = attn.embed_dim // num_heads
+
+    q = q.reshape(N, -1, num_heads, head_dim).transpose(1, 2)
+    k = k.reshape(N, -1, num_heads, head_dim).transpose(1, 2)
+    v = v.reshape(N, -1, num_heads, head_dim).transpose(1, 2)
+
+    weights = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(head_dim), dim=-1)
+    out = (weights @ v).transpose(1, 2).reshape(N, -1, attn.embed_dim)
+    return attn.out_proj(out)
+
+
+class PARSeqEncoder(nn.Module):
+    """
+    Encoder of PARSeq for ONNX export.
+    The keys and values of the cross attention are projected here once per image
+    instead of at every decoding step.
+    """
+
+    def __init__(self, model: PARSeq):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images: Tensor):
+        memory = self.model.encode(images)
+        cross_k = torch.stack(
+            [
+                _in_projection(layer.cross_attn, memory, 1)
+                for layer in self.model.decoder.layers
+            ]
+        )
+        cross_v = torch.stack(
+            [
+                _in_projection(layer.cross_attn, memory, 2)
+                for layer in self.model.decoder.layers
+            ]
+        )
+        return memory, cross_k, cross_v
+
+
+class PARSeqDecoderStep(nn.Module):
+    """
+    One step of the autoregressive decoding of PARSeq for ONNX export.
+    The self attention keys and values of the preceding tokens are passed as a
+    cache, so that each step only processes the newest token. This is
+    equivalent to `PARSeq.forward()` because the content stream is causal.
+    """
+
+    def __init__(self, model: PARSeq):
+        super().__init__()
+        self.model = model
+
+    def stream(self, layer, tgt, tgt_norm, k, v, cross_k, cross_v):
+        q = _in_projection(layer.self_attn, tgt_norm, 0)
+        tgt = tgt + _attention(layer.self_attn, q, k, v)
+
+        q = _in_projection(layer.cross_attn, layer.norm1(tgt), 0)
+        tgt = tgt + _attention(layer.cross_attn, q, cross_k, cross_v)
+
+        tgt2 = layer.linear2(layer.activation(layer.linear1(layer.norm2(tgt))))
+        return tgt + tgt2
+
+    def forward(
+        self,
+        tokens: Tensor,
+        step: Tensor,
+        cross_k: Tensor,
+        cross_v: Tensor,
+        past_k: Tensor,
+        past_v: Tensor,
+    ):
+        """
+        Args:
+            tokens (Tensor): the token at the current position (N, 1)
+            step (Tensor): the current position (1,)
+            cross_k, cross_v (Tensor): outputs of `PARSeqEncoder` (L, N, S, E)
+            past_k, past_v (Tensor): cache of the preceding tokens (L, N, step, E)
+
+        Returns:
+            Tuple[Tensor, Tensor, Tensor]: logits of the next token (N, 1, C) and
+            the updated cache (L, N, step + 1, E)
+        """
+        model = self.model
+        N = tokens.shape[0]
+        pos_queries = model.pos_queries[0]
+
+        # <bos> stands for the null context and has no position information.
+        content = model.text_embed(tokens)
+        has_position = (step > 0).to(content.dtype)
+        content = content + pos_queries[(step - 1).clamp(min=0)] * has_position
+        query = pos_queries[step].unsqueeze(0).expand(N, -1, -1)
+
+        present_k, present_v = [], []
+        layers = model.decoder.layers
+        for i, layer in enumerate(layers):
+            content_norm = layer.norm_c(content)
+            k = torch.cat(
+                [past_k[i], _in_projection(layer.self_attn, content_norm, 1)], 1
+            )
+            v = torch.cat(
+                [past_v[i], _in_projection(layer.self_attn, content_norm, 2)], 1
+            )
+            present_k.append(k)
+            present_v.append(v)
+
+            query = self.stream(
+                layer, query, layer.norm_q(query), k, v, cross_k[i], cross_v[i]
+            )
+            if i < len(layers) - 1:
+                content = self.stream(
+                    layer, content, content_norm, k, v, cross_k[i], cross_v[i]
+                )
+
+        logits = model.head(model.decoder.norm(query))
+        return logits, torch.stack(present_k), torch.stack(present_v)
+
+
+class PARSeqRefiner(nn.Module):
+    """
+    Iterative refinement of PARSeq for ONNX export. All positions are queried
+    with the cloze mask given the tokens predicted by the decoding.
+    """
+
+    def __init__(self, model: PARSeq):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens: Tensor, memory: Tensor):
+        model = self.model
+        N, L = tokens.shape
+        num_steps = model.pos_queries.shape[1]
+
+        pos_queries = model.pos_queries.expand(N, -1, -1)
+        # Same mask as the refinement of `PARSeq.forward()`.
+        query_mask = torch.triu(
+            torch.ones(num_steps, num_steps, dtype=torch.bool, device=tokens.device),
+            1,
+        )
+        query_mask[
+            torch.triu(
+                torch.ones(
+                    num_steps, num_steps, dtype=torch.int64, device=tokens.device
+                ),
+                2,
+            )
+        ] = 0
+
+        # Mask tokens beyond the first EOS token.
+        padding_mask = (tokens == model.tokenizer.eos_id).int().cumsum(-1) > 0
+        tgt_out = model.decode(
+            tokens,
+            memory,
+            query_mask[:L, :L],
+            padding_mask,
+            pos_queries,
+            query_mask[:, :L],
+        )
+        return model.head(tgt_out)
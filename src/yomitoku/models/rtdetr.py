@@ -1,11 +1,26 @@
+import torch
 import torch.nn as nn
 from huggingface_hub import PyTorchModelHubMixin
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
-from .layers.rtdetr_backbone import PResNet
-from .layers.rtdetr_hybrid_encoder import HybridEncoder
+from .layers.rtdetr_backbone import FrozenBatchNorm2d, PResNet
+from .layers.rtdetr_hybrid_encoder import HybridEncoder, RepVggBlock
 from .layers.rtdetrv2_decoder import RTDETRTransformerv2
 
 
+def fuse_conv_norm(module):
+    """conv, normの組を持つ層について、BatchNormを畳み込みの重みとバイアスに畳み込む"""
+    for m in list(module.modules()):
+        conv = getattr(m, "conv", None)
+        norm = getattr(m, "norm", None)
+        if isinstance(conv, nn.Conv2d) and isinstance(
+            norm, (nn.BatchNorm2d, FrozenBatchNorm2d)
+        ):
+            m.conv = fuse_conv_bn_eval(conv, norm)
+            m.norm = nn.Identity()
+    return module
+
+
 class RTDETRv2(nn.Module, PyTorchModelHubMixin):
     def __init__(self, cfg):
         super().__init__()
@@ -20,3 +35,38 @@ class RTDETRv2(nn.Module, PyTorchModelHubMixin):
         x = self.decoder(x, targets)
 
         return x
+
+    @torch.no_grad()
+    def deploy(self):
+        """
+        推論用の構造に変換する。RepVGGの分岐を1つの3x3畳み込みに統合し、
+        BatchNorm(PResNetのFrozenBatchNorm2dを含む)を直前の畳み込みに畳み込む。
+        学習済みの重みを読み込んだ後に呼び出すこと。
+        """
+        self.eval()
+        for m in list(self.modules()):
+            if isinstance(m, RepVggBlock) and not hasattr(m, "conv"):
+                m.convert_to_deploy()
+                del m.conv1, m.conv2
+
+        fuse_conv_norm(self)
+        return self
+
+
+class RTDETRv2Deploy(nn.Module):
+    """
+    deploy構造のRT-DETRv2と、deployモードの後処理をまとめたモデル。
+    ボックスは入力画像サイズで正規化したxyxy形式で出力し、スコアのしきい値処理と
+    元画像の座標への変換はモデルの外で行う。
+    """
+
+    def __init__(self, model, postprocessor):
+        super().__init__()
+        self.model = model.deploy()
+        self.postprocessor = postprocessor.deploy()
+
+    def forward(self, x):
+        outputs = self.model(x)
+        orig_target_sizes = torch.ones(x.shape[0], 2, device=x.device)
+        labels, boxes, scores = self.postprocessor(outputs, orig_target_sizes, None)
+        return {"labels": labels, "boxes": boxes, "scores": scores}
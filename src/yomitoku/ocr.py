@@ -1,11 +1,15 @@
 from typing import List
 
+import numpy as np
 from pydantic import conlist
 
 from yomitoku.text_detector import TextDetector
 from yomitoku.text_recognizer import TextRecognizer
 
-from .base import BaseSchema
+from .base import BaseRecord, BaseSchema
+from .constants import DIRECTIONS
+from .data.page import as_page
+from .utils.misc import quads_to_xyxy
 
 
 class WordPrediction(BaseSchema):
@@ -24,6 +28,59 @@ class OCRSchema(BaseSchema):
     words: List[WordPrediction]
 
 
+class OCRResultArrays(BaseRecord):
+    """
+    Columnar OCR result. The i-th word is described by the i-th entry of each field.
+
+    points: (N, 4, 2) int32, quadrilaterals sorted clockwise
+    det_scores: (N,) float64
+    rec_scores: (N,) float64
+    directions: (N,) uint8, index of `DIRECTIONS`
+    contents: list of N strings
+    """
+
+    __slots__ = ("points", "det_scores", "rec_scores", "directions", "contents")
+    schema = OCRSchema
+
+    def __len__(self):
+        return len(self.contents)
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            points=np.zeros((0, 4, 2), dtype=np.int32),
+            det_scores=np.zeros(0, dtype=np.float64),
+            rec_scores=np.zeros(0, dtype=np.float64),
+            directions=np.zeros(0, dtype=np.uint8),
+            contents=[],
+        )
+
+    def boxes(self):
+        """(N, 4) int32 bounding boxes (x1, y1, x2, y2) of the words"""
+        return quads_to_xyxy(self.points)
+
+    def to_words(self):
+        return [
+            WordPrediction.model_construct(
+                points=points,
+                content=content,
+                direction=DIRECTIONS[direction],
+                det_score=det_score,
+                rec_score=rec_score,
+            )
+            for points, content, direction, det_score, rec_score in zip(
+                self.points.tolist(),
+                self.contents,
+                self.directions.tolist(),
+                self.det_scores.tolist(),
+                self.rec_scores.tolist(),
+            )
+        ]
+
+    def to_schema(self):
+        return self.schema.model_construct(words=self.to_words())
+
+
 class OCR:
     def __init__(self, configs=None, device="cuda", visualize=False):
         text_detector_kwargs = {
@@ -53,35 +110,28 @@ class OCR:
         self.recognizer = TextRecognizer(**text_recognizer_kwargs)
 
     def aggregate(self, det_outputs, rec_outputs):
-        words = []
-        for points, det_score, pred, rec_score, direction in zip(
-            det_outputs.points,
-            det_outputs.scores,
-            rec_outputs.contents,
-            rec_outputs.scores,
-            rec_outputs.directions,
-        ):
-            words.append(
-                {
-                    "points": points,
-                    "content": pred,
-                    "direction": direction,
-                    "det_score": det_score,
-                    "rec_score": rec_score,
-                }
-            )
-        return words
-
-    def __call__(self, img):
+        return OCRResultArrays(
+            points=np.asarray(det_outputs.points, dtype=np.int32).reshape(-1, 4, 2),
+            det_scores=np.asarray(det_outputs.scores, dtype=np.float64),
+            rec_scores=np.asarray(rec_outputs.scores, dtype=np.float64),
+            directions=np.asarray(rec_outputs.directions, dtype=np.uint8),
+            contents=list(rec_outputs.contents),
+        )
+
+    def predict(self, img):
         """_summary_
 
         Args:
-            img (np.ndarray): cv2 image(BGR)
+            img (np.ndarray | Page): cv2 image(BGR)
         """
 
-        det_outputs, vis = self.detector(img)
-        rec_outputs, vis = self.recognizer(img, det_outputs.points, vis=vis)
+        page = as_page(img)
+        det_outputs, vis = self.detector.predict(page)
+        rec_outputs, vis = self.recognizer.predict(page, det_outputs.points, vis=vis)
 
-        outputs = {"words": self.aggregate(det_outputs, rec_outputs)}
-        results = OCRSchema(**outputs)
+        results = self.aggregate(det_outputs, rec_outputs)
         return results, vis
+
+    def __call__(self, img):
+        results, vis = self.predict(img)
+        return results.to_schema(), vis
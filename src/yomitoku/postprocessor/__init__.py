@@ -1,9 +1,15 @@
 from .dbnet_postporcessor import DBnetPostProcessor
 from .parseq_tokenizer import ParseqTokenizer
-from .rtdetr_postprocessor import RTDETRPostProcessor
+from .rtdetr_postprocessor import (
+    RTDETRPostProcessor,
+    filter_detections,
+    merge_detections,
+)
 
 __all__ = [
     "DBnetPostProcessor",
     "RTDETRPostProcessor",
     "ParseqTokenizer",
+    "filter_detections",
+    "merge_detections",
 ]
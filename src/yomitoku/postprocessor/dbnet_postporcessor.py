@@ -4,14 +4,33 @@ import numpy as np
 import pyclipper
 from shapely.geometry import Polygon
 
+from ..utils.misc import calc_iou_matrix
+
 
 class DBnetPostProcessor:
-    def __init__(self, min_size, thresh, box_thresh, max_candidates, unclip_ratio):
+    def __init__(
+        self,
+        min_size,
+        thresh,
+        box_thresh,
+        max_candidates,
+        unclip_ratio,
+        stride=1,
+        refine_samples=5,
+    ):
+        """
+        Args:
+            stride (int): 確率マップに対する入力画像の解像度の比。
+                1より大きい場合は、矩形の辺をサブピクセル精度で補正してから入力画像の座標に変換する
+            refine_samples (int): 辺の補正で確率を調べる法線の本数
+        """
         self.min_size = min_size
         self.thresh = thresh
         self.box_thresh = box_thresh
         self.max_candidates = max_candidates
         self.unclip_ratio = unclip_ratio
+        self.stride = stride
+        self.refine_samples = refine_samples
 
     def __call__(self, preds, image_size):
         """
@@ -20,7 +39,7 @@ class DBnetPostProcessor:
             thresh: [if exists] thresh hold prediction with shape (N, H, W)
             thresh_binary: [if exists] binarized with threshhold, (N, H, W)
         """
-        pred = preds["binary"][0]
+        pred = preds["binary"][0].float()
         segmentation = self.binarize(pred)[0]
         height, width = image_size
         quads, scores = self.boxes_from_bitmap(pred, segmentation, width, height)
@@ -33,13 +52,35 @@ class DBnetPostProcessor:
         """
         _bitmap: single map with shape (H, W),
             whose values are binarized as {0, 1}
+
+        returns:
+            boxes: quadrilaterals with shape (N, 4, 2), int32
+            scores: box scores with shape (N,), float64
         """
 
         assert len(_bitmap.shape) == 2
+        height, width = _bitmap.shape
+        regions, scores = self.candidates(pred, _bitmap)
+        return self.expand_boxes(
+            regions,
+            scores,
+            width * self.stride,
+            height * self.stride,
+            dest_width,
+            dest_height,
+        )
+
+    def candidates(self, pred, _bitmap):
+        """
+        確率マップの輪郭から、拡大前の文字領域の矩形とスコアを求める。
+
+        returns:
+            regions: 入力画像の座標の矩形 (N, 4, 2), float32
+            scores: box scores with shape (N,), float64
+        """
         bitmap = _bitmap.cpu().numpy()  # The first channel
 
         pred = pred.cpu().detach().numpy()[0]
-        height, width = bitmap.shape
         contours, _ = cv2.findContours(
             (bitmap * 255).astype(np.uint8),
             cv2.RETR_LIST,
@@ -50,37 +91,248 @@ class DBnetPostProcessor:
 
         boxes = []
         scores = []
-        for index in range(num_contours):
-            contour = contours[index].squeeze(1)
-            points, sside = self.get_mini_boxes(contour)
+        contours = [contours[index].squeeze(1) for index in range(num_contours)]
+        regions = contours
+        if self.stride > 1 and num_contours > 0:
+            # 低解像度の輪郭の外接矩形を補正し、入力画像の画素の中心の座標に変換する
+            regions = self.refine_boxes(pred, contours)
+            regions = regions * self.stride + (self.stride - 1) / 2
+
+        for contour, region in zip(contours, regions):
+            points, sside = self.get_mini_boxes(region)
 
             if sside < self.min_size:
                 continue
-            points = np.array(points)
             score = self.box_score_fast(pred, contour)
 
             if self.box_thresh > score:
                 continue
 
+            boxes.append(points)
+            scores.append(score)
+
+        boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4, 2)
+        scores = np.array(scores, dtype=np.float64)
+        return boxes, scores
+
+    def expand_boxes(self, regions, scores, width, height, dest_width, dest_height):
+        """
+        文字領域の矩形を拡大し、幅`width`、高さ`height`の入力画像の座標から
+        出力先の画像の座標に変換する。
+        """
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+
+        boxes = []
+        keep = []
+        for i, points in enumerate(regions):
             box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
             box, sside = self.get_mini_boxes(box)
             if sside < self.min_size + 2:
                 continue
             box = np.array(box)
-            if not isinstance(dest_width, int):
-                dest_width = dest_width.item()
-                dest_height = dest_height.item()
 
             box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
             box[:, 1] = np.clip(
                 np.round(box[:, 1] / height * dest_height), 0, dest_height
             )
 
-            boxes.append(box.astype(np.int16).tolist())
-            scores.append(score)
+            boxes.append(box.astype(np.int32))
+            keep.append(i)
 
+        boxes = np.array(boxes, dtype=np.int32).reshape(-1, 4, 2)
+        scores = np.array(scores, dtype=np.float64)[keep]
         return boxes, scores
 
+    def tile_candidates(self, pred, offset):
+        """
+        タイルの確率マップから、ページの座標の拡大前の矩形とスコアを求める。
+
+        Args:
+            pred (torch.Tensor): タイルの確率マップ (1, H, W)
+            offset (tuple): ページにおけるタイルの左上の座標 (x, y)
+        """
+        segmentation = self.binarize(pred)[0]
+        regions, scores = self.candidates(pred, segmentation)
+        return regions + np.array(offset, dtype=np.float32), scores
+
+    def merge_tiles(self, candidates, tiles, page_size, image_size, merge_iou=0.3):
+        """
+        タイルごとの矩形を統合する。隣接するタイルの重なり領域に切り取った矩形の
+        IoUが`merge_iou`以上の矩形は、タイルの境界で分割された同じ文字列、または
+        重なり領域で重複して検出された文字列とみなし、全体を囲む矩形に統合してから拡大する。
+
+        Args:
+            candidates (list): タイルごとの`tile_candidates()`の結果
+            tiles (list): ページにおけるタイルの範囲 (x0, y0, x1, y1)
+            page_size (tuple): タイルに分割したページの大きさ (height, width)
+            image_size (tuple): 出力先の画像の大きさ (height, width)
+        """
+        regions = [region for region, _ in candidates]
+        scores = [score for _, score in candidates]
+        offsets = np.cumsum([0] + [len(region) for region in regions])
+        regions = np.concatenate(regions).reshape(-1, 4, 2)
+        scores = np.concatenate(scores)
+
+        parent = np.arange(len(regions))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        xyxy = np.concatenate([regions.min(axis=1), regions.max(axis=1)], axis=1)
+        for i, j in zip(*np.triu_indices(len(tiles), k=1)):
+            overlap = np.concatenate(
+                [
+                    np.maximum(tiles[i][:2], tiles[j][:2]),
+                    np.minimum(tiles[i][2:], tiles[j][2:]),
+                ]
+            )
+            if np.any(overlap[:2] >= overlap[2:]):
+                continue
+
+            index_i = np.arange(offsets[i], offsets[i + 1])
+            index_j = np.arange(offsets[j], offsets[j + 1])
+            if len(index_i) == 0 or len(index_j) == 0:
+                continue
+
+            clipped_i = clip_boxes(xyxy[index_i], overlap)
+            clipped_j = clip_boxes(xyxy[index_j], overlap)
+            iou = calc_iou_matrix(clipped_i, clipped_j)
+            for a, b in zip(*np.nonzero(iou >= merge_iou)):
+                parent[find(index_i[a])] = find(index_j[b])
+
+        groups = {}
+        for i in range(len(regions)):
+            groups.setdefault(find(i), []).append(i)
+
+        merged = []
+        merged_scores = []
+        for group in groups.values():
+            points = regions[group].reshape(-1, 2)
+            box, _ = self.get_mini_boxes(points)
+            areas = np.prod(xyxy[group, 2:] - xyxy[group, :2], axis=1)
+            merged.append(box)
+            merged_scores.append(np.average(scores[group], weights=areas + 1e-6))
+
+        height, width = page_size
+        dest_height, dest_width = image_size
+        return self.expand_boxes(
+            np.array(merged, dtype=np.float32).reshape(-1, 4, 2),
+            merged_scores,
+            width,
+            height,
+            dest_width,
+            dest_height,
+        )
+
+    def refine_boxes(self, pred, contours, search=1.5, steps=13):
+        """
+        確率マップをバイリニア補間し、輪郭の外接矩形の各辺の法線に沿って確率がしきい値を
+        下回る位置をサブピクセル精度で求め、辺をその位置に移動する。
+        輪郭は境界の画素の中心を通るため、辺は境界の画素の中心から半画素(入力画像の解像度)の
+        位置を基準とする。
+
+        Args:
+            pred (np.ndarray): 確率マップ (H, W)
+            contours (list): 輪郭のリスト
+            search (float): 辺の前後に探索する範囲(確率マップの画素単位)
+            steps (int): 探索範囲のサンプル数
+
+        returns:
+            boxes: 補正した矩形の頂点 (N, 4, 2)
+        """
+        rects = [cv2.minAreaRect(contour) for contour in contours]
+        center = np.array([rect[0] for rect in rects], dtype=np.float64).reshape(-1, 2)
+        size = np.array([rect[1] for rect in rects], dtype=np.float64).reshape(-1, 2)
+        theta = np.deg2rad([rect[2] for rect in rects])
+
+        u = np.stack([np.cos(theta), np.sin(theta)], axis=-1)
+        v = np.stack([-np.sin(theta), np.cos(theta)], axis=-1)
+
+        # 各辺の法線、中心からの距離、辺に沿った方向と辺の半分の長さ (N, 4, ...)
+        normal = np.stack([u, -u, v, -v], axis=1)
+        tangent = np.stack([v, v, u, u], axis=1)
+        dist = size[:, [0, 0, 1, 1]] / 2
+        half = size[:, [1, 1, 0, 0]] / 2
+
+        offset = np.full(dist.shape, np.nan)
+        if self.refine_samples > 0:
+            offset = self.edge_offsets(
+                pred, center, normal, tangent, dist, half, search, steps
+            )
+
+        # 境界が見つからない場合は、境界の画素と外側の画素の中間を辺とする
+        offset = np.where(np.isnan(offset), 0.5, offset)
+        # 平均プーリングした確率マップでは、しきい値が0.5未満の場合に
+        # 境界が外側にずれるため、段差状の境界を仮定して補正する
+        bias = (0.5 - self.thresh) + 0.5 / self.stride
+        dist = np.maximum(dist + offset - bias, 0.0)
+
+        center = (
+            center
+            + (dist[:, 0] - dist[:, 1])[:, None] / 2 * u
+            + (dist[:, 2] - dist[:, 3])[:, None] / 2 * v
+        )
+        half_u = (dist[:, 0] + dist[:, 1])[:, None, None] / 2 * u[:, None]
+        half_v = (dist[:, 2] + dist[:, 3])[:, None, None] / 2 * v[:, None]
+        signs = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+        boxes = (
+            center[:, None]
+            + signs[None, :, 0, None] * half_u
+            + signs[None, :, 1, None] * half_v
+        )
+        return boxes.astype(np.float32)
+
+    def edge_offsets(self, pred, center, normal, tangent, dist, half, search, steps):
+        """
+        矩形の各辺の法線に沿って、確率がしきい値を下回る位置の辺からのずれを求める。
+        境界が見つからない辺はnanとする。
+        """
+        offsets = np.linspace(-search, search, steps)
+        positions = np.linspace(-1, 1, self.refine_samples + 2)[1:-1]
+        positions = half[..., None] * positions
+
+        # サンプル点 (N, 4, samples, steps, 2)
+        grid = (
+            center[:, None, None, None]
+            + positions[..., None, None] * tangent[:, :, None, None]
+            + (dist[..., None, None] + offsets)[..., None] * normal[:, :, None, None]
+        ).astype(np.float32)
+        grid = grid.reshape(len(center) * 4, -1, 2)
+
+        profile = cv2.remap(
+            pred.astype(np.float32),
+            np.ascontiguousarray(grid[..., 0]),
+            np.ascontiguousarray(grid[..., 1]),
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        ).reshape(len(center), 4, self.refine_samples, steps)
+
+        # 内側から外側に向かって最後にしきい値を上回る位置と、
+        # その次の位置の間で線形補間する
+        inside = profile > self.thresh
+        crossing = inside[..., :-1] & ~inside[..., 1:]
+        found = crossing.any(axis=-1)
+        k = steps - 2 - np.argmax(crossing[..., ::-1], axis=-1)
+
+        upper = np.take_along_axis(profile, k[..., None], axis=-1)[..., 0]
+        lower = np.take_along_axis(profile, k[..., None] + 1, axis=-1)[..., 0]
+        ratio = (upper - self.thresh) / np.maximum(upper - lower, 1e-6)
+        crossings = offsets[k] + ratio * (offsets[1] - offsets[0])
+
+        # 各辺で境界が見つかった法線の中央値を採用する
+        count = found.sum(axis=-1)
+        crossings = np.sort(np.where(found, crossings, np.inf), axis=-1)
+        median = np.take_along_axis(
+            crossings, (np.maximum(count, 1)[..., None] - 1) // 2, axis=-1
+        )[..., 0]
+        return np.where(count > 0, median, np.nan)
+
     def unclip(self, box, unclip_ratio=7):
         # 小さい文字が見切れやすい、大きい文字のマージンが過度に大きくなる等の課題がある
         # 対応として、文字の大きさに応じて、拡大パラメータを動的に変更する
@@ -136,3 +388,10 @@ class DBnetPostProcessor:
         box[:, 1] = box[:, 1] - ymin
         cv2.fillPoly(mask, box.reshape(1, -1, 2).astype(np.int32), 1)
         return cv2.mean(bitmap[ymin : ymax + 1, xmin : xmax + 1], mask)[0]
+
+
+def clip_boxes(boxes, region):
+    """矩形 (N, 4) を領域 (x0, y0, x1, y1) の内側に切り取る。"""
+    lt = np.clip(boxes[:, :2], region[:2], region[2:])
+    rb = np.clip(boxes[:, 2:], region[:2], region[2:])
+    return np.concatenate([lt, rb], axis=1)
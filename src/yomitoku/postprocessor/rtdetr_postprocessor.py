@@ -13,17 +13,101 @@
 # limitations under the License.
 
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 
+from ..utils.misc import calc_iou_matrix
+
 
 def mod(a, b):
     out = a - a // b * b
     return out
 
 
+def filter_detections(preds, orig_target_sizes, threshold):
+    """
+    deployモードの後処理の出力(正規化したxyxy形式のボックス)を元画像の座標に変換し、
+    スコアがしきい値を超える検出結果を画像ごとに返す
+
+    Args:
+        preds (dict): labels, boxes, scoresのテンソル
+        orig_target_sizes (list): 元画像の(幅, 高さ)のリスト
+        threshold (float): スコアのしきい値
+    """
+    sizes = np.asarray(orig_target_sizes, dtype=np.float32).reshape(-1, 2)
+
+    results = []
+    for lab, box, sco, size in zip(
+        preds["labels"], preds["boxes"], preds["scores"], sizes
+    ):
+        lab = lab.cpu().numpy().astype(np.int64)
+        box = box.cpu().numpy()
+        sco = sco.cpu().numpy()
+
+        keep = sco > threshold
+        result = dict(
+            labels=lab[keep],
+            boxes=box[keep] * np.tile(size, 2),
+            scores=sco[keep],
+        )
+        results.append(result)
+
+    return results
+
+
+def merge_detections(results, iou_threshold=0.55, method="wbf"):
+    """
+    複数の領域(タイル)の検出結果を統合する。カテゴリごとにスコアの高い順に、
+    IoUが`iou_threshold`以上の検出結果をまとめ、`method`が"nms"の場合は最もスコアの
+    高いボックスを、"wbf"の場合はスコアで重み付けした平均のボックスを採用する。
+    スコアはまとめた検出結果の最大値とする。
+
+    Args:
+        results (list): `filter_detections()`と同じ形式の検出結果のリスト
+        iou_threshold (float): 同じ物体とみなすIoUのしきい値
+        method (str): "wbf" or "nms"
+    """
+    if method not in ("wbf", "nms"):
+        raise ValueError(f"Invalid merge method: {method}. Supported are wbf, nms")
+
+    labels = np.concatenate([r["labels"] for r in results]).astype(np.int64)
+    boxes = np.concatenate([r["boxes"] for r in results]).reshape(-1, 4)
+    scores = np.concatenate([r["scores"] for r in results])
+
+    merged = dict(labels=[], boxes=[], scores=[])
+    order = np.argsort(-scores, kind="stable")
+    for label in np.unique(labels):
+        index = order[labels[order] == label]
+        iou = calc_iou_matrix(boxes[index], boxes[index])
+
+        assigned = np.zeros(len(index), dtype=bool)
+        for k in range(len(index)):
+            if assigned[k]:
+                continue
+
+            members = np.nonzero((iou[k] >= iou_threshold) & ~assigned)[0]
+            members = np.union1d(members, [k])
+            assigned[members] = True
+
+            box = boxes[index[k]]
+            if method == "wbf":
+                weights = scores[index[members]]
+                box = np.average(boxes[index[members]], axis=0, weights=weights)
+
+            merged["labels"].append(label)
+            merged["boxes"].append(box)
+            merged["scores"].append(scores[index[k]])
+
+    return dict(
+        labels=np.array(merged["labels"], dtype=np.int64),
+        boxes=np.array(merged["boxes"], dtype=np.float32).reshape(-1, 4),
+        scores=np.array(merged["scores"], dtype=np.float32),
+    )
+
+
 class RTDETRPostProcessor(nn.Module):
     __share__ = [
         "num_classes",
@@ -51,7 +135,8 @@ class RTDETRPostProcessor(nn.Module):
 
     # def forward(self, outputs, orig_target_sizes):
     def forward(self, outputs, orig_target_sizes: torch.Tensor, threshold):
-        logits, boxes = outputs["pred_logits"], outputs["pred_boxes"]
+        # スコアの計算とtopkは精度の影響を受けやすいため、fp32で行う
+        logits, boxes = outputs["pred_logits"].float(), outputs["pred_boxes"].float()
         # orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
 
         bbox_pred = torchvision.ops.box_convert(boxes, in_fmt="cxcywh", out_fmt="xyxy")
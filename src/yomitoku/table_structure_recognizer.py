@@ -1,22 +1,21 @@
 from typing import List, Union
 
-import cv2
-import os
-import onnx
-import onnxruntime
+import numpy as np
 import torch
-import torchvision.transforms as T
-from PIL import Image
 from pydantic import conlist
 
-from .constants import ROOT_DIR
-
-from .base import BaseModelCatalog, BaseModule, BaseSchema
+from .base import BaseModelCatalog, BaseModule, BaseRecord, BaseSchema
 from .configs import TableStructureRecognizerRTDETRv2Config
+from .data.functions import resize_to_tensor
+from .data.page import as_page
 from .layout_parser import filter_contained_rectangles_within_category
-from .models import RTDETRv2
-from .postprocessor import RTDETRPostProcessor
-from .utils.misc import calc_intersection, filter_by_flag, is_contained
+from .models import RTDETRv2, RTDETRv2Deploy
+from .postprocessor import RTDETRPostProcessor, filter_detections
+from .utils.misc import (
+    calc_intersection_matrix,
+    filter_by_flag,
+    is_contained_matrix,
+)
 from .utils.visualizer import table_visualizer
 
 
@@ -43,49 +42,56 @@ class TableStructureRecognizerSchema(BaseSchema):
     order: int
 
 
+class TableCellRecord(BaseRecord):
+    __slots__ = ("col", "row", "col_span", "row_span", "box", "contents")
+    schema = TableCellSchema
+
+
+class TableStructureRecognizerRecord(BaseRecord):
+    __slots__ = ("box", "n_row", "n_col", "cells", "order")
+    schema = TableStructureRecognizerSchema
+
+
 def extract_cells(row_boxes, col_boxes):
-    cells = []
-    for i, row_box in enumerate(row_boxes):
-        for j, col_box in enumerate(col_boxes):
-            intersection = calc_intersection(row_box, col_box)
-            if intersection is None:
-                continue
+    intersections, is_intersected = calc_intersection_matrix(row_boxes, col_boxes)
 
-            cells.append(
-                {
-                    "col": j + 1,
-                    "row": i + 1,
-                    "col_span": 1,
-                    "row_span": 1,
-                    "box": intersection,
-                    "contents": None,
-                }
-            )
+    cells = []
+    for i, j in zip(*np.nonzero(is_intersected)):
+        cells.append(
+            {
+                "col": int(j) + 1,
+                "row": int(i) + 1,
+                "col_span": 1,
+                "row_span": 1,
+                "box": intersections[i, j].tolist(),
+                "contents": None,
+            }
+        )
 
     return cells
 
 
 def filter_contained_cells_within_spancell(cells, span_boxes):
-    check_list = [True] * len(cells)
-    child_boxes = [[] for _ in range(len(span_boxes))]
-    for i, span_box in enumerate(span_boxes):
-        for j, sub_cell in enumerate(cells):
-            if is_contained(span_box, sub_cell["box"]):
-                check_list[j] = False
-                child_boxes[i].append(sub_cell)
+    cell_boxes = [cell["box"] for cell in cells]
+    contained = is_contained_matrix(span_boxes, cell_boxes)
+
+    check_list = (~contained.any(axis=0)).tolist()
+    rows = np.array([cell["row"] for cell in cells], dtype=np.int64)
+    cols = np.array([cell["col"] for cell in cells], dtype=np.int64)
 
     cells = filter_by_flag(cells, check_list)
 
     for i, span_box in enumerate(span_boxes):
-        child_box = child_boxes[i]
+        child_rows = rows[contained[i]]
+        child_cols = cols[contained[i]]
 
-        if len(child_box) == 0:
+        if len(child_rows) == 0:
             continue
 
-        row = min([box["row"] for box in child_box])
-        col = min([box["col"] for box in child_box])
-        row_span = max([box["row"] for box in child_box]) - row + 1
-        col_span = max([box["col"] for box in child_box]) - col + 1
+        row = int(child_rows.min())
+        col = int(child_cols.min())
+        row_span = int(child_rows.max()) - row + 1
+        col_span = int(child_cols.max()) - col + 1
 
         span_box = list(map(int, span_box))
 
@@ -106,6 +112,9 @@ def filter_contained_cells_within_spancell(cells, span_boxes):
 
 class TableStructureRecognizer(BaseModule):
     model_catalog = TableStructureRecognizerModelCatalog()
+    onnx_opset = 16
+    postprocess_config_keys = ("thresh_score", "category", "visualize")
+    quantize_modules = ("encoder.encoder", "decoder.decoder")
 
     def __init__(
         self,
@@ -115,30 +124,30 @@ class TableStructureRecognizer(BaseModule):
         visualize=False,
         from_pretrained=True,
         infer_onnx=False,
+        quantize=None,
+        compile=False,
     ):
         super().__init__()
+        if infer_onnx and quantize is not None:
+            raise ValueError("quantize is not supported with infer_onnx.")
+
         self.load_model(
             model_name,
             path_cfg,
             from_pretrained=from_pretrained,
+            quantize=quantize,
         )
         self.device = device
         self.visualize = visualize
 
-        self.model.eval()
-        self.model.to(self.device)
-
-        self.postprocessor = RTDETRPostProcessor(
+        # RepVGGの分岐とBatchNormを畳み込みに統合し、後処理をモデルに含める
+        postprocessor = RTDETRPostProcessor(
             num_classes=self._cfg.RTDETRTransformerv2.num_classes,
             num_top_queries=self._cfg.RTDETRTransformerv2.num_queries,
         )
-
-        self.transforms = T.Compose(
-            [
-                T.Resize(self._cfg.data.img_size),
-                T.ToTensor(),
-            ]
-        )
+        self.model = RTDETRv2Deploy(self.model, postprocessor)
+        self.model.eval()
+        self.model.to(self.device)
 
         self.thresh_score = self._cfg.thresh_score
 
@@ -147,52 +156,50 @@ class TableStructureRecognizer(BaseModule):
         }
 
         self.infer_onnx = infer_onnx
+        self.set_precision(self._cfg.precision)
         if infer_onnx:
-            name = self._cfg.hf_hub_repo.split("/")[-1]
-            path_onnx = f"{ROOT_DIR}/onnx/{name}.onnx"
-            if not os.path.exists(path_onnx):
-                self.convert_onnx(path_onnx)
-
-            model = onnx.load(path_onnx)
-            if torch.cuda.is_available() and device == "cuda":
-                self.sess = onnxruntime.InferenceSession(
-                    model.SerializeToString(), providers=["CUDAExecutionProvider"]
-                )
-            else:
-                self.sess = onnxruntime.InferenceSession(model.SerializeToString())
+            self.load_onnx()
 
-    def convert_onnx(self, path_onnx):
-        dynamic_axes = {
-            "input": {0: "batch_size"},
-            "output": {0: "batch_size"},
-        }
+        if compile or self._cfg.compile:
+            self.compile_model()
+            self.warmup()
 
-        img_size = self._cfg.data.img_size
-        dummy_input = torch.randn(1, 3, *img_size, requires_grad=True)
+    def convert_onnx(self, path_onnx):
+        # 入力は常に1枚の画像を固定サイズにリサイズしたものであるため、静的な形状で
+        # 変換し、形状に依存する演算を定数畳み込みで除去する
+        dummy_input = torch.randn(*self.onnx_input_shape())
 
         torch.onnx.export(
             self.model,
             dummy_input,
             path_onnx,
-            opset_version=16,
+            opset_version=self.onnx_opset,
             input_names=["input"],
-            output_names=["pred_logits", "pred_boxes"],
-            dynamic_axes=dynamic_axes,
+            output_names=["labels", "boxes", "scores"],
+            do_constant_folding=True,
+            dynamo=False,
         )
 
+    def warmup_shapes(self):
+        return [(1, 3, *self._cfg.data.img_size)]
+
     def preprocess(self, img, boxes):
-        cv_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # ページ全体は変換せず、テーブル領域のみをリサイズしてテンソルに書き込む
+        page = as_page(img)
+        img_size = self._cfg.data.img_size
 
         table_imgs = []
         for box in boxes:
             x1, y1, x2, y2 = map(int, box)
-            table_img = cv_img[y1:y2, x1:x2, :]
+            table_img = page.crop(box)
             th, hw = table_img.shape[:2]
-            table_img = Image.fromarray(table_img)
-            img_tensor = self.transforms(table_img)[None]
+            key = ("table_structure_recognizer", (x1, y1, x2, y2), tuple(img_size))
+            tensor = page.memoize(
+                key, lambda: resize_to_tensor(table_img, img_size)[None]
+            )
             table_imgs.append(
                 {
-                    "tensor": img_tensor,
+                    "tensor": tensor,
                     "size": (th, hw),
                     "offset": (x1, y1),
                 }
@@ -201,8 +208,7 @@ class TableStructureRecognizer(BaseModule):
 
     def postprocess(self, preds, data):
         h, w = data["size"]
-        orig_size = torch.tensor([w, h])[None].to(self.device)
-        outputs = self.postprocessor(preds, orig_size, self.thresh_score)
+        outputs = filter_detections(preds, [(w, h)], self.thresh_score)
 
         preds = outputs[0]
         scores = preds["scores"]
@@ -241,11 +247,11 @@ class TableStructureRecognizer(BaseModule):
             "box": table_box,
             "n_row": n_row,
             "n_col": n_col,
-            "cells": cells,
+            "cells": [TableCellRecord(**cell) for cell in cells],
             "order": 0,
         }
 
-        results = TableStructureRecognizerSchema(**table)
+        results = TableStructureRecognizerRecord(**table)
 
         return results
 
@@ -262,23 +268,26 @@ class TableStructureRecognizer(BaseModule):
 
         return cells, len(row_boxes), len(col_boxes)
 
-    def __call__(self, img, table_boxes, vis=None):
-        img_tensors = self.preprocess(img, table_boxes)
-        outputs = []
-        for data in img_tensors:
-            if self.infer_onnx:
-                input = data["tensor"].numpy()
-                results = self.sess.run(None, {"input": input})
-                pred = {
-                    "pred_logits": torch.tensor(results[0]).to(self.device),
-                    "pred_boxes": torch.tensor(results[1]).to(self.device),
-                }
+    def forward(self, tensor):
+        if self.infer_onnx:
+            input = tensor.numpy()
+            results = self.sess.run(None, {"input": input})
+            return {
+                name: torch.tensor(result).to(self.device)
+                for name, result in zip(["labels", "boxes", "scores"], results)
+            }
 
-            else:
-                with torch.inference_mode():
-                    data["tensor"] = data["tensor"].to(self.device)
-                    pred = self.model(data["tensor"])
+        with torch.inference_mode():
+            tensor = tensor.to(self.device)
+            return self.model(tensor)
 
+    def predict(self, img, table_boxes, vis=None):
+        page = as_page(img)
+        img = page.img
+        img_tensors = self.preprocess(page, table_boxes)
+        outputs = []
+        for data in img_tensors:
+            pred = self.infer(data["tensor"])
             table = self.postprocess(pred, data)
             outputs.append(table)
 
@@ -293,3 +302,7 @@ class TableStructureRecognizer(BaseModule):
                 )
 
         return outputs, vis
+
+    def __call__(self, img, table_boxes, vis=None):
+        results, vis = self.predict(img, table_boxes, vis=vis)
+        return [table.to_schema() for table in results], vis
@@ -1,24 +1,31 @@
 from typing import List
 
+import cv2
 import numpy as np
 import torch
-import os
 from pydantic import conlist
 
-from .base import BaseModelCatalog, BaseModule, BaseSchema
+from .base import BaseModelCatalog, BaseModule, BaseRecord, BaseSchema
 from .configs import TextDetectorDBNetConfig
 from .data.functions import (
-    array_to_tensor,
-    resize_shortest_edge,
-    standardization_image,
+    calc_adaptive_shortest_edge_size,
+    calc_resized_shortest_edge_size,
+    calc_tiles,
+    estimate_text_height,
+    resize_to_tensor,
 )
+from .data.page import as_page
 from .models import DBNet
 from .postprocessor import DBnetPostProcessor
+from .utils.quantization import quantize_static
 from .utils.visualizer import det_visualizer
-from .constants import ROOT_DIR
 
-import onnx
-import onnxruntime
+# ウォームアップする文書画像の縦横比(正方形, レター, A判)
+WARMUP_ASPECT_RATIOS = [1.0, 1.294, 1.414]
+
+# 学習時の入力の正規化に用いたチャンネルごとの平均と標準偏差
+NORMALIZE_MEAN = (0.485, 0.456, 0.406)
+NORMALIZE_STD = (0.229, 0.224, 0.225)
 
 
 class TextDetectorModelCatalog(BaseModelCatalog):
@@ -38,8 +45,14 @@ class TextDetectorSchema(BaseSchema):
     scores: List[float]
 
 
+class TextDetectorRecord(BaseRecord):
+    __slots__ = ("points", "scores")
+    schema = TextDetectorSchema
+
+
 class TextDetector(BaseModule):
     model_catalog = TextDetectorModelCatalog()
+    postprocess_config_keys = ("post_process", "visualize")
 
     def __init__(
         self,
@@ -49,36 +62,63 @@ class TextDetector(BaseModule):
         visualize=False,
         from_pretrained=True,
         infer_onnx=False,
+        quantize=None,
+        compile=False,
+        calibration_images=None,
     ):
         super().__init__()
+        if infer_onnx and quantize is not None:
+            raise ValueError("quantize is not supported with infer_onnx.")
+
         self.load_model(
             model_name,
             path_cfg,
             from_pretrained=from_pretrained,
+            quantize=quantize,
+            calibration_data=calibration_images,
         )
 
         self.device = device
         self.visualize = visualize
 
+        # 確率マップを1/4の解像度で出力し、後処理も低解像度で行う
+        if self._cfg.low_res:
+            self.model.to_low_resolution()
+
+        # BatchNormの畳み込みへの統合としきい値マップの分岐の削除を行う。
+        # 静的量子化したバックボーンはchannels_lastに変換しない
+        self.channels_last = self._cfg.deploy and self.quantize is None
+        if self._cfg.deploy:
+            self.model.deploy(channels_last=self.channels_last)
+
         self.model.eval()
         self.model.to(self.device)
 
-        self.post_processor = DBnetPostProcessor(**self._cfg.post_process)
+        tiling = self._cfg.tiling
+        if tiling.enabled and (
+            tiling.tile_size % 32 != 0 or not 0 <= tiling.overlap < tiling.tile_size
+        ):
+            raise ValueError(
+                "tiling.tile_size must be a multiple of 32 "
+                "and tiling.overlap must be smaller than tiling.tile_size."
+            )
+
+        self.post_processor = DBnetPostProcessor(
+            **self._cfg.post_process, stride=4 if self._cfg.low_res else 1
+        )
         self.infer_onnx = infer_onnx
+        self.set_precision(self._cfg.precision)
 
         if infer_onnx:
-            name = self._cfg.hf_hub_repo.split("/")[-1]
-            path_onnx = f"{ROOT_DIR}/onnx/{name}.onnx"
-            if not os.path.exists(path_onnx):
-                self.convert_onnx(path_onnx)
-
-            model = onnx.load(path_onnx)
-            if torch.cuda.is_available() and device == "cuda":
-                self.sess = onnxruntime.InferenceSession(
-                    model.SerializeToString(), providers=["CUDAExecutionProvider"]
-                )
-            else:
-                self.sess = onnxruntime.InferenceSession(model.SerializeToString())
+            self.load_onnx()
+
+        if compile or self._cfg.compile:
+            self.compile_model()
+            self.warmup()
+
+    def onnx_input_shape(self):
+        # 入力の高さと幅は可変
+        return (1, 3, 256, 256)
 
     def convert_onnx(self, path_onnx):
         dynamic_axes = {
@@ -86,54 +126,206 @@ class TextDetector(BaseModule):
             "output": {0: "batch_size", 2: "height", 3: "width"},
         }
 
-        dummy_input = torch.randn(1, 3, 256, 256, requires_grad=True)
+        dummy_input = torch.randn(*self.onnx_input_shape(), requires_grad=True)
 
         torch.onnx.export(
             self.model,
             dummy_input,
             path_onnx,
-            opset_version=14,
+            opset_version=self.onnx_opset,
             input_names=["input"],
             output_names=["output"],
             dynamic_axes=dynamic_axes,
+            dynamo=False,
+        )
+
+    def warmup_shapes(self):
+        # 縦長、横長の文書画像のリサイズ後の形状
+        shapes = set()
+        for ratio in WARMUP_ASPECT_RATIOS:
+            for h, w in [(ratio * 1000, 1000), (1000, ratio * 1000)]:
+                shape = calc_resized_shortest_edge_size(
+                    h, w, self._cfg.data.shortest_size, self._cfg.data.limit_size
+                )
+                shapes.add((1, 3, *shape))
+        return sorted(shapes)
+
+    def quantize_model(self, calibration_data, calibrate=True):
+        """
+        DBNetのバックボーンの畳み込み層を静的量子化する。
+        活性値の範囲はキャリブレーション画像で推定する。
+        """
+        if calibrate and len(calibration_data) == 0:
+            raise ValueError(
+                "calibration_images are required for int8 quantization of TextDetector."
+            )
+
+        calibration_data = [self.preprocess(img) for img in calibration_data]
+        example_input = torch.zeros(1, 3, 256, 256)
+        if len(calibration_data) > 0:
+            example_input = calibration_data[0]
+
+        self.model.backbone.body = quantize_static(
+            self.model.backbone.body, calibration_data, example_input
+        )
+
+    def input_size(self, img):
+        """
+        Return the shortest edge length and the maximum edge length of the input.
+        With `adaptive_resize`, the resolution is chosen per image so that the
+        estimated text height becomes `target_text_height` pixels.
+        """
+        cfg = self._cfg.data
+        if not cfg.adaptive_resize:
+            return cfg.shortest_size, cfg.limit_size
+
+        # 文字を検出できない画像は既定の解像度で推論する
+        text_height = estimate_text_height(img)
+        if text_height is None:
+            return cfg.shortest_size, cfg.limit_size
+
+        h, w = img.shape[:2]
+        return calc_adaptive_shortest_edge_size(
+            h,
+            w,
+            text_height,
+            cfg.shortest_size,
+            cfg.limit_size,
+            cfg.target_text_height,
+            cfg.min_shortest_size,
+            cfg.max_shortest_size,
         )
 
     def preprocess(self, img):
-        img = img.copy()
-        img = img[:, :, ::-1].astype(np.float32)
-        resized = resize_shortest_edge(
-            img, self._cfg.data.shortest_size, self._cfg.data.limit_size
+        # uint8のまま1度だけリサイズし、正規化の結果をテンソルに直接書き込む。
+        # 学習時と同じく、チャンネルはBGRの順に並べる
+        shortest_size, limit_size = self.input_size(img)
+        h, w = img.shape[:2]
+        size = calc_resized_shortest_edge_size(h, w, shortest_size, limit_size)
+        tensor = torch.empty((1, 3, *size))
+        resize_to_tensor(
+            img,
+            size,
+            out=tensor[0],
+            mean=NORMALIZE_MEAN,
+            std=NORMALIZE_STD,
+            rgb=False,
+            interpolation=cv2.INTER_LINEAR,
         )
-        normalized = standardization_image(resized)
-        tensor = array_to_tensor(normalized)
         return tensor
 
     def postprocess(self, preds, image_size):
         return self.post_processor(preds, image_size)
 
-    def __call__(self, img):
-        """apply the detection model to the input image.
-
-        Args:
-            img (np.ndarray): target image(BGR)
+    def preprocess_tile(self, page, tile, out):
         """
+        タイルを切り出し、端のタイルは余白を白で埋めてタイルの大きさに揃え、
+        正規化した結果を`out` (3, tile_size, tile_size) に書き込む。
+        """
+        x0, y0, x1, y1 = tile
+        tile_size = self._cfg.tiling.tile_size
+        img = cv2.copyMakeBorder(
+            page[y0:y1, x0:x1],
+            0,
+            tile_size - (y1 - y0),
+            0,
+            tile_size - (x1 - x0),
+            cv2.BORDER_CONSTANT,
+            value=(255, 255, 255),
+        )
+        return resize_to_tensor(
+            img,
+            (tile_size, tile_size),
+            out=out,
+            mean=NORMALIZE_MEAN,
+            std=NORMALIZE_STD,
+            rgb=False,
+        )
 
+    def detect_tiles(self, img):
+        """
+        縮小せずに(最長辺が`tiling.max_length`を超える場合はその長さまで縮小して)
+        重なりのあるタイルに分割して推論し、タイルの境界で分割された文字列を統合する。
+        タイルの確率マップはバッチごとに矩形に変換して破棄するため、
+        メモリ使用量はページの大きさによらずバッチの大きさで決まる。
+        """
+        cfg = self._cfg.tiling
         ori_h, ori_w = img.shape[:2]
-        tensor = self.preprocess(img)
+        scale = min(1.0, cfg.max_length / max(ori_h, ori_w))
+        page = img
+        if scale < 1.0:
+            page = cv2.resize(
+                img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+
+        h, w = page.shape[:2]
+        tiles = calc_tiles(h, w, cfg.tile_size, cfg.overlap)
+        stride = self.post_processor.stride
+
+        candidates = []
+        for i in range(0, len(tiles), cfg.batch_size):
+            batch = tiles[i : i + cfg.batch_size]
+            tensor = torch.empty((len(batch), 3, cfg.tile_size, cfg.tile_size))
+            for tile, out in zip(batch, tensor):
+                self.preprocess_tile(page, tile, out)
+            preds = self.infer(tensor)
+
+            for (x0, y0, x1, y1), pred in zip(batch, preds["binary"]):
+                # 余白の領域の確率マップを除く
+                pred = pred[:, : -(-(y1 - y0) // stride), : -(-(x1 - x0) // stride)]
+                candidates.append(self.post_processor.tile_candidates(pred, (x0, y0)))
 
+        return self.post_processor.merge_tiles(
+            candidates, tiles, (h, w), (ori_h, ori_w)
+        )
+
+    def forward(self, tensor):
         if self.infer_onnx:
             input = tensor.numpy()
             results = self.sess.run(["output"], {"input": input})
-            preds = {"binary": torch.tensor(results[0])}
+            return {"binary": torch.tensor(results[0])}
+
+        with torch.inference_mode():
+            tensor = tensor.to(self.device)
+            if self.channels_last:
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+            return self.model(tensor)
+
+    def predict(self, img, region=None):
+        """apply the detection model to the input image.
+
+        Args:
+            img (np.ndarray | Page): target image(BGR)
+            region (list, optional): xyxy box to limit the detection to. The
+                returned points are in the coordinates of the input image.
+        """
+
+        page = as_page(img)
+        img = page.img
+        target, offset = page, (0, 0)
+        if region is not None:
+            # 領域を切り出したページは前処理を共有しないため、Pageを新たに作成する
+            x0, y0, x1, y1 = map(int, region)
+            target, offset = as_page(page.crop([x0, y0, x1, y1])), (x0, y0)
+
+        ori_h, ori_w = target.shape[:2]
+        if self._cfg.tiling.enabled:
+            preds = None
+            quads, scores = self.detect_tiles(target.img)
         else:
-            with torch.inference_mode():
-                tensor = tensor.to(self.device)
-                preds = self.model(tensor)
+            key = ("text_detector", str(self._cfg.data))
+            tensor = target.memoize(key, lambda: self.preprocess(target.img))
+            preds = self.infer(tensor)
+            quads, scores = self.postprocess(preds, (ori_h, ori_w))
+
+        if region is not None:
+            quads = quads + np.array(offset, dtype=quads.dtype)
+            # 確率マップは切り出した領域のものであるため、可視化しない
+            preds = None
 
-        quads, scores = self.postprocess(preds, (ori_h, ori_w))
         outputs = {"points": quads, "scores": scores}
 
-        results = TextDetectorSchema(**outputs)
+        results = TextDetectorRecord(**outputs)
 
         vis = None
         if self.visualize:
@@ -146,3 +338,7 @@ class TextDetector(BaseModule):
             )
 
         return results, vis
+
+    def __call__(self, img):
+        results, vis = self.predict(img)
+        return results.to_schema(), vis
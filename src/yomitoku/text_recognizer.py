@@ -2,21 +2,28 @@ from typing import List
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import os
 import unicodedata
 from pydantic import conlist
 
-from .base import BaseModelCatalog, BaseModule, BaseSchema
+from .base import BaseModelCatalog, BaseModule, BaseRecord, BaseSchema
 from .configs import TextRecognizerPARSeqConfig, TextRecognizerPARSeqSmallConfig
 from .data.dataset import ParseqDataset
+from .data.page import as_page
 from .models import PARSeq
+from .models.parseq import PARSeqDecoderStep, PARSeqEncoder, PARSeqRefiner
 from .postprocessor import ParseqTokenizer as Tokenizer
+from .utils.cache import MemoryCache, atomic_write
+from .utils.logger import set_logger
 from .utils.misc import load_charset
 from .utils.visualizer import rec_visualizer
 
-from .constants import ROOT_DIR
-import onnx
-import onnxruntime
+from .constants import DIRECTIONS
+
+logger = set_logger(__name__, "INFO")
+
+ONNX_PARTS = ("encoder", "decoder_step", "refiner")
 
 
 class TextRecognizerModelCatalog(BaseModelCatalog):
@@ -39,8 +46,50 @@ class TextRecognizerSchema(BaseSchema):
     ]
 
 
+class TextRecognizerRecord(BaseRecord):
+    """
+    points: (N, 4, 2) int32
+    scores: (N,) float64
+    directions: (N,) uint8, index of `DIRECTIONS`
+    """
+
+    __slots__ = ("contents", "directions", "scores", "points")
+    schema = TextRecognizerSchema
+
+    def to_schema(self):
+        return self.schema.model_construct(
+            contents=self.contents,
+            directions=[DIRECTIONS[d] for d in self.directions.tolist()],
+            scores=self.scores.tolist(),
+            points=self.points.tolist(),
+        )
+
+
+def estimate_directions(points):
+    points = points.astype(np.float64)
+    w = np.linalg.norm(points[:, 0] - points[:, 1], axis=-1)
+    h = np.linalg.norm(points[:, 1] - points[:, 2], axis=-1)
+    return (h > w * 2).astype(np.uint8)
+
+
+def perceptual_hash(tensors, pool_size=(2, 4), levels=16):
+    """
+    正規化済みの文字画像テンソル(N, 3, H, W)から知覚的ハッシュを計算する。
+    グレースケールに変換して平均プーリングで縮小し、輝度を量子化することで、
+    画素値のわずかな差異に影響されないキーを生成する。
+    """
+    gray = tensors.float().mean(dim=1, keepdim=True)
+    pooled = F.avg_pool2d(gray, kernel_size=pool_size)
+    quantized = ((pooled + 1) / 2 * (levels - 1)).round().clamp(0, levels - 1)
+    quantized = quantized.to(torch.uint8).flatten(1).cpu().numpy()
+    return [row.tobytes() for row in quantized]
+
+
 class TextRecognizer(BaseModule):
     model_catalog = TextRecognizerModelCatalog()
+    # 自己回帰デコードは推論結果によってループを打ち切るため、トレースできない
+    traceable = False
+    quantize_modules = ("encoder", "decoder")
 
     def __init__(
         self,
@@ -50,13 +99,26 @@ class TextRecognizer(BaseModule):
         visualize=False,
         from_pretrained=True,
         infer_onnx=False,
+        quantize=None,
+        compile=False,
+        word_cache_size=0,
     ):
         super().__init__()
+        if infer_onnx and quantize is not None:
+            raise ValueError("quantize is not supported with infer_onnx.")
+
         self.load_model(
             model_name,
             path_cfg,
             from_pretrained=from_pretrained,
+            quantize=quantize,
         )
+
+        # ページ間で繰り返し出現する文字画像の認識結果を再利用する
+        self.word_cache = None
+        if word_cache_size > 0:
+            self.word_cache = MemoryCache(word_cache_size)
+
         self.charset = load_charset(self._cfg.charset)
         self.tokenizer = Tokenizer(self.charset)
 
@@ -69,20 +131,14 @@ class TextRecognizer(BaseModule):
         self.visualize = visualize
 
         self.infer_onnx = infer_onnx
+        self.set_precision(self._cfg.precision)
 
         if infer_onnx:
-            name = self._cfg.hf_hub_repo.split("/")[-1]
-            path_onnx = f"{ROOT_DIR}/onnx/{name}.onnx"
-            if not os.path.exists(path_onnx):
-                self.convert_onnx(path_onnx)
-
-            model = onnx.load(path_onnx)
-            if torch.cuda.is_available() and device == "cuda":
-                self.sess = onnxruntime.InferenceSession(
-                    model.SerializeToString(), providers=["CUDAExecutionProvider"]
-                )
-            else:
-                self.sess = onnxruntime.InferenceSession(model.SerializeToString())
+            self.load_onnx()
+
+        if compile or self._cfg.compile:
+            self.compile_model()
+            self.warmup()
 
     def preprocess(self, img, polygons):
         dataset = ParseqDataset(self._cfg, img, polygons)
@@ -95,86 +151,260 @@ class TextRecognizer(BaseModule):
 
         return dataloader
 
-    def convert_onnx(self, path_onnx):
-        img_size = self._cfg.data.img_size
-        input = torch.randn(1, 3, *img_size, requires_grad=True)
-        dynamic_axes = {
-            "input": {0: "batch_size"},
-            "output": {0: "batch_size"},
+    def onnx_paths(self):
+        root, _ = os.path.splitext(self.onnx_path())
+        return {part: f"{root}_{part}.onnx" for part in ONNX_PARTS}
+
+    def load_onnx(self):
+        """
+        Load the encoder, the decoding step and the refinement of PARSeq exported
+        as separate ONNX models. They are exported on the first run.
+        """
+        paths = self.onnx_paths()
+        if not all(os.path.exists(path) for path in paths.values()):
+            logger.info(f"Export ONNX models: {list(paths.values())}")
+            self.convert_onnx(paths)
+
+        self.sess = {
+            part: self.create_onnx_session(path) for part, path in paths.items()
         }
 
-        torch.onnx.export(
-            self.model,
-            input,
-            path_onnx,
-            opset_version=14,
-            input_names=["input"],
-            output_names=["output"],
-            do_constant_folding=True,
-            dynamic_axes=dynamic_axes,
-        )
+    def convert_onnx(self, paths):
+        if not self._cfg.decode_ar:
+            raise ValueError("ONNX inference only supports autoregressive decoding.")
 
-    def postprocess(self, p, points):
+        img_size = self._cfg.data.img_size
+        input = torch.randn(2, 3, *img_size)
+        num_layers = len(self.model.decoder.layers)
+        embed_dim = self._cfg.decoder.embed_dim
+
+        encoder = PARSeqEncoder(self.model).eval()
+        with torch.inference_mode():
+            memory, cross_k, cross_v = encoder(input)
+
+        with atomic_write(paths["encoder"], suffix=".onnx") as tmp_path:
+            torch.onnx.export(
+                encoder,
+                input,
+                tmp_path,
+                opset_version=self.onnx_opset,
+                input_names=["input"],
+                output_names=["memory", "cross_k", "cross_v"],
+                do_constant_folding=True,
+                dynamo=False,
+                dynamic_axes={
+                    "input": {0: "batch_size"},
+                    "memory": {0: "batch_size"},
+                    "cross_k": {1: "batch_size"},
+                    "cross_v": {1: "batch_size"},
+                },
+            )
+
+        tokens = torch.full((2, 1), self.tokenizer.bos_id, dtype=torch.long)
+        step = torch.tensor([1], dtype=torch.long)
+        past = torch.randn(num_layers, 2, 1, embed_dim)
+        cache_axes = {1: "batch_size", 2: "length"}
+        with atomic_write(paths["decoder_step"], suffix=".onnx") as tmp_path:
+            torch.onnx.export(
+                PARSeqDecoderStep(self.model).eval(),
+                (tokens, step, cross_k, cross_v, past, past),
+                tmp_path,
+                opset_version=self.onnx_opset,
+                input_names=[
+                    "tokens",
+                    "step",
+                    "cross_k",
+                    "cross_v",
+                    "past_k",
+                    "past_v",
+                ],
+                output_names=["logits", "present_k", "present_v"],
+                do_constant_folding=True,
+                dynamo=False,
+                dynamic_axes={
+                    "tokens": {0: "batch_size"},
+                    "cross_k": {1: "batch_size"},
+                    "cross_v": {1: "batch_size"},
+                    "past_k": cache_axes,
+                    "past_v": cache_axes,
+                    "logits": {0: "batch_size"},
+                    "present_k": cache_axes,
+                    "present_v": cache_axes,
+                },
+            )
+
+        num_steps = self._cfg.max_label_length + 1
+        tokens = torch.full((2, num_steps), self.tokenizer.bos_id, dtype=torch.long)
+        with atomic_write(paths["refiner"], suffix=".onnx") as tmp_path:
+            torch.onnx.export(
+                PARSeqRefiner(self.model).eval(),
+                (tokens, memory),
+                tmp_path,
+                opset_version=self.onnx_opset,
+                input_names=["tokens", "memory"],
+                output_names=["logits"],
+                do_constant_folding=True,
+                dynamo=False,
+                dynamic_axes={
+                    "tokens": {0: "batch_size"},
+                    "memory": {0: "batch_size"},
+                    "logits": {0: "batch_size"},
+                },
+            )
+
+    def decode_onnx(self, input):
+        """
+        Autoregressive decoding with the ONNX models.
+        The loop runs in Python and stops when all sequences have reached <eos>,
+        in the same way as `PARSeq.forward()`.
+        """
+        memory, cross_k, cross_v = self.sess["encoder"].run(None, {"input": input})
+
+        N = input.shape[0]
+        num_steps = self._cfg.max_label_length + 1
+        num_layers, embed_dim = cross_k.shape[0], cross_k.shape[-1]
+        past_k = np.zeros((num_layers, N, 0, embed_dim), dtype=np.float32)
+        past_v = np.zeros((num_layers, N, 0, embed_dim), dtype=np.float32)
+
+        tgt_in = np.full((N, num_steps), self.tokenizer.pad_id, dtype=np.int64)
+        tgt_in[:, 0] = self.tokenizer.bos_id
+
+        logits = []
+        for i in range(num_steps):
+            p_i, past_k, past_v = self.sess["decoder_step"].run(
+                None,
+                {
+                    "tokens": tgt_in[:, i : i + 1],
+                    "step": np.array([i], dtype=np.int64),
+                    "cross_k": cross_k,
+                    "cross_v": cross_v,
+                    "past_k": past_k,
+                    "past_v": past_v,
+                },
+            )
+            logits.append(p_i)
+            if i + 1 < num_steps:
+                tgt_in[:, i + 1] = p_i[:, 0].argmax(-1)
+                if (tgt_in == self.tokenizer.eos_id).any(axis=-1).all():
+                    break
+
+        logits = np.concatenate(logits, axis=1)
+
+        # 打ち切った後の位置は<eos>で埋める。<eos>以降はマスクされ、結果は変わらない
+        tokens = np.full((N, num_steps), self.tokenizer.eos_id, dtype=np.int64)
+        tokens[:, 0] = self.tokenizer.bos_id
+        for _ in range(self._cfg.refine_iters):
+            tokens[:, 1 : logits.shape[1]] = logits[:, :-1].argmax(-1)
+            logits = self.sess["refiner"].run(
+                None, {"tokens": tokens, "memory": memory}
+            )[0]
+
+        return torch.tensor(logits)
+
+    def forward(self, tensor):
+        if self.infer_onnx:
+            logits = self.decode_onnx(tensor.numpy())
+            return {"probs": logits.softmax(-1)}
+
+        with torch.inference_mode():
+            tensor = tensor.to(self.device)
+            return {"probs": self.model(tensor).softmax(-1)}
+
+    def warmup_shapes(self):
+        # 最後のバッチはバッチサイズより小さくなるため、バッチサイズ1の形状も準備する
+        img_size = self._cfg.data.img_size
+        return [(self._cfg.data.batch_size, 3, *img_size), (1, 3, *img_size)]
+
+    def decode(self, p):
         pred, score = self.tokenizer.decode(p)
         pred = [unicodedata.normalize("NFKC", x) for x in pred]
+        return pred, score
 
-        directions = []
-        for point in points:
-            point = np.array(point)
-            w = np.linalg.norm(point[0] - point[1])
-            h = np.linalg.norm(point[1] - point[2])
+    def postprocess(self, p, points):
+        pred, score = self.decode(p)
+        return pred, score, estimate_directions(points)
 
-            direction = "vertical" if h > w * 2 else "horizontal"
-            directions.append(direction)
+    def recognize(self, data, points):
+        if self.word_cache is None:
+            p = self.infer(data)["probs"]
+            return self.postprocess(p, points)
 
-        return pred, score, directions
+        keys = perceptual_hash(data)
+        cached = [self.word_cache.get(key) for key in keys]
+        misses = [i for i, value in enumerate(cached) if value is None]
 
-    def __call__(self, img, points, vis=None):
+        # キャッシュに存在しない文字画像のみをモデルに入力する
+        if len(misses) > 0:
+            p = self.infer(data[misses])["probs"]
+            pred, score = self.decode(p)
+            for i, content, s in zip(misses, pred, score):
+                cached[i] = (content, s)
+                self.word_cache.put(keys[i], cached[i])
+
+        pred = [content for content, _ in cached]
+        score = [s for _, s in cached]
+        return pred, score, estimate_directions(points)
+
+    def cache_info(self):
+        """Return hit/miss statistics of the word cache."""
+        if self.word_cache is None:
+            return None
+        return self.word_cache.info()
+
+    def predict(self, img, points, vis=None):
         """
         Apply the recognition model to the input image.
 
         Args:
-            img (np.ndarray): target image(BGR)
+            img (np.ndarray | Page): target image(BGR)
             points (list): list of quadrilaterals. Each quadrilateral is represented as a list of 4 points sorted clockwise.
             vis (np.ndarray, optional): rendering image. Defaults to None.
         """
 
+        img = as_page(img).img
+        points = np.asarray(points, dtype=np.int32).reshape(-1, 4, 2)
         dataloader = self.preprocess(img, points)
         preds = []
         scores = []
         directions = []
+        start = 0
         for data in dataloader:
-            if self.infer_onnx:
-                input = data.numpy()
-                results = self.sess.run(["output"], {"input": input})
-                p = torch.tensor(results[0])
-            else:
-                with torch.inference_mode():
-                    data = data.to(self.device)
-                    p = self.model(data).softmax(-1)
-
-            pred, score, direction = self.postprocess(p, points)
+            end = start + len(data)
+            pred, score, direction = self.recognize(data, points[start:end])
             preds.extend(pred)
             scores.extend(score)
-            directions.extend(direction)
+            directions.append(direction)
+            start = end
+
+        if self.word_cache is not None:
+            logger.debug(f"{self.__class__.__name__} word cache: {self.cache_info()}")
+
+        if len(directions) > 0:
+            directions = np.concatenate(directions)
+        else:
+            directions = np.zeros(0, dtype=np.uint8)
 
         outputs = {
             "contents": preds,
-            "scores": scores,
+            "scores": np.array(scores, dtype=np.float64),
             "points": points,
             "directions": directions,
         }
-        results = TextRecognizerSchema(**outputs)
+        results = TextRecognizerRecord(**outputs)
 
         if self.visualize:
             if vis is None:
                 vis = img.copy()
             vis = rec_visualizer(
                 vis,
-                results,
+                results.to_schema(),
                 font_size=self._cfg.visualize.font_size,
                 font_color=tuple(self._cfg.visualize.color[::-1]),
                 font_path=self._cfg.visualize.font,
             )
 
         return results, vis
+
+    def __call__(self, img, points, vis=None):
+        results, vis = self.predict(img, points, vis=vis)
+        return results.to_schema(), vis
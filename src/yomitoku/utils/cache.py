@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .logger import set_logger
+
+logger = set_logger(__name__, "INFO")
+
+DEFAULT_CACHE_SIZE = 1024**3
+
+
+def hash_image(img):
+    """画像の画素値、形状、型からハッシュ値を計算する"""
+    img = np.ascontiguousarray(img)
+    hasher = hashlib.sha256()
+    hasher.update(str(img.shape).encode())
+    hasher.update(str(img.dtype).encode())
+    hasher.update(img.data)
+    return hasher.hexdigest()
+
+
+def hash_file(path, chunk_size=1024**2):
+    """ファイルの内容からハッシュ値を計算する"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_texts(*texts):
+    hasher = hashlib.sha256()
+    for text in texts:
+        hasher.update(str(text).encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def _update_state_hash(hasher, value):
+    # 量子化済みのモデルの重みは、量子化テンソルのタプルやdtypeとして保持される
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            _update_state_hash(hasher, item)
+        return
+
+    if not isinstance(value, torch.Tensor):
+        hasher.update(str(value).encode())
+        return
+
+    hasher.update(str(value.dtype).encode())
+    hasher.update(str(tuple(value.shape)).encode())
+    if value.is_quantized:
+        value = value.dequantize()
+    data = value.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+    hasher.update(data.numpy().data)
+
+
+def hash_state_dict(state_dict):
+    """モデルの重みの名前と値からハッシュ値を計算する"""
+    hasher = hashlib.sha256()
+    for name, value in state_dict.items():
+        hasher.update(name.encode())
+        _update_state_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+@contextmanager
+def atomic_write(path, suffix=".tmp"):
+    """
+    Yield a temporary path next to `path` and move it to `path` on success, so that
+    concurrent readers never see a partially written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileCache:
+    """
+    Content-addressed on-disk cache.
+    Entries are stored as `<cache_dir>/<key[:2]>/<key><suffix>` and the total size
+    is bounded by `max_size` bytes. The least recently used entries (by mtime,
+    which is refreshed on every hit) are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE, suffix=".json"):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.suffix = suffix
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.cache_dir / key[:2] / f"{key}{self.suffix}"
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)
+        return data
+
+    def save(self, key, data):
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書き込んでから置き換える
+        with atomic_write(self.path(key)) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for path in self.cache_dir.glob(f"*/*{self.suffix}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        for _, size, path in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f"Evicted cache entry: {path}")
+
+
+class MemoryCache:
+    """
+    In-memory LRU cache bounded by the number of entries.
+    Hits and misses are counted so that the hit rate can be monitored.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": len(self.entries),
+            "max_entries": self.max_entries,
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,51 @@
+from functools import lru_cache
+
+import torch
+import torch.nn as nn
+
+from .cache import MemoryCache
+from .logger import set_logger
+
+logger = set_logger(__name__, "INFO")
+
+DEFAULT_MAX_TRACED_SHAPES = 16
+
+
+@lru_cache(maxsize=None)
+def is_compile_supported():
+    """Check whether torch.compile and its default backend work in this environment."""
+    try:
+        compiled = torch.compile(lambda x: x * 2 + 1)
+        compiled(torch.ones(2))
+    except Exception as e:
+        logger.warning(f"torch.compile is not available: {e}")
+        return False
+    return True
+
+
+class ShapeTracedModule(nn.Module):
+    """
+    TorchScript fallback of torch.compile.
+    The wrapped module is traced once per input shape, because tracing
+    specializes the shape dependent control flow of the model.
+    The traced modules are kept in an LRU cache of `max_shapes` entries, so that
+    inputs of arbitrary sizes do not accumulate traced graphs without limit.
+    """
+
+    def __init__(self, module, max_shapes=DEFAULT_MAX_TRACED_SHAPES):
+        super().__init__()
+        self.module = module
+        self.traced = MemoryCache(max_shapes)
+
+    def forward(self, tensor):
+        shape = tuple(tensor.shape)
+        traced = self.traced.get(shape)
+        if traced is None:
+            logger.info(f"Trace {self.module.__class__.__name__} for shape {shape}")
+            with torch.no_grad():
+                traced = torch.jit.trace(
+                    self.module, tensor, strict=False, check_trace=False
+                )
+            self.traced.put(shape, traced)
+
+        return traced(tensor)
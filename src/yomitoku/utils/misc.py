@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def load_charset(charset_path):
     with open(charset_path, "r", encoding="utf-8") as f:
         charset = f.read()
@@ -42,6 +45,97 @@ def is_contained(rect_a, rect_b, threshold=0.8):
     return False
 
 
+def calc_intersection_matrix(rects_a, rects_b):
+    """矩形群A, Bの全ての組み合わせについてcalc_intersectionをまとめて計算する。
+
+    Args:
+        rects_a (np.array): (N, 4) x1, y1, x2, y2
+        rects_b (np.array): (M, 4) x1, y1, x2, y2
+
+    Returns:
+        np.array: (N, M, 4) 交差領域 x1, y1, x2, y2
+        np.array: (N, M) 交差領域が存在する場合True
+    """
+
+    rects_a = np.asarray(rects_a, dtype=np.float64).reshape(-1, 4).astype(np.int64)
+    rects_b = np.asarray(rects_b, dtype=np.float64).reshape(-1, 4).astype(np.int64)
+
+    top_left = np.maximum(rects_a[:, None, :2], rects_b[None, :, :2])
+    bottom_right = np.minimum(rects_a[:, None, 2:], rects_b[None, :, 2:])
+
+    intersection = np.concatenate([top_left, bottom_right], axis=-1)
+    is_intersected = np.all(bottom_right > top_left, axis=-1)
+    return intersection, is_intersected
+
+
+def calc_overlap_ratio(rects_a, rects_b):
+    """矩形群A, Bの全ての組み合わせについて、矩形Bの面積に対する重複領域の割合を求める。
+    is_containedを行列演算でまとめて計算するために用いる。
+
+    Args:
+        rects_a (np.array): (N, 4) x1, y1, x2, y2
+        rects_b (np.array): (M, 4) x1, y1, x2, y2
+
+    Returns:
+        np.array: (N, M) 重複率。重複がない場合は0
+    """
+
+    intersection, is_intersected = calc_intersection_matrix(rects_a, rects_b)
+    overlap_area = (intersection[..., 2] - intersection[..., 0]) * (
+        intersection[..., 3] - intersection[..., 1]
+    )
+
+    rects_b = np.asarray(rects_b, dtype=np.float64).reshape(-1, 4).astype(np.int64)
+    b_area = (rects_b[:, 2] - rects_b[:, 0]) * (rects_b[:, 3] - rects_b[:, 1])
+    b_area = np.broadcast_to(b_area[None, :], overlap_area.shape)
+
+    ratio = np.zeros(overlap_area.shape, dtype=np.float64)
+    np.divide(overlap_area, b_area, out=ratio, where=is_intersected)
+    return ratio
+
+
+def calc_iou_matrix(rects_a, rects_b):
+    """矩形群A, Bの全ての組み合わせについてIoUを求める。
+
+    Args:
+        rects_a (np.array): (N, 4) x1, y1, x2, y2
+        rects_b (np.array): (M, 4) x1, y1, x2, y2
+
+    Returns:
+        np.array: (N, M) IoU。面積0の矩形同士の場合は0
+    """
+
+    rects_a = np.asarray(rects_a, dtype=np.float64).reshape(-1, 4)
+    rects_b = np.asarray(rects_b, dtype=np.float64).reshape(-1, 4)
+
+    top_left = np.maximum(rects_a[:, None, :2], rects_b[None, :, :2])
+    bottom_right = np.minimum(rects_a[:, None, 2:], rects_b[None, :, 2:])
+    overlap_area = np.clip(bottom_right - top_left, 0, None).prod(axis=-1)
+
+    a_area = (rects_a[:, 2:] - rects_a[:, :2]).prod(axis=-1)
+    b_area = (rects_b[:, 2:] - rects_b[:, :2]).prod(axis=-1)
+    union = a_area[:, None] + b_area[None, :] - overlap_area
+
+    iou = np.zeros(overlap_area.shape, dtype=np.float64)
+    np.divide(overlap_area, union, out=iou, where=union > 0)
+    return iou
+
+
+def is_contained_matrix(rects_a, rects_b, threshold=0.8):
+    """矩形群A, Bの全ての組み合わせについてis_containedを判定する。
+
+    Args:
+        rects_a (np.array): (N, 4) x1, y1, x2, y2
+        rects_b (np.array): (M, 4) x1, y1, x2, y2
+        threshold (float, optional): 判定の閾値. Defaults to 0.8.
+
+    Returns:
+        np.array: (N, M) 矩形B[j]が矩形A[i]に含まれる場合True
+    """
+
+    return calc_overlap_ratio(rects_a, rects_b) > threshold
+
+
 def calc_intersection(rect_a, rect_b):
     ax1, ay1, ax2, ay2 = map(int, rect_a)
     bx1, by1, bx2, by2 = map(int, rect_b)
@@ -100,3 +194,9 @@ def quad_to_xyxy(quad):
     y2 = max([y for _, y in quad])
 
     return x1, y1, x2, y2
+
+
+def quads_to_xyxy(quads):
+    """(N, 4, 2)の四角形群を(N, 4)の外接矩形群に変換する"""
+    quads = np.asarray(quads).reshape(-1, 4, 2)
+    return np.concatenate([quads.min(axis=1), quads.max(axis=1)], axis=1)
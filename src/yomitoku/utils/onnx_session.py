@@ -0,0 +1,165 @@
+import os
+
+import onnxruntime
+
+from .cache import atomic_write
+from .logger import set_logger
+
+logger = set_logger(__name__, "INFO")
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# DocumentAnalyzerではOCRとレイアウト解析が並列に実行され、各グループ内のモジュールは
+# 逐次実行されるため、スレッドはグループ単位で割り当てる
+THREAD_GROUPS = {
+    "TextDetector": "ocr",
+    "TextRecognizer": "ocr",
+    "LayoutParser": "layout",
+    "TableStructureRecognizer": "layout",
+}
+
+DEFAULT_THREAD_SHARES = {"ocr": 1, "layout": 1}
+
+_thread_budget = {}
+
+
+def set_thread_budget(num_threads=None, shares=None):
+    """
+    Divide a process-wide number of threads between the ONNX Runtime sessions,
+    so that the sessions running in parallel do not oversubscribe the cores.
+    The budget applies to sessions created afterwards whose
+    `intra_op_num_threads` is 0.
+
+    Args:
+        num_threads (int, optional): total number of threads. Defaults to the
+            number of CPUs. 0 disables the budget.
+        shares (dict, optional): relative share of each group ("ocr", "layout")
+    """
+    _thread_budget.clear()
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+
+    if num_threads <= 0:
+        return
+
+    if shares is None:
+        shares = DEFAULT_THREAD_SHARES
+
+    unknown = set(shares) - set(DEFAULT_THREAD_SHARES)
+    if unknown:
+        raise ValueError(
+            f"Invalid thread groups: {sorted(unknown)}. "
+            f"Supported groups are {list(DEFAULT_THREAD_SHARES)}"
+        )
+
+    total = sum(shares.values())
+    for group, share in shares.items():
+        _thread_budget[group] = max(1, int(num_threads * share / total))
+
+    logger.info(f"ONNX Runtime thread budget: {_thread_budget}")
+
+
+def get_thread_budget(name):
+    """Return the number of threads allotted to the module, or 0 if not set."""
+    return _thread_budget.get(THREAD_GROUPS.get(name), 0)
+
+
+def build_session_options(cfg, name=None):
+    """
+    Build the session options of ONNX Runtime from the `onnx_runtime` section of
+    the module config. The number of threads 0 means the thread budget of the
+    module if set, otherwise the default of ONNX Runtime.
+    """
+    level = cfg.graph_optimization_level
+    if level not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(
+            f"Invalid graph_optimization_level: {level}. "
+            f"Supported values are {list(GRAPH_OPTIMIZATION_LEVELS)}"
+        )
+
+    intra_op_num_threads = cfg.intra_op_num_threads
+    if intra_op_num_threads == 0:
+        intra_op_num_threads = get_thread_budget(name)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = cfg.inter_op_num_threads
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[level]
+    options.enable_cpu_mem_arena = cfg.enable_cpu_mem_arena
+    options.enable_mem_pattern = cfg.enable_mem_pattern
+    return options
+
+
+def select_providers(cfg, device):
+    """
+    Return the execution providers in `cfg.providers`. If it is empty, CUDA is
+    used on GPU and the default provider otherwise.
+    """
+    if len(cfg.providers) == 0:
+        if device.type == "cuda":
+            return ["CUDAExecutionProvider"]
+        return None
+
+    available = onnxruntime.get_available_providers()
+    unavailable = [p for p in cfg.providers if p not in available]
+    if unavailable:
+        raise ValueError(
+            f"Execution providers {unavailable} are not available. "
+            f"Available providers are {available}"
+        )
+    return list(cfg.providers)
+
+
+def optimized_model_path(path_onnx, cfg, providers):
+    """
+    Path of the ORT format model optimized for the optimization level and the
+    execution providers of the session.
+    """
+    root, _ = os.path.splitext(path_onnx)
+    provider = "default" if providers is None else providers[0]
+    provider = provider.replace("ExecutionProvider", "").lower()
+    return f"{root}.{cfg.graph_optimization_level}.{provider}.ort"
+
+
+def create_session(path_onnx, device, cfg, name=None):
+    """
+    Create an ONNX Runtime session directly from the model file.
+    If `cfg.use_optimized_model` is set, the graph optimized on the first run is
+    saved in the ORT format and loaded without optimization afterwards.
+
+    Args:
+        path_onnx (str): path to the ONNX model
+        device (torch.device): device of the module
+        cfg: `onnx_runtime` section of the module config
+        name (str, optional): class name of the module to look up the thread budget
+    """
+    options = build_session_options(cfg, name)
+    providers = select_providers(cfg, device)
+
+    if cfg.use_optimized_model:
+        path_ort = optimized_model_path(path_onnx, cfg, providers)
+        # 再変換されたONNXモデルより古い最適化済みモデルは利用しない
+        is_latest = os.path.exists(path_ort) and (
+            os.path.getmtime(path_ort) >= os.path.getmtime(path_onnx)
+        )
+        if is_latest:
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+            return onnxruntime.InferenceSession(
+                path_ort, sess_options=options, providers=providers
+            )
+
+        logger.info(f"Save optimized ONNX model: {path_ort}")
+        with atomic_write(path_ort, suffix=".ort") as tmp_path:
+            options.optimized_model_filepath = tmp_path
+            return onnxruntime.InferenceSession(
+                path_onnx, sess_options=options, providers=providers
+            )
+
+    return onnxruntime.InferenceSession(
+        path_onnx, sess_options=options, providers=providers
+    )
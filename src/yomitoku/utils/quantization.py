@@ -0,0 +1,56 @@
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+import torch.nn as nn
+from torch.ao.quantization import (
+    default_dynamic_qconfig,
+    get_default_qconfig_mapping,
+    quantize_dynamic,
+)
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from ..constants import SUPPORT_QUANTIZE
+
+
+def validate_quantize(quantize):
+    if quantize is not None and quantize not in SUPPORT_QUANTIZE:
+        raise ValueError(
+            f"Invalid quantize: {quantize}. Supported values are {SUPPORT_QUANTIZE}"
+        )
+    return quantize
+
+
+def quantize_dynamic_linears(model, module_names):
+    """
+    Apply dynamic INT8 quantization to the `nn.Linear` layers within the given
+    submodules. Weights are quantized ahead of time and activations at runtime.
+    The output projections of `nn.MultiheadAttention` are kept in float because
+    the attention accesses their weights directly.
+    """
+    qconfig_spec = {name: default_dynamic_qconfig for name in module_names}
+    return quantize_dynamic(
+        model,
+        qconfig_spec,
+        dtype=torch.qint8,
+        mapping={nn.Linear: nnqd.Linear},
+        inplace=True,
+    )
+
+
+def quantize_static(module: nn.Module, calibration_data, example_input):
+    """
+    Apply post-training static INT8 quantization to the module with FX graph mode.
+    Activation ranges are calibrated with `calibration_data`. When it is empty,
+    observers are initialized with `example_input` only, which is enough to load
+    cached quantized weights with `load_state_dict()`.
+    """
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(module, qconfig_mapping, example_inputs=(example_input,))
+
+    with torch.inference_mode():
+        if len(calibration_data) == 0:
+            prepared(example_input)
+
+        for tensor in calibration_data:
+            prepared(tensor)
+
+    return convert_fx(prepared)
@@ -1,14 +1,24 @@
 from unittest.mock import patch
 
+import numpy as np
 import pytest
+import torch
 
 from yomitoku.base import (
     BaseModelCatalog,
     BaseModule,
+    BaseRecord,
     load_config,
     load_yaml_config,
+    weights_revision,
 )
 from yomitoku.configs import LayoutParserRTDETRv2Config
+from yomitoku.layout_parser import (
+    Element,
+    ElementRecord,
+    LayoutParserRecord,
+    LayoutParserSchema,
+)
 from yomitoku.models import RTDETRv2
 
 
@@ -113,3 +123,220 @@ def test_invalid_base_model():
 
     with pytest.raises(ValueError):
         InvalidModel()
+
+
+def test_base_record():
+    element = ElementRecord(box=[0, 0, 10, 10], score=0.9, role=None)
+    record = LayoutParserRecord(paragraphs=[element], tables=[], figures=[])
+
+    assert record.dict() == {
+        "paragraphs": [{"box": [0, 0, 10, 10], "score": 0.9, "role": None}],
+        "tables": [],
+        "figures": [],
+    }
+
+    schema = record.to_schema()
+    assert isinstance(schema, LayoutParserSchema)
+    assert isinstance(schema.paragraphs[0], Element)
+    assert schema.model_dump() == record.model_dump()
+
+    with pytest.raises(TypeError):
+        ElementRecord(box=[0, 0, 10, 10], score=0.9)
+
+    with pytest.raises(AttributeError):
+        ElementRecord(box=[0, 0, 10, 10], score=0.9, role=None, dummy=1)
+
+    with pytest.raises(NotImplementedError):
+        BaseRecord().to_schema()
+
+
+def test_stage_cache(tmp_path):
+    class CountModule(TestModule):
+        postprocess_config_keys = ("thresh_score",)
+
+        def __init__(self):
+            super().__init__()
+            self.device = "cpu"
+            self.load_model("test", None, from_pretrained=False)
+            self.n_forward = 0
+
+        def forward(self, tensor):
+            self.n_forward += 1
+            return {"pred": tensor * 2}
+
+    module = CountModule()
+    tensor = torch.rand(1, 3, 8, 8)
+
+    # キャッシュが無効な場合は毎回推論する
+    module.infer(tensor)
+    module.infer(tensor)
+    assert module.n_forward == 2
+
+    module.enable_stage_cache(tmp_path)
+    preds = module.infer(tensor)
+    cached = module.infer(tensor)
+    assert module.n_forward == 3
+    assert torch.equal(preds["pred"], cached["pred"])
+
+    module.infer(torch.rand(1, 3, 8, 8))
+    assert module.n_forward == 4
+
+    # 後処理の設定のみを変更した場合はキャッシュを利用する
+    module._cfg.thresh_score = 0.1
+    module.enable_stage_cache(tmp_path)
+    module.infer(tensor)
+    assert module.n_forward == 4
+
+    module._cfg.data.img_size = [320, 320]
+    module.enable_stage_cache(tmp_path)
+    module.infer(tensor)
+    assert module.n_forward == 5
+
+    # 重みが異なる場合はキャッシュを利用しない
+    with torch.no_grad():
+        next(module.model.parameters()).add_(1)
+    module.enable_stage_cache(tmp_path)
+    module.infer(tensor)
+    assert module.n_forward == 6
+
+
+def test_weights_revision(tmp_path):
+    # ローカルのディレクトリの場合は重みのファイルの内容から識別する
+    path_weights = tmp_path / "model.safetensors"
+    path_weights.write_bytes(b"0" * 10)
+    revision = weights_revision(str(tmp_path))
+
+    path_weights.write_bytes(b"1" * 10)
+    assert weights_revision(str(tmp_path)) != revision
+
+
+def test_quantize_cache(tmp_path):
+    class QuantizeModule(TestModule):
+        quantize_modules = ("decoder.decoder",)
+
+    with patch("yomitoku.base.CACHE_DIR", str(tmp_path)):
+        with patch("yomitoku.base.weights_revision", return_value="v1") as revision:
+            with patch.object(
+                RTDETRv2, "from_pretrained", side_effect=lambda _, cfg: RTDETRv2(cfg)
+            ) as mock:
+                module = QuantizeModule()
+                module.load_model("test", None, quantize="int8")
+                mock.assert_called_once()
+
+                # 2回目以降はキャッシュした量子化済みの重みを読み込む
+                cached = QuantizeModule()
+                cached.load_model("test", None, quantize="int8")
+                mock.assert_called_once()
+
+                # キャリブレーション画像が異なる場合は量子化し直す
+                calibration_data = [np.zeros((32, 32, 3), dtype=np.uint8)]
+                QuantizeModule().load_model(
+                    "test", None, quantize="int8", calibration_data=calibration_data
+                )
+                assert mock.call_count == 2
+
+                # 学習済みの重みが更新された場合も量子化し直す
+                revision.return_value = "v2"
+                QuantizeModule().load_model("test", None, quantize="int8")
+                assert mock.call_count == 3
+
+    assert len(list(tmp_path.glob("quantized/*/*.pt"))) == 3
+
+    state = module.model.state_dict()
+    cached_state = cached.model.state_dict()
+    assert state.keys() == cached_state.keys()
+    for key, value in state.items():
+        if isinstance(value, torch.Tensor) and not value.is_quantized:
+            assert torch.equal(value, cached_state[key])
+
+    module.device = "cuda"
+    assert module.device == torch.device("cpu")
+
+    with pytest.raises(ValueError):
+        TestModule().load_model("test", None, quantize="int4")
+
+
+def test_precision():
+    class PrecisionModule(TestModule):
+        def __init__(self):
+            super().__init__()
+            self.load_model("test", None, from_pretrained=False)
+            self.device = "cpu"
+            self.linear = torch.nn.Linear(8, 8)
+
+        def forward(self, tensor):
+            return {"pred": self.linear(tensor)}
+
+    module = PrecisionModule()
+    tensor = torch.rand(2, 8)
+    expected = module.infer(tensor)["pred"]
+
+    module.set_precision("bf16")
+    preds = module.infer(tensor)["pred"]
+    assert preds.dtype == torch.float32
+    assert torch.allclose(preds, expected, atol=5e-2)
+
+    # CPUではfp16をサポートしないため、fp32で推論する
+    module.set_precision("fp16")
+    assert module.precision == "fp32"
+
+    with pytest.raises(ValueError):
+        module.set_precision("fp8")
+
+
+def test_compile():
+    class CompileModule(TestModule):
+        def __init__(self):
+            super().__init__()
+            self.load_model("test", None, from_pretrained=False)
+            self.device = "cpu"
+            self.model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU())
+            self.model.eval()
+
+        def forward(self, tensor):
+            with torch.inference_mode():
+                return {"pred": self.model(tensor)}
+
+        def warmup_shapes(self):
+            return [(1, 3, 8, 8), (1, 3, 16, 8)]
+
+    module = CompileModule()
+    tensors = [torch.rand(shape) for shape in module.warmup_shapes()]
+    expected = [module.infer(tensor)["pred"] for tensor in tensors]
+
+    with patch("yomitoku.base.is_compile_supported", return_value=False):
+        module.compile_model()
+    assert module.compile_mode == "torchscript"
+
+    module.warmup()
+    assert set(module.model.traced.entries) == set(module.warmup_shapes())
+
+    for tensor, pred in zip(tensors, expected):
+        assert torch.allclose(module.infer(tensor)["pred"], pred, atol=1e-6)
+
+    # トレース済みのモジュールは最近使用した形状のみ保持する
+    module.model.traced.max_entries = 2
+    module.infer(torch.rand(1, 3, 8, 16))
+    assert set(module.model.traced.entries) == {(1, 3, 16, 8), (1, 3, 8, 16)}
+
+
+def test_onnx_path(tmp_path):
+    module = TestModule()
+    module.load_model("test", None, from_pretrained=False)
+    module._cfg.onnx_runtime.cache_dir = str(tmp_path)
+
+    path_onnx = module.onnx_path()
+    assert path_onnx.startswith(str(tmp_path))
+    assert path_onnx == module.onnx_path()
+
+    # セッションの設定は変換結果に影響しない
+    module._cfg.onnx_runtime.intra_op_num_threads = 2
+    assert module.onnx_path() == path_onnx
+
+    module._cfg.data.img_size = [320, 320]
+    assert module.onnx_path() != path_onnx
+    module._cfg.data.img_size = [640, 640]
+
+    with torch.no_grad():
+        next(module.model.parameters()).add_(1.0)
+    assert module.onnx_path() != path_onnx
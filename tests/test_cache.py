@@ -0,0 +1,91 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+from yomitoku.utils.cache import (
+    FileCache,
+    MemoryCache,
+    hash_image,
+    hash_state_dict,
+    hash_texts,
+)
+from yomitoku.utils.quantization import quantize_dynamic_linears
+
+
+def test_hash_image():
+    img = np.zeros((32, 32, 3), dtype=np.uint8)
+    assert hash_image(img) == hash_image(img.copy())
+
+    changed = img.copy()
+    changed[0, 0, 0] = 1
+    assert hash_image(img) != hash_image(changed)
+    assert hash_image(img) != hash_image(img.reshape(32, 96))
+
+    assert hash_texts("a", "bc") != hash_texts("ab", "c")
+
+
+def test_hash_state_dict():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    state_hash = hash_state_dict(model.state_dict())
+
+    with torch.no_grad():
+        model[0].bias[0] += 1
+    assert hash_state_dict(model.state_dict()) != state_hash
+
+    # 量子化済みのモデルの重みもハッシュ値を計算できる
+    quantize_dynamic_linears(model, ("0",))
+    quantized_hash = hash_state_dict(model.state_dict())
+    assert quantized_hash == hash_state_dict(model.state_dict())
+
+    with torch.no_grad():
+        model[0].set_weight_bias(model[0].weight(), model[0].bias() + 1)
+    assert hash_state_dict(model.state_dict()) != quantized_hash
+
+
+def test_file_cache(tmp_path):
+    cache = FileCache(tmp_path, max_size=25)
+
+    assert cache.load("aa01") is None
+
+    cache.save("aa01", b"0" * 10)
+    assert cache.load("aa01") == b"0" * 10
+
+    cache.save("bb02", b"1" * 10)
+    past = time.time() - 100
+    os.utime(cache.path("aa01"), (past, past))
+    os.utime(cache.path("bb02"), (past + 1, past + 1))
+
+    # 参照されたエントリは最近利用されたものとして扱われる
+    cache.load("aa01")
+    cache.save("cc03", b"2" * 10)
+
+    assert cache.load("bb02") is None
+    assert cache.load("aa01") == b"0" * 10
+    assert cache.load("cc03") == b"2" * 10
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+
+def test_memory_cache():
+    cache = MemoryCache(2)
+    assert cache.get("a") is None
+
+    cache.put("a", ("A", 0.9))
+    cache.put("b", ("B", 0.8))
+    assert cache.get("a") == ("A", 0.9)
+
+    # 最も長く参照されていない"b"が削除される
+    cache.put("c", ("C", 0.7))
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("c") == ("C", 0.7)
+
+    assert cache.info() == {
+        "hits": 2,
+        "misses": 2,
+        "hit_rate": 0.5,
+        "size": 2,
+        "max_entries": 2,
+    }
@@ -1,3 +1,4 @@
+import argparse
 import os
 from pathlib import Path
 
@@ -200,3 +201,24 @@ def test_run_dir_json(monkeypatch, tmp_path):
     filename = "test"
     out_path = os.path.join(str(tmp_path), f"{dirname}_{filename}_p1.json")
     assert os.path.exists(out_path)
+
+
+def test_get_tasks():
+    parser = argparse.Namespace
+
+    args = parser(figure=False, figure_letter=False)
+    assert main.get_tasks(args, "json") is None
+    assert main.get_tasks(args, "csv") == {"paragraphs", "tables"}
+    assert main.get_tasks(args, "html") == {"paragraphs", "tables"}
+
+    args = parser(figure=True, figure_letter=False)
+    assert main.get_tasks(args, "md") == {"paragraphs", "tables", "figures"}
+    assert main.get_tasks(args, "csv") == {"paragraphs", "tables"}
+
+    args = parser(figure=True, figure_letter=True)
+    assert main.get_tasks(args, "html") == {
+        "paragraphs",
+        "tables",
+        "figures",
+        "figure_letters",
+    }
@@ -1,16 +1,23 @@
+import cv2
 import numpy as np
 import pytest
+import torch
 
 from yomitoku.data.functions import (
     array_to_tensor,
+    calc_adaptive_shortest_edge_size,
+    calc_tiles,
+    estimate_text_height,
     load_image,
     load_pdf,
     resize_shortest_edge,
+    resize_to_tensor,
     resize_with_padding,
     rotate_text_image,
     standardization_image,
     validate_quads,
 )
+from yomitoku.data.page import Page, as_page
 
 
 def test_load_image():
@@ -99,6 +106,110 @@ def test_resize_shortest_edge():
     assert w % 32 == 0
 
 
+def render_text_page(scale, vertical=False):
+    img = np.full((2000, 1500, 3), 255, dtype=np.uint8)
+    thickness = max(1, int(scale * 2))
+    (_, height), _ = cv2.getTextSize(
+        "Hello World", cv2.FONT_HERSHEY_SIMPLEX, scale, thickness
+    )
+    for y in range(50, 1900, int(height * 2.2)):
+        cv2.putText(
+            img,
+            "Hello World text line 0123",
+            (50, y + height),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            scale,
+            (0, 0, 0),
+            thickness,
+        )
+
+    if vertical:
+        img = np.ascontiguousarray(np.rot90(img))
+    return img
+
+
+def test_estimate_text_height():
+    small = estimate_text_height(render_text_page(1))
+    large = estimate_text_height(render_text_page(3))
+    assert large / small == pytest.approx(3, rel=0.2)
+
+    # 縦書きでも同じ大きさと推定する
+    vertical = estimate_text_height(render_text_page(1, vertical=True))
+    assert vertical == pytest.approx(small, rel=0.1)
+
+    blank = np.full((1000, 1000, 3), 255, dtype=np.uint8)
+    assert estimate_text_height(blank) is None
+
+
+def test_calc_adaptive_shortest_edge_size():
+    # リサイズ後の文字の大きさが目標値と同じ場合は既定の解像度
+    size = calc_adaptive_shortest_edge_size(1280, 1280, 16, 1280, 1600, 16, 640, 1920)
+    assert size == (1280, 1600)
+
+    size = calc_adaptive_shortest_edge_size(1280, 1280, 32, 1280, 1600, 16, 640, 1920)
+    assert size == (640, 800)
+
+    size = calc_adaptive_shortest_edge_size(1280, 1280, 4, 1280, 1600, 16, 640, 1920)
+    assert size == (1920, 2400)
+
+    size = calc_adaptive_shortest_edge_size(1280, 1280, 12, 1280, 1600, 16, 640, 1920)
+    assert size[0] % 128 == 0
+
+
+def test_calc_tiles():
+    assert calc_tiles(100, 200, 256, 32) == [(0, 0, 200, 100)]
+
+    tiles = calc_tiles(1000, 500, 256, 32)
+    xs = sorted({tile[0] for tile in tiles})
+    ys = sorted({tile[1] for tile in tiles})
+    assert xs == [0, 122, 244]
+    assert ys[0] == 0 and tiles[-1][2:] == (500, 1000)
+    assert all(y1 - y0 >= 32 for y0, y1 in zip(ys[1:], [y + 256 for y in ys]))
+    assert len(tiles) == len(xs) * len(ys)
+
+
+def test_resize_to_tensor():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (300, 200, 3), dtype=np.uint8)
+
+    for size in [(640, 640), (100, 50)]:
+        tensor = resize_to_tensor(img, size)
+        assert tensor.shape == (3, *size)
+
+        interpolation = cv2.INTER_AREA if size[0] < 300 else cv2.INTER_LINEAR
+        expected = cv2.resize(img, size[::-1], interpolation=interpolation)
+        expected = expected[:, :, ::-1].transpose(2, 0, 1) / 255
+        assert np.allclose(tensor.numpy(), expected, atol=1e-6)
+
+    # 大きなテンソルの一部に直接書き込む
+    out = torch.zeros((2, 3, 64, 64))
+    resize_to_tensor(img, (32, 48), out=out[1, :, :32, :48])
+    assert out[0].eq(0).all() and out[1, :, 32:].eq(0).all()
+    assert out[1, :, :32, :48].gt(0).any()
+
+
+def test_page():
+    img = np.zeros((20, 30, 3), dtype=np.uint8)
+    img[..., 0] = 255
+    page = Page(img)
+    assert as_page(page) is page
+    assert as_page(img).img is img
+    assert page.crop([5, 2, 15, 12]).shape == (10, 10, 3)
+    assert page.hash() == Page(img.copy()).hash()
+
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return torch.zeros(1)
+
+    # 同じキーの変換は1度だけ計算する
+    first = page.memoize("tensor", compute)
+    assert page.memoize("tensor", compute) is first
+    page.memoize("other", compute)
+    assert len(calls) == 2
+
+
 def test_standardization_image():
     img = np.random.randint(0, 255, (100, 100, 3), dtype=np.uint8)
     normalized = standardization_image(img)
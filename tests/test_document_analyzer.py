@@ -1,8 +1,21 @@
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 import torch
 from omegaconf import OmegaConf
 
 from yomitoku import DocumentAnalyzer
+from yomitoku.document_analyzer import (
+    extract_region_boxes,
+    extract_words_within_element,
+    validate_ocr_regions,
+    validate_tasks,
+)
+from yomitoku.layout_analyzer import LayoutAnalyzerRecord
+from yomitoku.layout_parser import ElementRecord
+from yomitoku.ocr import OCRResultArrays
+from yomitoku.text_detector import TextDetectorRecord
 
 
 def test_initialize():
@@ -86,3 +99,128 @@ def test_invalid_config():
         DocumentAnalyzer(
             configs="invalid",
         )
+
+
+def test_extract_words_within_element():
+    words = OCRResultArrays(
+        points=np.array(
+            [
+                [[0, 20], [100, 20], [100, 30], [0, 30]],
+                [[0, 0], [100, 0], [100, 10], [0, 10]],
+                [[500, 500], [600, 500], [600, 510], [500, 510]],
+                [[0, 40], [100, 40], [100, 50], [0, 50]],
+            ],
+            dtype=np.int32,
+        ),
+        det_scores=np.ones(4),
+        rec_scores=np.ones(4),
+        directions=np.array([0, 0, 0, 1], dtype=np.uint8),
+        contents=["second", "first", "outside", "third"],
+    )
+    element = ElementRecord(box=[0, 0, 200, 100], score=1.0, role=None)
+
+    contents, direction, flags = extract_words_within_element(words, element)
+    assert contents == "first\nsecond\nthird"
+    assert direction == "horizontal"
+    assert flags.tolist() == [True, True, False, True]
+
+    element = ElementRecord(box=[1000, 1000, 1100, 1100], score=1.0, role=None)
+    contents, direction, flags = extract_words_within_element(words, element)
+    assert contents is None
+    assert direction is None
+    assert flags.tolist() == [False] * 4
+
+
+def test_validate_tasks():
+    assert validate_tasks(None) == {
+        "words",
+        "paragraphs",
+        "tables",
+        "figures",
+        "figure_letters",
+    }
+    assert validate_tasks(["paragraphs", "tables"]) == {"paragraphs", "tables"}
+    assert validate_tasks({"figure_letters"}) == {"figures", "figure_letters"}
+
+    with pytest.raises(ValueError):
+        validate_tasks(["invalid"])
+
+    with pytest.raises(ValueError):
+        validate_tasks([])
+
+
+def test_extract_region_boxes():
+    layout_res = LayoutAnalyzerRecord(
+        paragraphs=[
+            ElementRecord(box=[0, 0, 10, 10], score=1.0, role=None),
+            ElementRecord(box=[0, 10, 10, 20], score=1.0, role="page_header"),
+            ElementRecord(box=[0, 20, 10, 30], score=1.0, role="section_headings"),
+        ],
+        tables=[ElementRecord(box=[0, 30, 10, 40], score=1.0, role=None)],
+        figures=[ElementRecord(box=[0, 40, 10, 50], score=1.0, role=None)],
+    )
+
+    assert extract_region_boxes(layout_res, {"paragraphs", "tables"}) == [
+        [0, 0, 10, 10],
+        [0, 30, 10, 40],
+    ]
+    assert extract_region_boxes(layout_res, {"section_headings", "figures"}) == [
+        [0, 20, 10, 30],
+        [0, 40, 10, 50],
+    ]
+
+    assert validate_ocr_regions(None) is None
+    assert validate_ocr_regions(["tables"]) == {"tables"}
+    with pytest.raises(ValueError):
+        validate_ocr_regions(["invalid"])
+
+
+def test_template_ocr():
+    configs = {
+        "ocr": {
+            "text_detector": {"from_pretrained": False},
+            "text_recognizer": {"from_pretrained": False},
+        },
+        "layout_analyzer": {
+            "layout_parser": {"from_pretrained": False},
+            "table_structure_recognizer": {"from_pretrained": False},
+        },
+    }
+    analyzer = DocumentAnalyzer(
+        configs=configs, device="cpu", tasks=["words", "paragraphs"]
+    )
+    img = np.full((1000, 800, 3), 255, dtype=np.uint8)
+    layout_res = LayoutAnalyzerRecord(
+        paragraphs=[ElementRecord(box=[100, 100, 400, 200], score=1.0, role=None)],
+        tables=[],
+        figures=[ElementRecord(box=[500, 500, 700, 700], score=1.0, role=None)],
+    )
+    assert analyzer.template_text_boxes(layout_res) == [[100, 100, 400, 200]]
+
+    det_outputs = TextDetectorRecord(
+        points=np.array(
+            [
+                [[110, 110], [300, 110], [300, 130], [110, 130]],
+                [[110, 300], [300, 300], [300, 320], [110, 320]],
+            ],
+            dtype=np.int32,
+        ),
+        scores=np.array([0.9, 0.8]),
+    )
+
+    # 位置合わせできた場合はレイアウト解析を行わず、テンプレートの文字領域のみを読み取る
+    with (
+        patch.object(analyzer, "match_template", return_value=layout_res),
+        patch.object(analyzer.layout, "predict") as layout_predict,
+        patch.object(
+            analyzer.ocr.detector, "predict", return_value=(det_outputs, None)
+        ) as detect,
+    ):
+        results, _, _ = analyzer.predict(img)
+
+    layout_predict.assert_not_called()
+    x0, y0, x1, y1 = detect.call_args.kwargs["region"]
+    assert x0 <= 100 and y0 <= 100 and x1 >= 400 and y1 >= 200
+    assert x1 < 500 and y1 < 500
+    assert results.words.points.tolist() == [det_outputs.points[0].tolist()]
+    assert len(results.paragraphs) == 1
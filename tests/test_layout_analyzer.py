@@ -1,8 +1,30 @@
+import copy
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 import torch
 from omegaconf import OmegaConf
 
+from yomitoku.configs import LayoutParserRTDETRv2Config
 from yomitoku.layout_analyzer import LayoutAnalyzer
+from yomitoku.layout_parser import (
+    LayoutParser,
+    filter_contained_rectangles_across_categories,
+    filter_contained_rectangles_within_category,
+)
+from yomitoku.models import RTDETRv2, RTDETRv2Deploy
+from yomitoku.models.layers.rtdetr_backbone import FrozenBatchNorm2d
+from yomitoku.models.layers.rtdetr_hybrid_encoder import RepVggBlock
+from yomitoku.postprocessor import (
+    RTDETRPostProcessor,
+    filter_detections,
+    merge_detections,
+)
+from yomitoku.table_structure_recognizer import (
+    extract_cells,
+    filter_contained_cells_within_spancell,
+)
 
 
 def test_layout():
@@ -55,3 +77,203 @@ def test_layout_invalid_config():
     configs = {"test": "invalid"}
     with pytest.raises(AssertionError):
         LayoutAnalyzer(configs=configs)
+
+
+def test_extract_cells():
+    row_boxes = [[0, 0, 100, 10], [0, 10, 100, 20]]
+    col_boxes = [[0, 0, 50, 20], [50, 0, 100, 20], [200, 0, 300, 20]]
+    cells = extract_cells(row_boxes, col_boxes)
+
+    assert [(cell["row"], cell["col"]) for cell in cells] == [
+        (1, 1),
+        (1, 2),
+        (2, 1),
+        (2, 2),
+    ]
+    assert cells[1]["box"] == [50, 0, 100, 10]
+    assert all(isinstance(v, int) for cell in cells for v in cell["box"])
+
+    span_boxes = [[0, 0, 100, 10], [500, 500, 600, 600]]
+    cells = filter_contained_cells_within_spancell(cells, span_boxes)
+
+    assert [
+        (cell["row"], cell["col"], cell["row_span"], cell["col_span"]) for cell in cells
+    ] == [(1, 1, 1, 2), (2, 1, 1, 1), (2, 2, 1, 1)]
+    assert cells[0]["box"] == [0, 0, 100, 10]
+
+
+def test_filter_contained_rectangles():
+    category_elements = {
+        "paragraphs": [
+            {"box": [0, 0, 100, 100]},
+            {"box": [10, 10, 50, 50]},
+            {"box": [1, 1, 100, 100]},
+            {"box": [200, 200, 300, 300]},
+        ],
+        "tables": [
+            {"box": [190, 190, 310, 310]},
+        ],
+    }
+
+    category_elements = filter_contained_rectangles_within_category(category_elements)
+    assert category_elements["paragraphs"] == [
+        {"box": [0, 0, 100, 100]},
+        {"box": [200, 200, 300, 300]},
+    ]
+
+    category_elements = filter_contained_rectangles_across_categories(
+        category_elements, "tables", "paragraphs"
+    )
+    assert category_elements["paragraphs"] == [{"box": [0, 0, 100, 100]}]
+    assert category_elements["tables"] == [{"box": [190, 190, 310, 310]}]
+
+
+def sort_detections(labels, boxes, scores):
+    """ランダムな重みではスコアが同値の検出が多く順位が不定となるため、順序に依存せず比較する"""
+    boxes = np.round(np.asarray(boxes, dtype=np.float64), 2)
+    labels = np.asarray(labels)
+    order = np.lexsort([*boxes.T[::-1], labels])
+    return labels[order], boxes[order], np.sort(np.asarray(scores))
+
+
+def test_rtdetr_deploy():
+    torch.manual_seed(0)
+    cfg = OmegaConf.structured(LayoutParserRTDETRv2Config)
+    model = RTDETRv2(cfg)
+
+    # 畳み込みへの統合を検証するため、BatchNormの統計量と係数を初期値から変更する
+    for m in model.modules():
+        if isinstance(m, (torch.nn.BatchNorm2d, FrozenBatchNorm2d)):
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    model.eval()
+
+    postprocessor = RTDETRPostProcessor(
+        num_classes=cfg.RTDETRTransformerv2.num_classes,
+        num_top_queries=cfg.RTDETRTransformerv2.num_queries,
+    )
+    deployed = RTDETRv2Deploy(copy.deepcopy(model), copy.deepcopy(postprocessor))
+
+    modules = list(deployed.modules())
+    assert not any(
+        isinstance(m, (torch.nn.BatchNorm2d, FrozenBatchNorm2d)) for m in modules
+    )
+    assert not any(hasattr(m, "conv1") for m in modules if isinstance(m, RepVggBlock))
+
+    tensor = torch.rand(1, 3, *cfg.data.img_size)
+    orig_size = (1000, 800)
+    with torch.inference_mode():
+        # デコーダのクエリ選択は順位に依存するため、エンコーダの出力までを比較する
+        expected = model.encoder(model.backbone(tensor))
+        outputs = deployed.model.encoder(deployed.model.backbone(tensor))
+        for output, feat in zip(outputs, expected):
+            assert torch.allclose(output, feat, atol=1e-4)
+
+        expected = postprocessor(model(tensor), torch.tensor([orig_size]), 0.0)[0]
+        outputs = filter_detections(deployed(tensor), [orig_size], 0.0)[0]
+
+    labels, boxes, scores = sort_detections(
+        outputs["labels"], outputs["boxes"], outputs["scores"]
+    )
+    exp_labels, exp_boxes, exp_scores = sort_detections(
+        expected["labels"], expected["boxes"], expected["scores"]
+    )
+    assert (labels == exp_labels).all()
+    assert np.allclose(boxes, exp_boxes, atol=1e-2)
+    assert np.allclose(scores, exp_scores, atol=1e-4)
+
+
+def test_layout_parser_onnx(tmp_path):
+    parser = LayoutParser(from_pretrained=False, device="cpu")
+    tensor = torch.rand(1, 3, *parser._cfg.data.img_size)
+    expected = parser.infer(tensor)
+
+    parser._cfg.onnx_runtime.cache_dir = str(tmp_path)
+    parser.load_onnx()
+    parser.infer_onnx = True
+    preds = parser.infer(tensor)
+
+    # バッチはバッチサイズ1のモデルで1枚ずつ推論する
+    batch = parser.infer(torch.cat([tensor, tensor]))
+    assert batch["scores"].shape[0] == 2
+    assert torch.equal(batch["scores"][1], preds["scores"][0])
+
+    labels, boxes, scores = sort_detections(
+        preds["labels"][0], preds["boxes"][0], preds["scores"][0]
+    )
+    exp_labels, exp_boxes, exp_scores = sort_detections(
+        expected["labels"][0], expected["boxes"][0], expected["scores"][0]
+    )
+    assert (labels == exp_labels).all()
+    assert np.allclose(boxes, exp_boxes, atol=1e-2)
+    assert np.allclose(scores, exp_scores, atol=1e-4)
+
+
+def test_merge_detections():
+    results = [
+        dict(
+            labels=np.array([0, 0, 1]),
+            boxes=np.array(
+                [[0, 0, 100, 100], [200, 0, 300, 100], [0, 0, 100, 100]],
+                dtype=np.float32,
+            ),
+            scores=np.array([0.9, 0.8, 0.7], dtype=np.float32),
+        ),
+        dict(
+            labels=np.array([0]),
+            boxes=np.array([[10, 0, 110, 100]], dtype=np.float32),
+            scores=np.array([0.6], dtype=np.float32),
+        ),
+    ]
+
+    # 同じカテゴリで重なるボックスのみを統合する
+    merged = merge_detections(results, iou_threshold=0.5, method="nms")
+    assert len(merged["boxes"]) == 3
+    assert [0, 0, 100, 100] in merged["boxes"].tolist()
+
+    merged = merge_detections(results, iou_threshold=0.5, method="wbf")
+    index = np.argmax(merged["scores"])
+    assert merged["scores"][index] == pytest.approx(0.9)
+    assert merged["boxes"][index][0] == pytest.approx(6 / 1.5)
+
+    with pytest.raises(ValueError):
+        merge_detections(results, method="dummy")
+
+
+def test_layout_parser_tiling(tmp_path):
+    parser = LayoutParser(from_pretrained=False, device="cpu")
+    receipt = np.full((2000, 500, 3), 255, dtype=np.uint8)
+    assert parser.views(receipt) == [(0, 0, 500, 2000)]
+    assert parser.letterbox_size((0, 0, 500, 2000)) == (2000, 2000)
+
+    parser._cfg.tiling.mode = "tile"
+    parser._cfg.tiling.batch_size = 4
+    views = parser.views(receipt)
+    assert views[0] == (0, 0, 500, 2000)
+    assert all(x1 - x0 == y1 - y0 == 500 for x0, y0, x1, y1 in views[1:])
+
+    with patch.object(parser, "infer", wraps=parser.infer) as mock:
+        results, _ = parser.predict(receipt)
+    assert mock.call_count == -(-len(views) // 4)
+    assert mock.call_args_list[0][0][0].shape == (4, 3, 640, 640)
+    for element in results.paragraphs + results.tables + results.figures:
+        assert 0 <= element.box[0] <= element.box[2] <= 500
+        assert 0 <= element.box[1] <= element.box[3] <= 2000
+
+    # 余白は白で埋める
+    tensor = torch.zeros(3, 640, 640)
+    parser.preprocess_view(np.zeros_like(receipt), (0, 0, 500, 2000), tensor)
+    assert tensor[:, :, :160].eq(0).all()
+    assert tensor[:, :, 160:].eq(1).all()
+
+    parser._cfg.tiling.mode = "letterbox"
+    with patch.object(parser, "infer", wraps=parser.infer) as mock:
+        parser.predict(receipt)
+    mock.assert_called_once()
+
+    path_cfg = tmp_path / "layout_parser.yaml"
+    OmegaConf.save({"tiling": {"mode": "dummy"}}, path_cfg)
+    with pytest.raises(ValueError):
+        LayoutParser(path_cfg=str(path_cfg), from_pretrained=False, device="cpu")
@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+from yomitoku.layout_analyzer import LayoutAnalyzerRecord
+from yomitoku.layout_parser import ElementRecord
+from yomitoku.layout_template import LayoutTemplate, transform_boxes
+from yomitoku.table_structure_recognizer import (
+    TableCellRecord,
+    TableStructureRecognizerRecord,
+)
+
+
+def make_form(seed=0):
+    rng = np.random.default_rng(seed)
+    img = np.full((1000, 800, 3), 255, dtype=np.uint8)
+    for i in range(40):
+        x, y = rng.integers(20, 700), rng.integers(20, 950)
+        text = "".join(rng.choice(list("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789"), 6))
+        cv2.putText(img, text, (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0, 2)
+    cv2.rectangle(img, (100, 600), (700, 800), (0, 0, 0), 2)
+    cv2.line(img, (100, 700), (700, 700), (0, 0, 0), 2)
+    return img
+
+
+def make_layout():
+    cells = [
+        TableCellRecord(
+            col=1,
+            row=row + 1,
+            col_span=1,
+            row_span=1,
+            box=[100, 600 + row * 100, 700, 700 + row * 100],
+            contents=None,
+        )
+        for row in range(2)
+    ]
+    return LayoutAnalyzerRecord(
+        paragraphs=[ElementRecord(box=[50, 50, 400, 100], score=0.9, role=None)],
+        tables=[
+            TableStructureRecognizerRecord(
+                box=[100, 600, 700, 800], n_row=2, n_col=1, cells=cells, order=0
+            )
+        ],
+        figures=[],
+    )
+
+
+def test_transform_boxes():
+    H = np.array([[1, 0, 10], [0, 1, -5], [0, 0, 1]], dtype=np.float64)
+    boxes = transform_boxes([[0, 10, 20, 30]], H, (100, 100))
+    assert boxes.tolist() == [[10, 5, 30, 25]]
+
+    assert transform_boxes([], H, (100, 100)).shape == (0, 4)
+
+
+def test_layout_template(tmp_path):
+    img = make_form()
+    template = LayoutTemplate.from_image(img, make_layout())
+
+    H = np.array([[1, 0, 15], [0, 1, 10], [0, 0, 1]], dtype=np.float64)
+    page = cv2.warpPerspective(img, H, (800, 1000), borderValue=(255, 255, 255))
+
+    layout = template.match(page)
+    assert layout is not None
+    assert np.allclose(layout.paragraphs[0].box, [65, 60, 415, 110], atol=3)
+    assert np.allclose(layout.tables[0].box, [115, 610, 715, 810], atol=3)
+    assert np.allclose(layout.tables[0].cells[1].box, [115, 710, 715, 810], atol=3)
+
+    # 異なる帳票は位置合わせしない
+    assert template.match(make_form(seed=1)) is None
+
+    template.save(tmp_path / "template.npz")
+    loaded = LayoutTemplate.load(tmp_path / "template.npz")
+    assert loaded.hash == template.hash
+    assert loaded.layout.dict() == template.layout.dict()
@@ -1,8 +1,22 @@
+import copy
+from unittest.mock import patch
+
+import cv2
+import numpy as np
 import pytest
 import torch
+import torch.nn.functional as F
 from omegaconf import OmegaConf
 
-from yomitoku.ocr import OCR
+from yomitoku.configs import TextDetectorDBNetConfig
+from yomitoku.data.functions import calc_tiles
+from yomitoku.data.page import Page
+from yomitoku.models import DBNet
+from yomitoku.ocr import OCR, OCRResultArrays, OCRSchema
+from yomitoku.postprocessor import DBnetPostProcessor
+from yomitoku.text_detector import TextDetector
+from yomitoku.text_recognizer import TextRecognizer, perceptual_hash
+from yomitoku.utils.misc import quads_to_xyxy
 
 
 def test_ocr():
@@ -50,3 +64,256 @@ def test_ocr_invalid_config():
     config = {"test": "invalid"}
     with pytest.raises(AssertionError):
         OCR(configs=config)
+
+
+def test_ocr_result_arrays():
+    results = OCRResultArrays(
+        points=np.array(
+            [
+                [[10, 10], [50, 10], [50, 20], [10, 20]],
+                [[60, 5], [70, 5], [70, 80], [60, 80]],
+            ],
+            dtype=np.int32,
+        ),
+        det_scores=np.array([0.9, 0.8]),
+        rec_scores=np.array([0.7, 0.6]),
+        directions=np.array([0, 1], dtype=np.uint8),
+        contents=["abc", "縦書き"],
+    )
+
+    assert len(results) == 2
+    assert results.boxes().tolist() == [[10, 10, 50, 20], [60, 5, 70, 80]]
+
+    schema = results.to_schema()
+    assert isinstance(schema, OCRSchema)
+    assert schema.words[0].points == [[10, 10], [50, 10], [50, 20], [10, 20]]
+    assert schema.words[0].direction == "horizontal"
+    assert schema.words[1].direction == "vertical"
+    assert schema.words[1].content == "縦書き"
+    assert schema.words[1].det_score == 0.8
+    assert schema.words[1].rec_score == 0.6
+    assert schema.model_dump() == OCRSchema(**schema.model_dump()).model_dump()
+
+
+def test_perceptual_hash():
+    crops = -torch.ones(2, 3, 32, 800)
+    crops[:, :, 8:24, 16:80] = 1.0
+    crops[1, :, 8:24, 100:140] = 1.0
+
+    noisy = crops + torch.randn_like(crops) * 1e-3
+    keys = perceptual_hash(crops)
+    assert keys == perceptual_hash(noisy)
+    assert keys[0] != keys[1]
+
+
+def test_parseq_onnx(tmp_path):
+    path_cfg = tmp_path / "text_recognizer.yaml"
+    path_cfg.write_text("max_label_length: 8\n")
+
+    recognizer = TextRecognizer(
+        model_name="parseq-small",
+        path_cfg=str(path_cfg),
+        from_pretrained=False,
+        device="cpu",
+    )
+    # 一部の系列のみ途中で<eos>を出力し、デコードを打ち切るようにする
+    recognizer.model.head.bias.data[recognizer.tokenizer.eos_id] = 1.0
+
+    tensor = torch.randn(4, 3, 32, 800)
+    expected = recognizer.infer(tensor)["probs"]
+
+    recognizer._cfg.onnx_runtime.cache_dir = str(tmp_path)
+    recognizer.load_onnx()
+    assert all(
+        path.startswith(str(tmp_path)) for path in recognizer.onnx_paths().values()
+    )
+    recognizer.infer_onnx = True
+    probs = recognizer.infer(tensor)["probs"]
+
+    assert probs.shape == expected.shape
+    assert torch.allclose(probs, expected, atol=1e-5)
+
+
+def test_dbnet_deploy():
+    torch.manual_seed(0)
+    model = DBNet(OmegaConf.structured(TextDetectorDBNetConfig))
+
+    # ランダムな重みでは活性値が発散するため、BatchNormの統計量を入力から推定する
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.momentum = None
+    with torch.no_grad():
+        model.train()(torch.rand(2, 3, 256, 256))
+    model.eval()
+
+    deployed = copy.deepcopy(model).deploy(channels_last=True)
+    assert not hasattr(deployed.decoder, "thresh")
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in deployed.modules())
+
+    tensor = torch.rand(1, 3, 256, 320)
+    with torch.inference_mode():
+        expected = model(tensor)["binary"]
+        binary = deployed(tensor.contiguous(memory_format=torch.channels_last))
+    assert torch.allclose(binary["binary"], expected, atol=5e-3)
+
+    detector = TextDetector(from_pretrained=False, device="cpu")
+    assert detector.channels_last
+    assert not hasattr(detector.model.decoder, "thresh")
+
+
+def test_dbnet_low_res():
+    torch.manual_seed(0)
+    model = DBNet(OmegaConf.structured(TextDetectorDBNetConfig))
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.momentum = None
+    with torch.no_grad():
+        model.train()(torch.rand(2, 3, 256, 256))
+    model.eval()
+
+    low_res = copy.deepcopy(model).to_low_resolution()
+    assert not hasattr(low_res.decoder, "thresh")
+
+    tensor = torch.rand(1, 3, 256, 320)
+    with torch.inference_mode():
+        expected = F.avg_pool2d(model(tensor)["binary"], 4)
+        binary = low_res(tensor)["binary"]
+    assert binary.shape == (1, 1, 64, 80)
+    assert torch.allclose(binary, expected, atol=1e-5)
+
+
+def test_low_res_postprocess():
+    rng = np.random.default_rng(0)
+    binary = np.zeros((512, 640), dtype=np.float32)
+    # 低解像度で結合しないよう、文字領域を格子状に離して配置する
+    for y in range(0, 480, 120):
+        for x in range(0, 640, 160):
+            y1, x1 = y + rng.integers(0, 20), x + rng.integers(0, 20)
+            binary[y1 : y1 + rng.integers(8, 40), x1 : x1 + rng.integers(20, 120)] = 1
+    binary = torch.tensor(binary)[None, None]
+
+    cfg = OmegaConf.structured(TextDetectorDBNetConfig).post_process
+    expected, _ = DBnetPostProcessor(**cfg)({"binary": binary}, (1024, 1280))
+    quads, _ = DBnetPostProcessor(**cfg, stride=4)(
+        {"binary": F.avg_pool2d(binary, 4)}, (1024, 1280)
+    )
+
+    expected = np.array(quads_to_xyxy(expected))
+    boxes = np.array(quads_to_xyxy(quads))
+    assert len(boxes) == len(expected)
+
+    # 最も近い矩形との辺の誤差が入力画像の解像度で1画素程度に収まる
+    error = np.abs(expected[:, None] - boxes[None]).mean(axis=-1)
+    assert len(set(error.argmin(axis=1))) == len(expected)
+    assert error.min(axis=1).mean() < 1.5
+
+
+def test_adaptive_resize():
+    detector = TextDetector(from_pretrained=False, device="cpu")
+    detector._cfg.data.adaptive_resize = True
+
+    def page(scale):
+        img = np.full((1280, 1280, 3), 255, dtype=np.uint8)
+        for y in range(60, 1200, int(40 * scale)):
+            cv2.putText(
+                img,
+                "Hello World text line",
+                (40, y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                scale,
+                (0, 0, 0),
+                max(1, int(scale * 2)),
+            )
+        return img
+
+    # 小さい文字は高解像度、大きい文字は低解像度で推論する
+    small = detector.preprocess(page(0.6))
+    large = detector.preprocess(page(3.0))
+    assert small.shape[2] > 1280 > large.shape[2]
+
+    # 文字のない画像は既定の解像度
+    blank = np.full((1280, 1280, 3), 255, dtype=np.uint8)
+    assert detector.input_size(blank) == (1280, 1600)
+
+
+def test_tiled_postprocess():
+    rng = np.random.default_rng(0)
+    binary = np.zeros((600, 900), dtype=np.float32)
+    # タイルの境界をまたぐ長い行と、タイル内に収まる短い行を配置する
+    for y in range(20, 580, 40):
+        x = rng.integers(0, 100)
+        binary[y : y + rng.integers(10, 25), x : x + rng.integers(50, 780)] = 0.9
+    binary = torch.tensor(binary)[None, None]
+
+    cfg = OmegaConf.structured(TextDetectorDBNetConfig).post_process
+    post_processor = DBnetPostProcessor(**cfg)
+    expected, _ = post_processor({"binary": binary}, (600, 900))
+
+    tiles = calc_tiles(600, 900, 256, 64)
+    candidates = [
+        post_processor.tile_candidates(binary[0, :, y0:y1, x0:x1], (x0, y0))
+        for x0, y0, x1, y1 in tiles
+    ]
+    quads, scores = post_processor.merge_tiles(
+        candidates, tiles, (600, 900), (600, 900)
+    )
+    assert len(quads) == len(scores)
+
+    expected = np.array(quads_to_xyxy(expected))
+    boxes = np.array(quads_to_xyxy(quads))
+    assert len(boxes) == len(expected)
+
+    error = np.abs(expected[:, None] - boxes[None]).mean(axis=-1)
+    assert len(set(error.argmin(axis=1))) == len(expected)
+    assert error.min(axis=1).max() < 1.0
+
+
+def test_tiled_detection(tmp_path):
+    detector = TextDetector(from_pretrained=False, device="cpu")
+    detector._cfg.tiling.enabled = True
+    detector._cfg.tiling.tile_size = 256
+    detector._cfg.tiling.overlap = 32
+    detector._cfg.tiling.batch_size = 3
+
+    img = np.full((700, 500, 3), 255, dtype=np.uint8)
+    results, _ = detector.predict(img)
+    assert len(results.points) == len(results.scores)
+
+    with patch.object(detector, "infer", wraps=detector.infer) as mock:
+        detector.predict(img)
+    # 9タイルを3タイルずつ推論する
+    assert mock.call_count == 3
+    assert mock.call_args[0][0].shape == (3, 3, 256, 256)
+
+    path_cfg = tmp_path / "text_detector.yaml"
+    OmegaConf.save({"tiling": {"enabled": True, "tile_size": 250}}, path_cfg)
+    with pytest.raises(ValueError):
+        TextDetector(path_cfg=str(path_cfg), from_pretrained=False, device="cpu")
+
+
+def test_detect_region():
+    detector = TextDetector(from_pretrained=False, device="cpu")
+    img = np.full((700, 500, 3), 255, dtype=np.uint8)
+    quads = np.array([[[0, 0], [50, 0], [50, 10], [0, 10]]], dtype=np.int32)
+
+    # 切り出した領域で検出し、入力画像の座標に戻す
+    with patch.object(
+        detector, "postprocess", return_value=(quads, np.array([0.9]))
+    ) as mock:
+        results, _ = detector.predict(img, region=[100, 200, 300, 400])
+    assert mock.call_args[0][1] == (200, 200)
+    assert results.points.tolist() == (quads + [100, 200]).tolist()
+
+
+def test_detector_page_cache():
+    detector = TextDetector(from_pretrained=False, device="cpu")
+    img = np.full((640, 480, 3), 255, dtype=np.uint8)
+    page = Page(img)
+
+    with patch.object(detector, "preprocess", wraps=detector.preprocess) as mock:
+        results, _ = detector.predict(page)
+        cached, _ = detector.predict(page)
+        detector.predict(img)
+    # 同じPageの前処理は1度だけ行う
+    assert mock.call_count == 2
+    assert np.array_equal(results.points, cached.points)
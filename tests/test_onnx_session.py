@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import onnxruntime
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from yomitoku.configs import TextDetectorDBNetConfig
+from yomitoku.utils.onnx_session import (
+    build_session_options,
+    create_session,
+    get_thread_budget,
+    optimized_model_path,
+    select_providers,
+    set_thread_budget,
+)
+
+
+@pytest.fixture
+def cfg():
+    return OmegaConf.structured(TextDetectorDBNetConfig).onnx_runtime
+
+
+def test_thread_budget(cfg):
+    set_thread_budget(8)
+    assert get_thread_budget("TextDetector") == 4
+    assert get_thread_budget("TableStructureRecognizer") == 4
+
+    set_thread_budget(8, shares={"ocr": 3, "layout": 1})
+    assert get_thread_budget("TextRecognizer") == 6
+    assert get_thread_budget("LayoutParser") == 2
+
+    options = build_session_options(cfg, name="TextRecognizer")
+    assert options.intra_op_num_threads == 6
+
+    # Configで指定したスレッド数を優先する
+    cfg.intra_op_num_threads = 3
+    options = build_session_options(cfg, name="TextRecognizer")
+    assert options.intra_op_num_threads == 3
+
+    with pytest.raises(ValueError):
+        set_thread_budget(8, shares={"recognizer": 1})
+
+    set_thread_budget(0)
+    assert get_thread_budget("TextDetector") == 0
+
+
+def test_session_options(cfg):
+    cfg.graph_optimization_level = "basic"
+    cfg.enable_cpu_mem_arena = False
+    options = build_session_options(cfg)
+    assert (
+        options.graph_optimization_level
+        == onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    )
+    assert not options.enable_cpu_mem_arena
+
+    cfg.graph_optimization_level = "O3"
+    with pytest.raises(ValueError):
+        build_session_options(cfg)
+
+
+def test_select_providers(cfg):
+    assert select_providers(cfg, torch.device("cpu")) is None
+    assert select_providers(cfg, torch.device("cuda")) == ["CUDAExecutionProvider"]
+
+    cfg.providers = ["CPUExecutionProvider"]
+    assert select_providers(cfg, torch.device("cpu")) == ["CPUExecutionProvider"]
+
+    cfg.providers = ["DummyExecutionProvider"]
+    with pytest.raises(ValueError):
+        select_providers(cfg, torch.device("cpu"))
+
+
+def test_create_session(cfg, tmp_path):
+    path_onnx = str(tmp_path / "model.onnx")
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.ReLU()).eval()
+    input = torch.randn(1, 4)
+    torch.onnx.export(
+        model,
+        input,
+        path_onnx,
+        input_names=["input"],
+        output_names=["output"],
+        dynamo=False,
+    )
+    expected = model(input).detach().numpy()
+
+    device = torch.device("cpu")
+    sess = create_session(path_onnx, device, cfg)
+    assert np.allclose(sess.run(None, {"input": input.numpy()})[0], expected)
+
+    cfg.use_optimized_model = True
+    path_ort = optimized_model_path(path_onnx, cfg, None)
+    assert path_ort == str(tmp_path / "model.all.default.ort")
+
+    create_session(path_onnx, device, cfg)
+    assert os.path.exists(path_ort)
+
+    sess = create_session(path_onnx, device, cfg)
+    assert np.allclose(sess.run(None, {"input": input.numpy()})[0], expected)